@@ -3,19 +3,97 @@ LL(1) and CYK parser for formal languages class.
 
 Author: Claire Hardgrove
 """
-# TODO: Stop hardcoding the parse table
+# The default parse table for G' is hardcoded below. Tables for other grammars
+# are generated from a grammar file by LL1Grammar and cached by grammar hash.
 
 # access an element of the parse table at M[X, b] using M['X']['b']
 # blank entries throw a keyerror
 # epsilon is encoded as the empty string
 
 import sys
+import os
 import re
-from collections import defaultdict
+import json
+import hashlib
+import struct
+import stat
+import math
+import bisect
+import random
+import time
+import platform
+import tempfile
+import tracemalloc
+import contextlib
+import asyncio
+import socket
+import threading
+import io
+import multiprocessing
+from multiprocessing import shared_memory
+from collections import defaultdict, deque
+from array import array
 import argparse
 from os.path import exists
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 EPSILON = ''
+# epsilon is written as this symbol (or as an empty alternative) in grammar files
+EPSILON_SYMBOL = 'ε'
+# compiled tables are saved here, keyed by a hash of the grammar file
+CACHE_DIR = os.environ.get('PARSING_CACHE_DIR', os.path.join(
+    os.path.expanduser('~'), '.cache', 'parsing'))
+# bump this whenever the layout of a cached table changes
+LL1_CACHE_VERSION = 1
+LALR1_CACHE_VERSION = 1
+# number of characters read at a time when streaming input
+CHUNK_SIZE = 1 << 16
+# LL1Parser.parse_state saves the stack every this many tokens
+CHECKPOINT_INTERVAL = 64
+WHITESPACE = re.compile(r'\s+')
+# compiled CYK grammar artifacts start with this, followed by the version
+ARTIFACT_MAGIC = b'CYKG'
+CYK_ARTIFACT_VERSION = 2
+# a rule weight in a grammar file, e.g. `VP -> V NP [0.7]`
+RULE_WEIGHT = re.compile(r'^\[([0-9.eE+-]+)\]$')
+# CYKParser uses the NumPy engine for strings at least this long (None turns
+# it off) whose sampled chart density is at least NUMPY_MIN_DENSITY. It won
+# on test11_cyk_dense_grammar (every cell filled: 0.59 s against 5.6 s for
+# the sparse engine at 400 tokens, 0.17 s against 0.72 s at 200) and on a
+# grammar filling 30% of the cells (0.7 s against 1.0 s at 400 tokens), but
+# was 20 times slower on test6_cyk_unambiguous_grammar (under 3% filled)
+NUMPY_THRESHOLD = 256
+NUMPY_MIN_DENSITY = 0.25
+# nor is it used if its arrays would take more than this many bytes
+NUMPY_MAX_BYTES = 1 << 27
+# span lengths, strings per length, and seconds per call after which a
+# benchmarked engine is not run on longer strings
+BENCHMARK_LENGTHS = [16, 32, 64, 128, 256]
+BENCHMARK_REPEATS = 20
+BENCHMARK_TIME_LIMIT = 2.0
+# CYKParser.parallel_table hands a block of at least this many partitions to
+# a worker, and splits each span length into at most this many blocks per
+# worker
+PARALLEL_BLOCK_WORK = 1 << 15
+PARALLEL_BLOCKS_PER_PROCESS = 4
+# the parallel fill uses the dense engine, which was 19 times slower than the
+# sparse engine on the test grammars (under 2% of cells filled), 1.3 times
+# slower with 30% filled and faster when every cell was, so CYKParser only
+# fills a table in parallel if at least this fraction of the cells are
+# filled in the sampled windows
+PARALLEL_MIN_DENSITY = 0.25
+# the chart density of a string is estimated from this many windows of
+# DENSITY_WINDOW tokens, spread evenly across it
+DENSITY_WINDOWS = 4
+DENSITY_WINDOW = 64
+# the Unix socket that --serve listens on and --client connects to
+SERVER_SOCKET = 'parser.sock'
+# binary trace files start with this, and hold one record per LL(1) step
+TRACE_MAGIC = b'LL1T\x01'
+TRACE_STEP = struct.Struct('<IIH')
 ACCEPTED = 'ACCEPTED'
 REJECTED = 'REJECTED'
 ERROR_INVALID_SYMBOL = 'ERROR_INVALID_SYMBOL'
@@ -73,6 +151,234 @@ class Stack:
         return ''.join(reversed(self.items))
 
 
+class TextTracer:
+    """
+    Prints each step of an LL1Parser as the remaining input followed by the
+    stack, top first, e.g. `(if(-1a)(print1))$ ER$`
+    """
+
+    def __init__(self, file=None):
+        self.file = file
+        self.string = None
+
+    def start(self, parser, string):
+        """Called with the parser and the input (ending in '$') before parsing"""
+        self.string = string
+
+    def step(self, index, stack):
+        """
+        Called before each step with the index of the current token and the
+        list of stack items, bottom first
+        """
+        print(self.string[index:], ''.join(reversed(stack)),
+              file=self.file if self.file is not None else sys.stdout)
+
+    def finish(self, accepted):
+        """Called with the result once parsing has finished"""
+
+
+class RingBufferTracer(TextTracer):
+    """
+    Keeps the last `size` steps of an LL1Parser so they can be inspected
+    after a string is rejected. `lines` returns them in the same format as
+    TextTracer.
+    """
+
+    def __init__(self, size=20):
+        super().__init__()
+        self.steps = deque(maxlen=size)
+        self.accepted = None
+
+    def start(self, parser, string):
+        self.string = string
+        self.steps.clear()
+        self.accepted = None
+
+    def step(self, index, stack):
+        self.steps.append((index, tuple(stack)))
+
+    def finish(self, accepted):
+        self.accepted = accepted
+
+    def lines(self):
+        """Return the stored steps formatted as lines of text"""
+        return ["{tokens} {stack}".format(tokens=self.string[index:],
+                                         stack=''.join(reversed(stack))) \
+                for index, stack in self.steps]
+
+
+class BinaryTracer:
+    """
+    Writes each step of an LL1Parser to a binary trace file. The file
+    starts with TRACE_MAGIC and a JSON list of the grammar's symbols, followed
+    by one TRACE_STEP record per step holding the input index, the stack depth
+    and the id of the symbol on top of the stack. The full stack is not
+    stored, since it can be rebuilt by replaying the steps against the parse
+    table. Use `read_binary_trace` to read the steps back.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.ids = None
+        self.buffer = bytearray()
+
+    def start(self, parser, string):
+        symbols = [parser.end] + sorted(parser.terminals) + sorted(parser.table)
+        self.ids = {symbol: index for index, symbol in enumerate(symbols)}
+        header = json.dumps(symbols).encode()
+        self.buffer = bytearray(TRACE_MAGIC)
+        self.buffer += struct.pack('<I', len(header)) + header
+
+    def step(self, index, stack):
+        self.buffer += TRACE_STEP.pack(index, len(stack), self.ids[stack[-1]])
+
+    def finish(self, accepted):
+        if isinstance(self.file, str):
+            with open(self.file, 'wb') as file:
+                file.write(self.buffer)
+        else:
+            self.file.write(self.buffer)
+        self.buffer = bytearray()
+
+
+def read_binary_trace(path):
+    """
+    Read a trace written by BinaryTracer and return a list of
+    (index, stack depth, top of stack symbol) steps
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    if not data.startswith(TRACE_MAGIC):
+        raise ValueError("{path} is not a binary trace".format(path=path))
+    offset = len(TRACE_MAGIC)
+    header_length, = struct.unpack_from('<I', data, offset)
+    offset += 4
+    symbols = json.loads(data[offset:offset+header_length].decode())
+    offset += header_length
+    return [(index, depth, symbols[symbol]) for index, depth, symbol \
+            in TRACE_STEP.iter_unpack(data[offset:])]
+
+
+class ParseStats:
+    """
+    Counters and phase timers for a parser, switched on by giving the parser
+    a ParseStats. `timers` holds the seconds spent in each phase (read,
+    validate, fill, tree and output) and `counters` the counts of engine
+    internals, such as the LL(1) steps, table lookups, matches and largest
+    stack (`max_stack`), or the CYK cells, cells filled, pairs of cells
+    combined, rule checks, rule matches and tree nodes. Counts are kept outside the inner loops where
+    they can be worked out afterwards, so a parser without a ParseStats does
+    no extra work in them.
+    """
+
+    def __init__(self):
+        self.timers = defaultdict(float)
+        self.counters = defaultdict(int)
+
+    def add(self, name, value=1):
+        """Add to a counter"""
+        self.counters[name] += value
+
+    def maximum(self, name, value):
+        """Raise a counter to `value` if it is lower"""
+        if value > self.counters[name]:
+            self.counters[name] = value
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """A context manager that adds the time spent in it to a phase"""
+        started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.timers[name] += time.perf_counter() - started
+
+    def as_dict(self):
+        """Return the timers and counters as a dictionary"""
+        return {'timers': dict(self.timers), 'counters': dict(self.counters)}
+
+    def __str__(self):
+        lines = ["{name:<14}{seconds:.6f} s".format(name=name, seconds=seconds) \
+                 for name, seconds in self.timers.items()]
+        lines.extend("{name:<14}{value}".format(name=name, value=value) \
+                     for name, value in sorted(self.counters.items()))
+        return '\n'.join(lines)
+
+
+def phase(stats, name):
+    """
+    Return stats.phase(name), or a context manager that does nothing if
+    `stats` is None
+    """
+    return contextlib.nullcontext() if stats is None else stats.phase(name)
+
+
+class LL1ParseError(Exception):
+    """
+    A rejection found by LL1Parser.errors: the symbol at `offset` in the
+    stripped string (the end marker at the end of the input) could not be
+    parsed, and `expected` lists the terminals that could have been parsed
+    there. `line` and `column` locate the symbol in the original file, if
+    it is known.
+    """
+    def __init__(self, offset, token, expected, line=None, column=None):
+        self.offset = offset
+        self.token = token
+        self.expected = expected
+        self.line = line
+        self.column = column
+
+    def __str__(self):
+        if self.line is None:
+            position = "offset {offset}".format(offset=self.offset)
+        else:
+            position = "line {line}, column {column}".format(
+                line=self.line, column=self.column)
+        return "{position}: unexpected {token}, expected {expected}".format(
+            position=position, token=describe_symbol(self.token),
+            expected=', '.join(describe_symbol(symbol) for symbol in self.expected))
+
+
+def describe_symbol(symbol, end=END):
+    """Quote a symbol for an error message, or name the end marker"""
+    return 'end of input' if symbol == end else "'{symbol}'".format(symbol=symbol)
+
+
+class SourceMap:
+    """
+    Maps offsets in a string with its whitespace stripped back to the line
+    and column of the symbol in the original text, both numbered from 1.
+    Only the whitespace runs and line starts are stored, so a position is
+    found with two binary searches. The end of the input is placed just
+    after its last symbol.
+    """
+
+    def __init__(self, text):
+        # the symbol at stripped offset o, where starts[k] <= o < starts[k+1],
+        # is at o + removed[k] in the text
+        self.starts = [0]
+        self.removed = [0]
+        removed = 0
+        for match in WHITESPACE.finditer(text):
+            removed += match.end() - match.start()
+            self.starts.append(match.end() - removed)
+            self.removed.append(removed)
+        self.length = len(text) - removed
+        self.line_starts = [0] + [match.end() for match in re.finditer('\n', text)]
+
+    def original(self, offset):
+        """Return the position in the text of the symbol at a stripped offset"""
+        if offset >= self.length and self.length:
+            return self.original(self.length - 1) + 1 + offset - self.length
+        return offset + self.removed[bisect.bisect_right(self.starts, offset) - 1]
+
+    def locate(self, offset):
+        """Return the (line, column) of the symbol at a stripped offset"""
+        position = self.original(offset)
+        line = bisect.bisect_right(self.line_starts, position)
+        return line, position - self.line_starts[line-1] + 1
+
+
 class LL1Parser:
     """
     An LL(1) parser. The parse method parses an input string an returns
@@ -82,19 +388,32 @@ class LL1Parser:
     """
 
     def __init__(self, table=LL1TABLE, terminals=TERMINALS, start=START,
-                 end=END, error_invalid_symbol=ERROR_INVALID_SYMBOL):
+                 end=END, error_invalid_symbol=ERROR_INVALID_SYMBOL,
+                 compiled=False, tracer=None, stats=None):
         self.table = table
         self.terminals = terminals
         self.start = start
         self.end = end
         self.stack = Stack()
         self.error_invalid_symbol = error_invalid_symbol
+        self.compiled = compiled
+        self._compiled_table = None
+        self.tracer = tracer
+        self.stats = stats
+
+    def compile(self):
+        """
+        Return the CompiledLL1Table for this parser's table, building it the
+        first time it is needed
+        """
+        if self._compiled_table is None:
+            self._compiled_table = CompiledLL1Table(self.table, self.terminals,
+                                                    self.start, self.end)
+        return self._compiled_table
 
     def read_input(self, path):
-        """Read and strip all whitespace from input"""
-        with open(path) as file:
-            string = ''.join([re.sub(r'\s+', '', line) for line in file.readlines()])
-        return string
+        """Read and strip all whitespace from input (see `read_input`)"""
+        return read_input(path)[0]
 
     def is_valid(self, string):
         """
@@ -102,6 +421,20 @@ class LL1Parser:
         """
         return set(string).issubset(self.terminals)
 
+    def recognise_tokens(self, tokens, lexer):
+        """
+        Returns True if a sequence of token ids from a Lexer is in the
+        language. The ids are mapped straight to the compiled engine's
+        terminal ids, so no token names are looked up. A token whose name is
+        not a terminal is rejected before the engine sees it, as
+        `check_tokens` does.
+        """
+        compiled = self.compile()
+        ids = [compiled.ids.get(name) for name in lexer.names]
+        if None in ids and any(ids[token] is None for token in tokens):
+            return False
+        return compiled.run(ids[token] for token in tokens)
+
     def is_terminal(self, token):
         """Returns true if a symbol is in the list of terminals"""
         return token in self.terminals
@@ -148,25 +481,73 @@ class LL1Parser:
         is in the language, otherwise it returns False.
         """
 
-        string = self.read_input(infile)
+        stats = self.stats
+        if stats is None:
+            string, valid = read_input(infile, self.terminals)
+        else:
+            # read and validate in separate passes, so that each can be timed
+            with stats.phase('read'):
+                string = read_input(infile)[0]
+            with stats.phase('validate'):
+                valid = self.is_valid(string)
 
         # check if input contains only terminals from the grammar
-        if not self.is_valid(string):
+        if not valid:
             print(self.error_invalid_symbol)
             sys.exit(0)
 
+        with phase(stats, 'fill'):
+            return self.recognise(string)
+
+    def check(self, string):
+        """
+        Strip whitespace from a string and return ACCEPTED, REJECTED or the
+        invalid symbol error, without printing or exiting
+        """
+        string = WHITESPACE.sub('', string)
+        if not self.is_valid(string):
+            return self.error_invalid_symbol
+        return ACCEPTED if self.recognise(string) else REJECTED
+
+    def recognise(self, string):
+        """
+        Returns True if a string of terminals (with whitespace already
+        stripped) is in the language. Each step is reported to the parser's
+        tracer, if it has one, and counted in its stats, if it has them.
+        """
+        tracer = self.tracer
+        # the compiled engine gives the same result but cannot be traced
+        if self.compiled and tracer is None:
+            return self.compile().recognise(string, self.stats)
+        if tracer is None:
+            return self._run(string, None)
+        tracer.start(self, string + self.end)
+        accepted = self._run(string, tracer)
+        tracer.finish(accepted)
+        return accepted
+
+    def _run(self, string, tracer):
+        """The LL(1) algorithm. Returns True if the string is accepted."""
         # 1. append '$' to the input and push '$' to the stack
         string = string + self.end
+        self.stack = Stack()
         self.stack.push(self.end)
 
         # 2. push the start variable on the stack and scan the first token
         self.stack.push(self.start)
         index = 0 # token will be scanned when loop starts
 
+        stats = self.stats
         # 3. Repeat
         while not self.stack.is_empty():
             token = string[index]
-            print(string[index:], self.stack)
+            if tracer is not None:
+                tracer.step(index, self.stack.items)
+            if stats is not None:
+                stats.add('steps')
+                stats.maximum('max_stack', self.stack.size())
+                if self.is_variable(self.stack.peek()):
+                    stats.add('lookups')
             #3.1 If the top of the stack is a variable symbol V , and the current
             #token is a, then pop V and push the string from the table
             #entry (V , a). If the entry was empty, reject the input.
@@ -187,12 +568,16 @@ class LL1Parser:
                 if top_of_stack == token:
                     self.stack.pop()
                     index += 1
+                    if stats is not None:
+                        stats.add('matches')
                 else:
                     return False
             #3.3 else if the top of the stack and the token are both $, then
             #accept the input (the stack is empty and we have used all the
             #input.)
             elif top_of_stack == self.end and token == self.end:
+                if stats is not None:
+                    stats.add('matches')
                 break
             #3.4 else reject the input (the stack is empty but there is unread
             #input.)
@@ -201,331 +586,4945 @@ class LL1Parser:
         # return True if the string has not already been rejected
         return True
 
-class CNFError(Exception):
-    """An error that is raised if a token is not in the grammar"""
-    def __init__(self, rule):
-        self.rule = rule
+    def errors(self, string, recover=False):
+        """
+        Parse a string (with whitespace already stripped) and return a list
+        of LL1ParseError, which is empty if the string is accepted. Symbols
+        that are not terminals are reported like any other unexpected
+        symbol. Without `recover` parsing stops at the first error. With it,
+        the parser recovers in panic mode: input is skipped until a symbol
+        that something on the stack can parse, and the stack is popped down
+        to that symbol. Errors found before a terminal is matched again are
+        not reported, so each mistake is reported once, in one pass. Input
+        left over once the stack is empty is parsed as a new string, so
+        errors after it are still found.
+        """
+        string = list(string) + [self.end]
+        stack = [self.end, self.start]
+        index = 0
+        errors = []
+        sync = None # the symbols that can end a recovery, while recovering
+        restarted = None # where the start symbol was last pushed again
+        while stack:
+            token = string[index]
+            top = stack[-1]
+            if self.is_variable(top):
+                if self.is_entry(top, token):
+                    stack.pop()
+                    stack.extend(reversed(self.tokenize(self.get_entry(top, token))))
+                    continue
+                expected = sorted(self.table[top])
+            elif top == token:
+                stack.pop()
+                index += 1
+                sync = None
+                continue
+            else:
+                expected = [top]
+            if sync is None:
+                errors.append(LL1ParseError(index, token, expected))
+                if not recover:
+                    break
+                sync = self._sync_symbols(stack)
+            if token in sync and top != self.end:
+                # pop the stack down to a symbol that can parse the token
+                stack.pop()
+                while stack[-1] != token and stack[-1] != self.end and \
+                    not self.is_entry(stack[-1], token):
+                    stack.pop()
+            elif top == self.end and restarted != index and \
+                self.is_entry(self.start, token):
+                stack.append(self.start)
+                restarted = index
+            else:
+                index += 1
+        return errors
 
-    def __str__(self):
-        return "Grammar is not in CNF (Rule {rule})".format(rule=self.rule)
+    def _sync_symbols(self, stack):
+        """
+        Return the set of terminals that some symbol below the top of the
+        stack can start with, and the end marker
+        """
+        sync = set([self.end])
+        for symbol in stack[:-1]:
+            if self.is_variable(symbol):
+                sync.update(self.table[symbol])
+            else:
+                sync.add(symbol)
+        return sync
 
+    def report(self, infile, recover=False):
+        """
+        Read an input file and return the list of LL1ParseError for it (see
+        `errors`), with the line and column of each error in the file
+        """
+        text = read_text(infile)
+        source = SourceMap(text)
+        errors = self.errors(WHITESPACE.sub('', text), recover)
+        for error in errors:
+            error.line, error.column = source.locate(error.offset)
+        return errors
 
-class CYKTable:
-    """
-    A triangular matrix of the right size to parse `string`
-    :param: string A list of tokens representing the string that needs to be
-            parsed.
-    """
+    def stream(self):
+        """Return an LL1Stream for feeding input to this parser in chunks"""
+        return LL1Stream(self.compile(), self.stats)
 
-    def __init__(self, string):
-        self.table = [[[] for c in range(0, r)] for r in range(len(string), 0, -1)]
+    def parse_stream(self, source, progress=None):
+        """
+        Parse input from a path, an open file or an iterable of chunks
+        without reading it all into memory, using the compiled engine. If
+        `progress` is given it is called after each chunk with True if the
+        input so far is still a valid prefix. Invalid symbols are handled the
+        same way as in `parse`.
+        """
+        stream = self.stream()
+        for chunk in read_chunks(source):
+            valid_prefix = stream.feed(chunk)
+            if progress is not None:
+                progress(valid_prefix)
+        accepted = stream.close()
+        if stream.invalid:
+            print(self.error_invalid_symbol)
+            sys.exit(0)
+        return accepted
 
-    def __repr__(self):
-        return '\n'.join(reversed(["{i}: {stringified_row}".format(
-            i=i, stringified_row=[str(node) for node in row]) \
-            for i, row in enumerate(self.table)]))
+    def parse_state(self, string, interval=CHECKPOINT_INTERVAL):
+        """
+        Recognise a string of terminals with the compiled engine and return
+        an LL1ParseState that `reparse` can update after an edit. The stack
+        is saved every `interval` tokens.
+        """
+        if not self.is_valid(string):
+            return LL1ParseState(string, False, False, [], interval)
+        return self._resume(string, [], interval)
 
-    def __getitem__(self, rowcolumn):
-        row, column = rowcolumn
-        length = len(self.table)
-        if row < 0:
-            row += length
-        if column < 0:
-            column += length
-        if 0 <= row < length and 0 <= column < length - row:
-            return self.table[row][column]
-        raise IndexError("Index out of range: [{row}, {column}]".format(
-            row=row, column=column))
+    def reparse(self, state, offset, deleted, inserted):
+        """
+        Apply an edit to the string of an LL1ParseState: remove `deleted`
+        tokens at `offset` and put the tokens of `inserted` in their place
+        (see `apply_edit`). Returns a new LL1ParseState, equal to the one
+        `parse_state` gives for the edited string. Parsing resumes from the
+        last saved stack before the edit, and if the old string was rejected
+        before the edit the new one is rejected without parsing at all.
+        """
+        string, inserted = apply_edit(state.string, offset, deleted, inserted)
+        interval = state.interval
+        if not state.valid:
+            # the old string had an invalid symbol, which may have been deleted
+            return self.parse_state(string, interval)
+        if not self.is_valid(inserted):
+            return LL1ParseState(string, False, False, [], interval)
+        if state.rejected_at is not None and state.rejected_at < offset:
+            return LL1ParseState(string, True, False, state.checkpoints, interval,
+                                 state.rejected_at)
+        return self._resume(string, state.checkpoints[:offset // interval + 1],
+                            interval)
 
-    def __setitem__(self, rowcolumn, value):
-        row, column = rowcolumn
-        length = len(self.table)
-        if row < 0:
-            row += length
-        if column < 0:
-            column += length
-        if 0 <= row < length and 0 <= column < length - row:
-            self.table[row][column] = value
-            return
-        raise IndexError("Index out of range: [{row}, {column}]".format(
-            row=row, column=column))
+    def _resume(self, string, checkpoints, interval):
+        """
+        Run the compiled engine over a string from the last of a list of
+        checkpoints (or from the start if there are none), saving the stack
+        every `interval` tokens, and return the LL1ParseState
+        """
+        compiled = self.compile()
+        stream = LL1Stream(compiled)
+        checkpoints = list(checkpoints)
+        if checkpoints:
+            position, stack = checkpoints[-1]
+            stream.stack = list(stack) + [0] * max(len(stack), 64)
+            stream.top = len(stack)
+            stream.consumed = position
+        else:
+            position = 0
+            checkpoints.append((0, tuple(stream.stack[:stream.top])))
+        tokens = compiled.token_ids(string[position:])
+        if not isinstance(tokens, bytes):
+            tokens = list(tokens)
+        # checkpoints[k] is the stack after the first k * interval tokens
+        base = position
+        while position + interval <= len(string):
+            if not stream.advance(tokens[position - base:position - base + interval]):
+                break
+            position += interval
+            checkpoints.append((position, tuple(stream.stack[:stream.top])))
+        else:
+            stream.advance(tokens[position - base:])
+        accepted = stream.close()
+        rejected_at = stream.consumed if stream.rejected else None
+        return LL1ParseState(string, True, accepted, checkpoints, interval,
+                             rejected_at)
 
-class CYKNode:
+    @classmethod
+    def from_grammar(cls, grammar_file, cache_dir=CACHE_DIR, **kwargs):
+        """
+        Create an LL1Parser for the grammar in `grammar_file`, using the
+        cached parse table if the grammar has been compiled before.
+        """
+        table, terminals, start = load_ll1_table(grammar_file, cache_dir)
+        return cls(table=table, terminals=terminals, start=start, **kwargs)
+
+
+class LL1ParseState:
     """
-    A node of a binary search tree used to store information about the
-    production rule used to populate an entry of a CYKTable in order to
-    reconstruct a binary search tree from the table.
-    For nonterminal rules, the Node contains Ra at the root and the children
-    Rb, Rc from the right hand side
-    of the rule Ra -> Rb Rc. Rules of the form
-    Ra -> b used to construct terminal symbols will only have a left child.
+    The result of parsing a string with LL1Parser.parse_state or
+    LL1Parser.reparse. `valid` is False if the string contains a symbol that
+    is not a terminal, and `accepted` is True if the string is in the
+    language. `checkpoints[k]` is the position k * interval and the stack of
+    terminal and variable ids after that many tokens (bottom first), up to
+    where the string was rejected. `rejected_at` is the position of the token
+    that was rejected, or None if the string was accepted (or is invalid).
     """
 
-    def __init__(self, symbol, left=None, right=None):
-        self.symbol = symbol
-        self.left = left
-        self.right = right
+    def __init__(self, string, valid, accepted, checkpoints, interval,
+                 rejected_at=None):
+        self.string = string
+        self.valid = valid
+        self.accepted = accepted
+        self.checkpoints = checkpoints
+        self.interval = interval
+        self.rejected_at = rejected_at
 
-    def __repr__(self):
-        return "{symbol}".format(symbol=self.symbol)
 
-    def get_symbol(self):
-        """Get the symbol at the root of this node"""
-        return self.symbol
+class CompiledLL1Table:
+    """
+    An LL(1) parse table in which every terminal and variable is interned
+    to a small integer. Terminals (including the end marker) are numbered
+    from 0, and variables are numbered after them, so a symbol is a variable
+    if its id is at least `num_terminals`. The table is a flat list indexed
+    by (variable - num_terminals) * num_terminals + terminal, holding the
+    index of a production in `productions` or -1 for a blank entry. Each
+    production is stored reversed, so it can be pushed onto the stack with a
+    single slice assignment.
+    """
 
-    def get_left(self):
-        """Get the left part of the right hand side of the rule"""
-        return self.left
+    def __init__(self, table, terminals, start=START, end=END):
+        self.symbols = [end] + sorted(set(terminals) - set([end]))
+        self.num_terminals = len(self.symbols)
+        self.symbols.extend(sorted(table))
+        self.ids = {symbol: index for index, symbol in enumerate(self.symbols)}
+        self.end_id = self.ids[end]
+        self.start_id = self.ids[start]
+        self.productions = []
+        production_ids = {}
+        self.table = [-1] * (len(table) * self.num_terminals)
+        for variable, row in table.items():
+            offset = (self.ids[variable] - self.num_terminals) * self.num_terminals
+            for token, entry in row.items():
+                rhs = tuple(self.ids[symbol] for symbol in reversed(list(entry)))
+                if rhs not in production_ids:
+                    production_ids[rhs] = len(self.productions)
+                    self.productions.append(rhs)
+                self.table[offset + self.ids[token]] = production_ids[rhs]
+        # maps the bytes of single character ASCII terminals to their ids
+        self.byte_ids = None
+        if self.num_terminals < 256 and input_table(self.symbols[:self.num_terminals]):
+            byte_ids = bytearray(256)
+            for symbol in self.symbols[:self.num_terminals]:
+                byte_ids[ord(symbol)] = self.ids[symbol]
+            self.byte_ids = bytes(byte_ids)
 
-    def get_right(self):
-        """Get the right part of the right hand side of the rule"""
-        return self.right
+    def token_ids(self, string):
+        """
+        Return an iterator over the terminal ids of the symbols in string.
+        Every symbol must be a terminal. An ASCII string of single character
+        terminals is mapped in one bytes.translate.
+        """
+        if self.byte_ids is not None and isinstance(string, str) and string.isascii():
+            return string.encode('ascii').translate(self.byte_ids)
+        return map(self.ids.__getitem__, string)
 
-    def is_unit_rule(self):
-        """Return True if the current node represents a unit production rule"""
-        return self.left is not None and self.right is None
+    def recognise(self, string, stats=None):
+        """
+        Return True if the string of terminals is in the language, using the
+        same algorithm as LL1Parser.parse on an integer stack
+        """
+        return self.run(self.token_ids(string), stats)
 
-    def is_terminal(self):
-        """Return True if the current node represents a terminal symbol"""
-        return self.left is None and self.right is None
+    def run(self, tokens, stats=None):
+        """
+        Run the LL(1) algorithm over an iterable of terminal ids (without the
+        end marker) and return True if it is accepted. Steps are counted in
+        `stats`, if it is given (see ParseStats).
+        """
+        stream = LL1Stream(self, stats)
+        stream.advance(tokens)
+        return stream.close()
 
-class CYKParser:
+
+class LL1Stream:
     """
-    The CYKParser expects a grammar file, from which it constructs the lists
-    of rules that will be used to parse a string. Each rule in the grammar file
-    consist of a token on the left hand side and a list of one terminal
-    token or two variable tokens on the right hand side separated by spaces.
-    The tokens may be more than one character long, since a grammar might
-    include more variables than the number of uppercase letters.
+    Incremental LL(1) parsing with a CompiledLL1Table. Input is fed in chunks
+    with `feed`, which strips whitespace, runs the LL(1) loop over the tokens
+    in the chunk and returns whether the input read so far is still a prefix
+    of some string in the language. Only the stack is kept between chunks, so
+    memory does not grow with the length of the input. `close` feeds the end
+    marker and returns True if the whole input was accepted.
 
-    The method `parse` is used to parse an input string, and prints the tree
-    generated by the string for unambiguous grammars. The method `recognise`
-    merely recognises the string, and prints the parse table generated while
-    recognising the string.
+    As with LL1Parser.parse, a symbol that is not a terminal makes the input
+    invalid even if it was already rejected, so chunks are still checked
+    after a rejection.
 
-    This parser does not handle ambigous grammars.
+    With a ParseStats, tokens are parsed by a copy of the loop that also
+    counts steps, table lookups, matches and the largest stack, so the
+    loop without it does no extra work.
     """
 
-    def __init__(self, grammar_file, error_invalid_symbol=ERROR_INVALID_SYMBOL):
-        self.rules = None
-        self.unit_productions = defaultdict(list)
-        self.nonterminal_rules = []
-        self.error_invalid_symbol = error_invalid_symbol
-        self.start_symbol = None
-        # add the rules from the grammar to terminal and variable rules
-        self._read_grammar(grammar_file)
+    def __init__(self, compiled, stats=None):
+        self.compiled = compiled
+        self.stats = stats
+        self.terminals = set(compiled.symbols[:compiled.num_terminals]) - \
+            set([compiled.symbols[compiled.end_id]])
+        # the stack is a preallocated list of ids; `top` is the number of
+        # symbols on it, so stack[top-1] is the top of the stack
+        self.stack = [0] * 64
+        self.stack[0] = compiled.end_id
+        self.stack[1] = compiled.start_id
+        self.top = 2
+        self.consumed = 0
+        self.rejected = False
+        self.invalid = False
+        self.accepted = False
 
-    def is_valid(self, string):
+    def feed(self, chunk):
         """
-        Returns True if all tokens in the string are terminals from the
-        grammar
+        Strip whitespace from a chunk of input and parse it. Returns True if
+        the input so far is a valid prefix.
         """
-        for token in string:
-            if not token in self.unit_productions:
-                return False
-        return True
+        chunk = WHITESPACE.sub('', chunk)
+        if not self.invalid and not set(chunk).issubset(self.terminals):
+            self.invalid = True
+        if self.invalid or self.rejected:
+            return False
+        return self.advance(self.compiled.token_ids(chunk))
 
-    def _read_grammar(self, grammar_file):
+    def advance(self, tokens):
         """
-        Reads a grammar file and appends the rules to the list of
-        terminal and nonterminal rules in the grammar. The start symbol
-        must be the LHS of the first rule in the file.
+        Run the LL(1) loop over an iterable of terminal ids and return True if
+        the input so far is a valid prefix
         """
-        grammar_rhs = lambda rule: rule.strip().split('->')[1].strip()
-        grammar_lhs = lambda rule: rule.strip().split('->')[0].strip()
-        with open(grammar_file) as file:
-            lines = file.readlines()
-        self.start_symbol = grammar_lhs(lines[0])
-        for line in lines:
-            # Get and check the LHS of the rule
-            lhs = grammar_lhs(line)
-            if len(grammar_lhs(line).split(' ')) != 1:
-                raise CNFError(line)
-            # Get the RHSes for this LHS
-            multirule_rhs = [rule.strip().split(' ') for rule in grammar_rhs(line).split('|')]
-            for rule in multirule_rhs:
-                if len(rule) == 1:
-                    self.unit_productions[rule[0]].append(lhs)
-                elif len(rule) == 2:
-                    self.nonterminal_rules.append((lhs, rule))
+        if self.rejected:
+            return False
+        if self.stats is not None:
+            return self._advance_counted(tokens)
+        table = self.compiled.table
+        productions = self.compiled.productions
+        num_terminals = self.compiled.num_terminals
+        stack = self.stack
+        capacity = len(stack)
+        top = self.top
+        consumed = self.consumed
+        for token in tokens:
+            # expand variables on top of the stack until a terminal is on top,
+            # then match it against the token
+            while True:
+                symbol = stack[top-1]
+                if symbol >= num_terminals:
+                    production = table[(symbol - num_terminals) * num_terminals + token]
+                    if production < 0:
+                        break
+                    rhs = productions[production]
+                    top -= 1
+                    new_top = top + len(rhs)
+                    while new_top > capacity:
+                        stack.extend([0] * capacity)
+                        capacity *= 2
+                    stack[top:new_top] = rhs
+                    top = new_top
+                elif symbol == token:
+                    top -= 1
+                    consumed += 1
+                    break
                 else:
-                    raise CNFError("{lhs} -> {rule}".format(lhs=lhs, rule=rule))
+                    break
+            if symbol != token:
+                self.rejected = True
+                break
+            if not top:
+                # the end marker was matched, so nothing more can be read
+                self.accepted = True
+        self.top = top
+        self.consumed = consumed
+        return not self.rejected
 
-    def read_input(self, path):
-        """Read and strip all whitespace from input"""
-        with open(path) as file:
-            string = ''.join([re.sub(r'\s+', '', line) for line in file.readlines()])
-        return string
+    def _advance_counted(self, tokens):
+        """`advance`, counting each step in the stream's stats"""
+        table = self.compiled.table
+        productions = self.compiled.productions
+        num_terminals = self.compiled.num_terminals
+        stack = self.stack
+        capacity = len(stack)
+        top = self.top
+        consumed = self.consumed
+        steps = lookups = 0
+        max_stack = top
+        for token in tokens:
+            while True:
+                steps += 1
+                symbol = stack[top-1]
+                if symbol >= num_terminals:
+                    lookups += 1
+                    production = table[(symbol - num_terminals) * num_terminals + token]
+                    if production < 0:
+                        break
+                    rhs = productions[production]
+                    top -= 1
+                    new_top = top + len(rhs)
+                    while new_top > capacity:
+                        stack.extend([0] * capacity)
+                        capacity *= 2
+                    stack[top:new_top] = rhs
+                    top = new_top
+                    if top > max_stack:
+                        max_stack = top
+                elif symbol == token:
+                    top -= 1
+                    consumed += 1
+                    break
+                else:
+                    break
+            if symbol != token:
+                self.rejected = True
+                break
+            if not top:
+                self.accepted = True
+        stats = self.stats
+        stats.add('steps', steps)
+        stats.add('lookups', lookups)
+        stats.add('matches', consumed - self.consumed)
+        stats.maximum('max_stack', max_stack)
+        self.top = top
+        self.consumed = consumed
+        return not self.rejected
 
-    def _generate_tree(self, node):
-        """Print the tree with node at the root"""
-        if node.is_terminal():
-            return node.get_symbol()
-        if node.is_unit_rule():
-            return [node.get_symbol(),
-                    self._generate_tree(node.get_left()),
-                    None]
-        return [node.get_symbol(),
-                self._generate_tree(node.get_left()),
-                self._generate_tree(node.get_right())]
+    def close(self):
+        """Feed the end marker and return True if the input is accepted"""
+        if not self.invalid and not self.accepted:
+            self.advance((self.compiled.end_id,))
+        return self.accepted and not self.invalid
 
-    def recognise(self, infile):
-        """
-        Print the parse table and returns True if a string is in the language,
-        otherwise return False
-        """
-        string = self.read_input(infile)
-        table = CYKTable(string)
-        # Fill the first row of the matrix with the variables
-        # that could have created the terminal at that position
-        # in the string. All the terminals are stored in the
-        # dictionary `unit_productions` along with the list of
-        # terminals that could create them, so just add this
-        # list to the table.
-        len_string = len(string)
-        for start in range(0, len_string):
-            try:
-                table[0, start] = table[0, start] = self.unit_productions[string[start]]
-            # Reject the string if it contains a symbol for which there is no unit production
-            except KeyError:
-                return False
-        # Find the rules that could have generated each substring
-        # and add them to the table.
-        for length in range(2, len_string+1): # length of span
-            for start in range(0, len_string-length+1): # start of span
-                for partition in range(1, length-1+1): # partition of span
-                    for lhs, rhs in self.nonterminal_rules:
-                        if rhs[0] in table[partition-1, start] and \
+
+def read_chunks(source, size=None):
+    """
+    Return an iterable of chunks of text from `source`, which may be a path,
+    an open file or any other iterable of strings
+    """
+    if size is None:
+        size = CHUNK_SIZE
+    if isinstance(source, str):
+        return _read_file_chunks(source, size)
+    if hasattr(source, 'read'):
+        return iter(lambda: source.read(size), '')
+    return source
+
+
+def _read_file_chunks(path, size):
+    """Yield chunks of at most `size` characters from the file at `path`"""
+    with open(path) as file:
+        for chunk in iter(lambda: file.read(size), ''):
+            yield chunk
+
+
+# ASCII whitespace, removed from input at the bytes level
+WHITESPACE_BYTES = b' \t\n\r\x0b\x0c'
+
+
+def read_bytes(path):
+    """
+    Return the raw bytes of an input file, or of stdin for '-', read in one
+    call. The parsers work on one string of the whole input, so reading it
+    in one call is the only copy made before it is stripped.
+    """
+    if path == '-':
+        return sys.stdin.buffer.read()
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+def read_text(path):
+    """Read a whole input file (or stdin for '-') as UTF-8 text"""
+    return read_bytes(path).decode('utf-8')
+
+
+def input_table(terminals):
+    """
+    Return a bytes.translate table that keeps the bytes of single character
+    ASCII terminals and maps every other byte to 0, or None if some terminal
+    is not a single ASCII character (other than NUL)
+    """
+    table = bytearray(256)
+    for terminal in terminals:
+        if len(terminal) != 1 or not 0 < ord(terminal) < 128:
+            return None
+        table[ord(terminal)] = ord(terminal)
+    return bytes(table)
+
+
+def read_input(path, terminals=None):
+    """
+    Read an input file (or stdin for '-') with all whitespace removed and
+    return (string, valid), where valid is True if every symbol is in
+    `terminals`, or None if no terminals are given. The file is read as
+    bytes (see read_bytes) and an ASCII input is stripped with a single
+    bytes.translate, which also maps every symbol that is not a terminal to
+    NUL, so that it is validated in the same pass. Other input is decoded as
+    UTF-8 and stripped with WHITESPACE.
+    """
+    data = read_bytes(path)
+    if not data.isascii():
+        string = WHITESPACE.sub('', data.decode('utf-8'))
+        valid = None if terminals is None else set(string).issubset(terminals)
+        return string, valid
+    table = None if terminals is None else input_table(terminals)
+    stripped = data.translate(table, WHITESPACE_BYTES)
+    if terminals is None:
+        return stripped.decode('ascii'), None
+    if table is None:
+        string = stripped.decode('ascii')
+        return string, set(string).issubset(terminals)
+    if 0 in stripped:
+        # strip again, keeping the symbols that are not terminals
+        return data.translate(None, WHITESPACE_BYTES).decode('ascii'), False
+    return stripped.decode('ascii'), True
+
+
+def apply_edit(string, offset, deleted, inserted):
+    """
+    Remove `deleted` symbols from a string at `offset` and put the symbols of
+    `inserted` in their place. Offsets count symbols of the string with its
+    whitespace already stripped, and whitespace is stripped from `inserted`
+    if it is a str. Returns the edited string and the inserted symbols.
+    """
+    if offset < 0 or deleted < 0 or offset + deleted > len(string):
+        raise IndexError("Edit out of range: offset {offset}, deleted {deleted}, "
+                         "length {length}".format(offset=offset, deleted=deleted,
+                                                  length=len(string)))
+    if isinstance(inserted, str):
+        inserted = WHITESPACE.sub('', inserted)
+    return string[:offset] + inserted + string[offset+deleted:], inserted
+
+
+class TokenSpecError(Exception):
+    """An error that is raised if a pattern in a token spec cannot be read"""
+    def __init__(self, pattern):
+        self.pattern = pattern
+
+    def __str__(self):
+        return "Malformed token pattern ({pattern})".format(pattern=self.pattern)
+
+
+class LexError(Exception):
+    """An error that is raised if no token matches the input at an offset"""
+    def __init__(self, offset, text):
+        self.offset = offset
+        self.text = text
+
+    def __str__(self):
+        return "No token matches {text!r} at offset {offset}".format(
+            text=self.text, offset=self.offset)
+
+
+# the character classes that can be escaped in a token pattern
+PATTERN_CLASSES = {
+    's': ' \t\n\r\f\v',
+    'd': '0123456789',
+    'w': 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_',
+}
+PATTERN_ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', 'f': '\f', 'v': '\v'}
+
+
+def read_pattern(pattern):
+    """
+    Read a token pattern into a tree of nodes: ('chars', chars, negated)
+    matches one character that is (or with negated, is not) in chars,
+    ('cat', nodes) and ('alt', nodes) match a sequence or one of the nodes,
+    and ('star', node), ('plus', node) and ('opt', node) repeat a node. The
+    syntax is a small part of Python's: literals, escapes, ., [] classes with
+    ranges and ^, (), |, *, + and ?.
+    """
+    position = [0]
+
+    def peek():
+        return pattern[position[0]] if position[0] < len(pattern) else None
+
+    def take():
+        if position[0] >= len(pattern):
+            raise TokenSpecError(pattern)
+        position[0] += 1
+        return pattern[position[0]-1]
+
+    def escape():
+        char = take()
+        if char in PATTERN_CLASSES:
+            return PATTERN_CLASSES[char]
+        return PATTERN_ESCAPES.get(char, char)
+
+    def alternation():
+        nodes = [sequence()]
+        while peek() == '|':
+            take()
+            nodes.append(sequence())
+        return nodes[0] if len(nodes) == 1 else ('alt', nodes)
+
+    def sequence():
+        nodes = []
+        while peek() is not None and peek() not in '|)':
+            nodes.append(repeat())
+        return nodes[0] if len(nodes) == 1 else ('cat', nodes)
+
+    def repeat():
+        node = atom()
+        while peek() is not None and peek() in '*+?':
+            node = ({'*': 'star', '+': 'plus', '?': 'opt'}[take()], node)
+        return node
+
+    def atom():
+        char = take()
+        if char == '(':
+            node = alternation()
+            if take() != ')':
+                raise TokenSpecError(pattern)
+            return node
+        if char == '[':
+            negated = peek() == '^'
+            if negated:
+                take()
+            chars = set()
+            while peek() != ']':
+                char = take()
+                first = escape() if char == '\\' else char
+                if peek() == '-' and position[0] + 1 < len(pattern) and \
+                    pattern[position[0]+1] != ']':
+                    take()
+                    last = take()
+                    last = escape() if last == '\\' else last
+                    chars.update(chr(code) for code in range(ord(first), ord(last) + 1))
+                else:
+                    chars.update(first)
+            take()
+            return ('chars', frozenset(chars), negated)
+        if char == '.':
+            return ('chars', frozenset('\n'), True)
+        if char == '\\':
+            return ('chars', frozenset(escape()), False)
+        if char in '*+?|)':
+            raise TokenSpecError(pattern)
+        return ('chars', frozenset(char), False)
+
+    node = alternation()
+    if position[0] != len(pattern):
+        raise TokenSpecError(pattern)
+    return node
+
+
+class Lexer:
+    """
+    A lexer built from a token spec, a list of (name, pattern) pairs (see
+    read_pattern), which is compiled to a single DFA. The input is split
+    into the longest token that matches at each offset, and where patterns
+    match the same text the first in the spec wins. Tokens named `skip`
+    (SKIP by default) are matched but not emitted, e.g. for whitespace.
+    Several patterns may share a name.
+
+    Token ids are indexes into `names`, and `tokenize` returns them as an
+    array('i'). The DFA works on classes of characters that no pattern
+    tells apart: `classes` maps each character used in a pattern to its
+    class, every other character is in class 0, and `table` is a flat list
+    indexed by state * num_classes + class. State 0 is the dead state, and
+    `accepts` holds the token id each state accepts, or -1.
+    """
+
+    SKIP = '_'
+
+    def __init__(self, spec, skip=SKIP):
+        self.names = []
+        token_ids = []
+        for name, _ in spec:
+            if name != skip and name not in self.names:
+                self.names.append(name)
+            token_ids.append(self.names.index(name) if name != skip else -1)
+        self.ids = {name: index for index, name in enumerate(self.names)}
+        self.skip_id = len(self.names)
+        # Thompson's construction: each NFA state has a list of (charset,
+        # target) edges, where the charset is None for an empty move
+        edges = []
+        charsets = []
+        charset_ids = {}
+
+        def new_state():
+            edges.append([])
+            return len(edges) - 1
+
+        def fragment(node):
+            kind = node[0]
+            start, end = new_state(), new_state()
+            if kind == 'chars':
+                key = (node[1], node[2])
+                if key not in charset_ids:
+                    charset_ids[key] = len(charsets)
+                    charsets.append(key)
+                edges[start].append((charset_ids[key], end))
+            elif kind == 'cat':
+                previous = start
+                for child in node[1]:
+                    first, last = fragment(child)
+                    edges[previous].append((None, first))
+                    previous = last
+                edges[previous].append((None, end))
+            elif kind == 'alt':
+                for child in node[1]:
+                    first, last = fragment(child)
+                    edges[start].append((None, first))
+                    edges[last].append((None, end))
+            else:
+                first, last = fragment(node[1])
+                edges[start].append((None, first))
+                edges[last].append((None, end))
+                if kind in ('star', 'opt'):
+                    edges[start].append((None, end))
+                if kind in ('star', 'plus'):
+                    edges[last].append((None, first))
+            return start, end
+
+        nfa_start = new_state()
+        # the index in the spec of the pattern each final NFA state accepts
+        nfa_accepts = {}
+        for index, (name, pattern) in enumerate(spec):
+            first, last = fragment(read_pattern(pattern))
+            edges[nfa_start].append((None, first))
+            nfa_accepts[last] = index
+        # group characters by the charsets they are in
+        explicit = sorted(set(char for chars, _ in charsets for char in chars))
+        signatures = {tuple(negated for _, negated in charsets): 0}
+        self.classes = {}
+        for char in explicit:
+            signature = tuple((char in chars) != negated for chars, negated in charsets)
+            self.classes[char] = signatures.setdefault(signature, len(signatures))
+        self.num_classes = len(signatures)
+        matches = [None] * self.num_classes
+        for signature, number in signatures.items():
+            matches[number] = signature
+
+        def closure(states):
+            result = set(states)
+            pending = list(states)
+            while pending:
+                for charset, target in edges[pending.pop()]:
+                    if charset is None and target not in result:
+                        result.add(target)
+                        pending.append(target)
+            return frozenset(result)
+
+        # subset construction, with the dead state first
+        dfa_states = [frozenset(), closure([nfa_start])]
+        numbers = {dfa_states[0]: 0, dfa_states[1]: 1}
+        self.table = []
+        state = 0
+        while state < len(dfa_states):
+            for number in range(self.num_classes):
+                moved = set(target for nfa_state in dfa_states[state] \
+                            for charset, target in edges[nfa_state] \
+                            if charset is not None and matches[number][charset])
+                target = closure(moved) if moved else dfa_states[0]
+                if target not in numbers:
+                    numbers[target] = len(dfa_states)
+                    dfa_states.append(target)
+                self.table.append(numbers[target])
+            state += 1
+        # each DFA state accepts the token of the first pattern in the spec
+        # that any of its NFA states accepts
+        self.accepts = []
+        for nfa_states in dfa_states:
+            accepted = [nfa_accepts[nfa_state] for nfa_state in nfa_states \
+                        if nfa_state in nfa_accepts]
+            if not accepted:
+                self.accepts.append(-1)
+                continue
+            token_id = token_ids[min(accepted)]
+            self.accepts.append(token_id if token_id >= 0 else self.skip_id)
+        if self.accepts[1] != -1:
+            raise TokenSpecError("a token matches the empty string")
+
+    @classmethod
+    def from_file(cls, spec_file, **kwargs):
+        """
+        Create a Lexer from a token spec file, with one `name pattern` pair
+        per line. Blank lines and lines starting with # are ignored.
+        """
+        spec = []
+        with open(spec_file) as file:
+            for line in file:
+                if not line.strip() or line.lstrip().startswith('#'):
+                    continue
+                fields = line.split(None, 1)
+                if len(fields) != 2:
+                    raise TokenSpecError(line.strip())
+                spec.append((fields[0], fields[1].strip()))
+        return cls(spec, **kwargs)
+
+    def tokenize(self, text):
+        """
+        Return the ids of the tokens in text as an array('i'), raising a
+        LexError if no token matches at some offset
+        """
+        table, accepts, classes = self.table, self.accepts, self.classes
+        num_classes, skip_id = self.num_classes, self.skip_id
+        tokens = array('i')
+        length = len(text)
+        position = 0
+        while position < length:
+            state = 1
+            token = -1
+            end = position
+            index = position
+            while index < length:
+                state = table[state * num_classes + classes.get(text[index], 0)]
+                if not state:
+                    break
+                index += 1
+                if accepts[state] >= 0:
+                    token = accepts[state]
+                    end = index
+            if token < 0:
+                raise LexError(position, text[position:position+10])
+            if token != skip_id:
+                tokens.append(token)
+            position = end
+        return tokens
+
+    def symbols(self, tokens):
+        """Return the names of a sequence of token ids"""
+        names = self.names
+        return [names[token] for token in tokens]
+
+
+def check_tokens(parser, lexer, text):
+    """
+    Split text into tokens with a Lexer and return ACCEPTED, REJECTED or the
+    parser's invalid symbol error. The parser's terminals are the names of
+    the tokens, and it is given the token ids (see `recognise_tokens`).
+    """
+    try:
+        tokens = lexer.tokenize(text)
+    except LexError:
+        return parser.error_invalid_symbol
+    if not parser.is_valid(lexer.symbols(tokens)):
+        return parser.error_invalid_symbol
+    return ACCEPTED if parser.recognise_tokens(tokens, lexer) else REJECTED
+
+
+def read_grammar(grammar_file):
+    """
+    Read a grammar file in the format used by the CYKParser and return the
+    start symbol (the LHS of the first rule) and a list of (lhs, rhs) rules,
+    where rhs is a tuple of symbols. Alternatives are separated by '|', and an
+    empty alternative or EPSILON_SYMBOL is the empty string.
+    """
+    rules = []
+    start_symbol = None
+    with open(grammar_file) as file:
+        lines = [line for line in file.readlines() if line.strip()]
+    for line in lines:
+        if '->' not in line:
+            raise GrammarError(line.strip())
+        lhs, rhs = line.split('->', 1)
+        lhs = lhs.strip()
+        if len(lhs.split()) != 1:
+            raise GrammarError(line.strip())
+        if start_symbol is None:
+            start_symbol = lhs
+        for alternative in rhs.split('|'):
+            rules.append((lhs, tuple(symbol for symbol in alternative.split() \
+                                     if symbol != EPSILON_SYMBOL)))
+    return start_symbol, rules
+
+
+class GrammarError(Exception):
+    """An error that is raised if a rule in a grammar file cannot be read"""
+    def __init__(self, rule):
+        self.rule = rule
+
+    def __str__(self):
+        return "Malformed grammar rule ({rule})".format(rule=self.rule)
+
+
+class LL1ConflictError(Exception):
+    """An error that is raised if a grammar is not LL(1)"""
+    def __init__(self, conflicts):
+        self.conflicts = conflicts
+
+    def __str__(self):
+        return "Grammar is not LL(1) ({conflicts})".format(
+            conflicts='; '.join(
+                "M[{variable},{token}]: {entries}".format(
+                    variable=variable, token=token,
+                    entries=' / '.join(' '.join(entry) or EPSILON_SYMBOL \
+                                       for entry in entries))
+                for variable, token, entries in self.conflicts))
+
+
+class LL1Grammar:
+    """
+    A context free grammar read from a grammar file, from which an LL(1)
+    parse table is generated. Variables are the symbols that appear on the
+    left hand side of a rule; every other symbol is a terminal. Because the
+    input is read one character at a time, terminals should be single
+    characters.
+
+    The table has the same shape as LL1TABLE, except that each entry is a
+    tuple of symbols rather than a string, so that symbols may be longer than
+    one character.
+    """
+
+    def __init__(self, grammar_file, end=END):
+        self.start, self.rules = read_grammar(grammar_file)
+        self.end = end
+        self.variables = set(lhs for lhs, _ in self.rules)
+        self.terminals = set(symbol for _, rhs in self.rules for symbol in rhs \
+                             if symbol not in self.variables)
+
+    def nullable(self):
+        """Return the set of variables that can derive the empty string"""
+        nullable = set()
+        changed = True
+        while changed:
+            changed = False
+            for lhs, rhs in self.rules:
+                if lhs not in nullable and all(symbol in nullable for symbol in rhs):
+                    nullable.add(lhs)
+                    changed = True
+        return nullable
+
+    def first_sets(self, nullable=None):
+        """Return a dictionary mapping each variable to its FIRST set"""
+        if nullable is None:
+            nullable = self.nullable()
+        first = {variable: set() for variable in self.variables}
+        changed = True
+        while changed:
+            changed = False
+            for lhs, rhs in self.rules:
+                before = len(first[lhs])
+                first[lhs] |= self.first_of(rhs, first, nullable)
+                changed = changed or len(first[lhs]) != before
+        return first
+
+    def first_of(self, symbols, first, nullable):
+        """
+        Return the FIRST set of a sequence of symbols. The empty string is
+        not included; use `nullable` to check whether the sequence is nullable.
+        """
+        result = set()
+        for symbol in symbols:
+            if symbol not in self.variables:
+                result.add(symbol)
+                break
+            result |= first[symbol]
+            if symbol not in nullable:
+                break
+        return result
+
+    def follow_sets(self, first=None, nullable=None):
+        """Return a dictionary mapping each variable to its FOLLOW set"""
+        if nullable is None:
+            nullable = self.nullable()
+        if first is None:
+            first = self.first_sets(nullable)
+        follow = {variable: set() for variable in self.variables}
+        follow[self.start].add(self.end)
+        changed = True
+        while changed:
+            changed = False
+            for lhs, rhs in self.rules:
+                for index, symbol in enumerate(rhs):
+                    if symbol not in self.variables:
+                        continue
+                    before = len(follow[symbol])
+                    rest = rhs[index+1:]
+                    follow[symbol] |= self.first_of(rest, first, nullable)
+                    if all(other in nullable for other in rest):
+                        follow[symbol] |= follow[lhs]
+                    changed = changed or len(follow[symbol]) != before
+        return follow
+
+    def build_table(self):
+        """
+        Build the LL(1) parse table. Returns the table and a list of
+        (variable, terminal, entries) conflicts, which is empty if the grammar
+        is LL(1).
+        """
+        nullable = self.nullable()
+        first = self.first_sets(nullable)
+        follow = self.follow_sets(first, nullable)
+        table = {variable: {} for variable in self.variables}
+        clashes = defaultdict(list)
+        for lhs, rhs in self.rules:
+            lookahead = self.first_of(rhs, first, nullable)
+            if all(symbol in nullable for symbol in rhs):
+                lookahead |= follow[lhs]
+            for token in lookahead:
+                if token in table[lhs] and table[lhs][token] != rhs:
+                    if not clashes[lhs, token]:
+                        clashes[lhs, token].append(table[lhs][token])
+                    clashes[lhs, token].append(rhs)
+                else:
+                    table[lhs][token] = rhs
+        conflicts = sorted((variable, token, entries) \
+                           for (variable, token), entries in clashes.items())
+        return table, conflicts
+
+    def compile(self):
+        """
+        Return the (table, terminals, start) used to initialise an
+        LL1Parser, raising an LL1ConflictError if the grammar is not LL(1)
+        """
+        table, conflicts = self.build_table()
+        if conflicts:
+            raise LL1ConflictError(conflicts)
+        return table, self.terminals, self.start
+
+
+def grammar_hash(grammar_file, version):
+    """Return a hash of the contents of a grammar file and a cache version"""
+    digest = hashlib.sha256("v{version}\n".format(version=version).encode())
+    with open(grammar_file, 'rb') as file:
+        digest.update(file.read())
+    return digest.hexdigest()
+
+
+def temporary_path(path):
+    """
+    Return the name of a temporary file to write before replacing `path`,
+    unique to this process and thread, so that concurrent writers of the
+    same cache file never write to the same temporary file
+    """
+    return "{path}.{pid}.{thread}.tmp".format(path=path, pid=os.getpid(),
+                                              thread=threading.get_ident())
+
+
+def load_ll1_table(grammar_file, cache_dir=CACHE_DIR):
+    """
+    Return the (table, terminals, start) for a grammar file. The compiled
+    table is read from `cache_dir` if this grammar has been compiled before,
+    otherwise it is generated and saved there. Pass cache_dir=None to always
+    generate the table.
+    """
+    if cache_dir is None:
+        return LL1Grammar(grammar_file).compile()
+    path = os.path.join(cache_dir, "{digest}.ll1.json".format(
+        digest=grammar_hash(grammar_file, LL1_CACHE_VERSION)))
+    try:
+        with open(path) as file:
+            cached = json.load(file)
+        table = {variable: {token: tuple(entry) for token, entry in row.items()} \
+                 for variable, row in cached['table'].items()}
+        return table, set(cached['terminals']), cached['start']
+    except (OSError, ValueError, KeyError):
+        pass
+    table, terminals, start = LL1Grammar(grammar_file).compile()
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first so that concurrent readers never see
+    # a partially written table
+    temporary = temporary_path(path)
+    with open(temporary, 'w') as file:
+        json.dump({'start': start, 'terminals': sorted(terminals),
+                   'table': {variable: {token: list(entry) \
+                                        for token, entry in row.items()} \
+                             for variable, row in table.items()}}, file)
+    os.replace(temporary, path)
+    return table, terminals, start
+
+
+class LALR1ConflictError(Exception):
+    """
+    An error that is raised if a grammar is not LALR(1). Reductions are
+    shown as their rule if the rules of the grammar are given.
+    """
+    def __init__(self, conflicts, rules=None):
+        self.conflicts = conflicts
+        self.rules = rules
+
+    def describe(self, kind, target):
+        """Return a conflicting ACTION entry as text"""
+        if kind == 'reduce' and self.rules is not None:
+            lhs, rhs = self.rules[target]
+            return "reduce {lhs} -> {rhs}".format(
+                lhs=lhs, rhs=' '.join(rhs) or EPSILON_SYMBOL)
+        return "{kind} {target}".format(kind=kind, target=target)
+
+    def __str__(self):
+        return "Grammar is not LALR(1) ({conflicts})".format(
+            conflicts='; '.join(
+                "ACTION[{state},{token}]: {entries}".format(
+                    state=state, token=token,
+                    entries=' / '.join(self.describe(kind, target) \
+                                       for kind, target in entries))
+                for state, token, entries in self.conflicts))
+
+
+class LALR1Grammar(LL1Grammar):
+    """
+    A context free grammar read from a grammar file, from which LALR(1)
+    ACTION and GOTO tables are generated. The grammar is augmented with a
+    new start rule, rule 0, so rule r of the file is rule r + 1 of `rules`.
+
+    The LR(0) states are built first, and their lookaheads are then found
+    by working out which are generated spontaneously and which propagate
+    from one kernel item to another, as in the Dragon Book. Each entry of
+    ACTION is ('shift', state), ('reduce', rule) or ('accept', 0).
+    """
+
+    def __init__(self, grammar_file, end=END):
+        super().__init__(grammar_file, end)
+        start = self.start + "'"
+        while start in self.variables or start in self.terminals:
+            start += "'"
+        self.rules = [(start, (self.start,))] + self.rules
+        self.variables.add(start)
+        self.rules_of = defaultdict(list)
+        for index, (lhs, _) in enumerate(self.rules):
+            self.rules_of[lhs].append(index)
+
+    def closure(self, kernel, first, nullable):
+        """
+        Return the LR(1) closure of a dictionary mapping (rule, dot) items to
+        sets of lookaheads, as a dictionary of the same kind. With empty sets
+        of lookaheads, this is the LR(0) closure.
+        """
+        items = dict((item, set(lookaheads)) for item, lookaheads in kernel.items())
+        pending = list(items)
+        while pending:
+            rule, dot = pending.pop()
+            rhs = self.rules[rule][1]
+            if dot >= len(rhs) or rhs[dot] not in self.variables:
+                continue
+            rest = rhs[dot+1:]
+            lookaheads = self.first_of(rest, first, nullable)
+            if all(symbol in nullable for symbol in rest):
+                lookaheads |= items[rule, dot]
+            for predicted in self.rules_of[rhs[dot]]:
+                item = (predicted, 0)
+                if item not in items:
+                    items[item] = set(lookaheads)
+                    pending.append(item)
+                elif not lookaheads <= items[item]:
+                    items[item] |= lookaheads
+                    pending.append(item)
+        return items
+
+    def states(self, first, nullable):
+        """
+        Return the kernels of the LR(0) states, as sorted tuples of items,
+        and a dictionary mapping (state, symbol) to the state it goes to
+        """
+        kernels = [((0, 0),)]
+        numbers = {kernels[0]: 0}
+        transitions = {}
+        state = 0
+        # kernels grows as new states are found
+        while state < len(kernels):
+            kernel = kernels[state]
+            moves = {}
+            for rule, dot in self.closure(dict((item, ()) for item in kernel),
+                                          first, nullable):
+                rhs = self.rules[rule][1]
+                if dot < len(rhs):
+                    moves.setdefault(rhs[dot], []).append((rule, dot + 1))
+            for symbol, items in moves.items():
+                target = tuple(sorted(items))
+                if target not in numbers:
+                    numbers[target] = len(kernels)
+                    kernels.append(target)
+                transitions[state, symbol] = numbers[target]
+            state += 1
+        return kernels, transitions
+
+    def lookaheads(self, kernels, transitions, first, nullable):
+        """
+        Return a dictionary mapping each (state, kernel item) to its set of
+        LALR(1) lookaheads
+        """
+        # stands for the lookaheads of the kernel item being closed
+        propagated = object()
+        lookaheads = dict(((state, item), set()) \
+                          for state, kernel in enumerate(kernels) for item in kernel)
+        lookaheads[0, (0, 0)].add(self.end)
+        propagates = defaultdict(list)
+        for state, kernel in enumerate(kernels):
+            for item in kernel:
+                closure = self.closure({item: set([propagated])}, first, nullable)
+                for (rule, dot), symbols in closure.items():
+                    rhs = self.rules[rule][1]
+                    if dot == len(rhs):
+                        continue
+                    target = (transitions[state, rhs[dot]], (rule, dot + 1))
+                    for symbol in symbols:
+                        if symbol is propagated:
+                            propagates[state, item].append(target)
+                        else:
+                            lookaheads[target].add(symbol)
+        changed = True
+        while changed:
+            changed = False
+            for source, targets in propagates.items():
+                for target in targets:
+                    if not lookaheads[source] <= lookaheads[target]:
+                        lookaheads[target] |= lookaheads[source]
+                        changed = True
+        return lookaheads
+
+    def build_table(self):
+        """
+        Build the LALR(1) tables. Returns the ACTION table, the GOTO table
+        (a dictionary for each state) and a list of (state, terminal,
+        entries) conflicts, which is empty if the grammar is LALR(1). Where
+        entries conflict, the first is kept in the table, so shifts are
+        preferred to reductions.
+        """
+        nullable = self.nullable()
+        first = self.first_sets(nullable)
+        kernels, transitions = self.states(first, nullable)
+        lookaheads = self.lookaheads(kernels, transitions, first, nullable)
+        action = [{} for _ in kernels]
+        goto = [{} for _ in kernels]
+        for (state, symbol), target in transitions.items():
+            if symbol in self.variables:
+                goto[state][symbol] = target
+            else:
+                action[state][symbol] = ('shift', target)
+        clashes = defaultdict(list)
+        for state, kernel in enumerate(kernels):
+            closure = self.closure(dict((item, lookaheads[state, item]) for item in kernel),
+                                   first, nullable)
+            for (rule, dot), symbols in sorted(closure.items()):
+                if dot < len(self.rules[rule][1]):
+                    continue
+                entry = ('accept', 0) if rule == 0 else ('reduce', rule)
+                for token in symbols:
+                    if token in action[state] and action[state][token] != entry:
+                        if not clashes[state, token]:
+                            clashes[state, token].append(action[state][token])
+                        clashes[state, token].append(entry)
+                    else:
+                        action[state][token] = entry
+        conflicts = sorted((state, token, entries) \
+                           for (state, token), entries in clashes.items())
+        return action, goto, conflicts
+
+    def compile(self):
+        """
+        Return the (action, goto, rules, terminals, start) used to initialise
+        an LALR1Parser, raising an LALR1ConflictError if the grammar is not
+        LALR(1)
+        """
+        action, goto, conflicts = self.build_table()
+        if conflicts:
+            raise LALR1ConflictError(conflicts, self.rules)
+        return action, goto, self.rules, self.terminals, self.start
+
+
+def load_lalr1_table(grammar_file, cache_dir=CACHE_DIR):
+    """
+    Return the (action, goto, rules, terminals, start) for a grammar file,
+    reading the compiled tables from `cache_dir` if this grammar has been
+    compiled before, otherwise generating and saving them there (see
+    load_ll1_table)
+    """
+    if cache_dir is None:
+        return LALR1Grammar(grammar_file).compile()
+    path = os.path.join(cache_dir, "{digest}.lalr1.json".format(
+        digest=grammar_hash(grammar_file, LALR1_CACHE_VERSION)))
+    try:
+        with open(path) as file:
+            cached = json.load(file)
+        action = [{token: tuple(entry) for token, entry in row.items()} \
+                  for row in cached['action']]
+        rules = [(lhs, tuple(rhs)) for lhs, rhs in cached['rules']]
+        return action, cached['goto'], rules, set(cached['terminals']), cached['start']
+    except (OSError, ValueError, KeyError):
+        pass
+    action, goto, rules, terminals, start = LALR1Grammar(grammar_file).compile()
+    os.makedirs(cache_dir, exist_ok=True)
+    temporary = temporary_path(path)
+    with open(temporary, 'w') as file:
+        json.dump({'start': start, 'terminals': sorted(terminals), 'rules': rules,
+                   'action': action, 'goto': goto}, file)
+    os.replace(temporary, path)
+    return action, goto, rules, terminals, start
+
+
+class LALR1Parser:
+    """
+    A shift-reduce parser driven by LALR(1) tables (see LALR1Grammar),
+    which parses in time linear in the length of the input
+    """
+
+    def __init__(self, action, goto, rules, terminals, start, end=END,
+                 error_invalid_symbol=ERROR_INVALID_SYMBOL):
+        self.action = action
+        self.goto = goto
+        self.rules = rules
+        self.terminals = terminals
+        self.start = start
+        self.end = end
+        self.error_invalid_symbol = error_invalid_symbol
+
+    @classmethod
+    def from_grammar(cls, grammar_file, cache_dir=CACHE_DIR, **kwargs):
+        """
+        Create an LALR1Parser for the grammar in `grammar_file`, using the
+        cached tables if the grammar has been compiled before.
+        """
+        return cls(*load_lalr1_table(grammar_file, cache_dir), **kwargs)
+
+    def read_input(self, path):
+        """Read and strip all whitespace from input (see `read_input`)"""
+        return read_input(path)[0]
+
+    def is_valid(self, string):
+        """
+        Returns True if all tokens in the string are terminals from the
+        grammar
+        """
+        return all(token in self.terminals for token in string)
+
+    def check(self, string):
+        """
+        Strip whitespace from a string and return ACCEPTED, REJECTED or the
+        invalid symbol error, without printing or exiting
+        """
+        string = WHITESPACE.sub('', string)
+        if not self.is_valid(string):
+            return self.error_invalid_symbol
+        return ACCEPTED if self.recognise(string) else REJECTED
+
+    def recognise_tokens(self, tokens, lexer):
+        """
+        Returns True if a sequence of token ids from a Lexer is in the
+        language, with the token names as terminals
+        """
+        return self.recognise(lexer.symbols(tokens))
+
+    def recognise(self, string):
+        """Returns True if a string of terminals is in the language"""
+        return self._run(string, False) is not None
+
+    def derivation(self, string):
+        """
+        Return the tree of a string of terminals as nested lists of a symbol
+        followed by all of its children, or None if the string is not in the
+        language
+        """
+        return self._run(string, True)
+
+    def _run(self, string, build):
+        """
+        Run the shift-reduce engine over a string. Returns the tree if
+        `build` is True, True if it is not, or None if the string is
+        rejected.
+        """
+        action, goto, rules = self.action, self.goto, self.rules
+        states = [0]
+        nodes = []
+        position = 0
+        length = len(string)
+        while True:
+            token = string[position] if position < length else self.end
+            entry = action[states[-1]].get(token)
+            if entry is None:
+                return None
+            kind, target = entry
+            if kind == 'shift':
+                states.append(target)
+                if build:
+                    nodes.append(token)
+                position += 1
+            elif kind == 'reduce':
+                lhs, rhs = rules[target]
+                if rhs:
+                    del states[-len(rhs):]
+                if build:
+                    children = nodes[len(nodes)-len(rhs):]
+                    del nodes[len(nodes)-len(rhs):]
+                    nodes.append([lhs] + children)
+                states.append(goto[states[-1]][lhs])
+            else:
+                return nodes[0] if build else True
+
+    def parse(self, infile, tree_format='list'):
+        """
+        Reads the string from the input file and prints its tree (see
+        `derivation` and `write_tree`). Returns True if the string is in
+        the language, otherwise it returns False.
+        """
+        string, valid = read_input(infile, self.terminals)
+        # check if input contains only terminals from the grammar
+        if not valid:
+            print(self.error_invalid_symbol)
+            sys.exit(0)
+        tree = self.derivation(string)
+        if tree is None:
+            return False
+        write_tree(tree, sys.stdout, tree_format)
+        print()
+        return True
+
+
+class CNFError(Exception):
+    """An error that is raised if a token is not in the grammar"""
+    def __init__(self, rule):
+        self.rule = rule
+
+    def __str__(self):
+        return "Grammar is not in CNF (Rule {rule})".format(rule=self.rule)
+
+
+class CNFGrammar:
+    """
+    A context free grammar read from a grammar file (see read_grammar) and
+    converted to Chomsky normal form for the CYKParser. The conversion runs
+    the START, TERM, BIN, DEL and UNIT steps, then removes unproductive and
+    unreachable symbols and merges variables that have the same rules, so
+    that the CYK loops run over as few rules as possible. The empty string
+    is dropped from the language.
+
+    Each converted rule keeps a template, which says how the children of its
+    node are rebuilt in the original grammar, so that `restore` can turn a
+    tree of the converted grammar into a tree of the original grammar. A
+    template is a list of entries: the index of a child of the rule, whose
+    rebuilt subtrees are spliced in; ('const', subtrees) for subtrees that
+    derive the empty string and were removed by DEL; or
+    ('node', symbol, template) for a node of the original grammar. Variables
+    added by the conversion have no node of their own.
+    """
+
+    def __init__(self, grammar_file):
+        start, rules = read_grammar(grammar_file)
+        self.original_start = start
+        self.original_rules = rules
+        self.original_variables = set(lhs for lhs, _ in rules)
+        self._names = self.original_variables | set(
+            symbol for _, rhs in rules for symbol in rhs)
+        # every variable, including those left without rules by DEL
+        self._variables = set(self.original_variables)
+        self.start = start
+        # each rule is (lhs, rhs, template), and every original rule starts
+        # out as a node of its LHS with all of its children
+        self.rules = [(lhs, rhs, [('node', lhs, list(range(len(rhs))))]) \
+                      for lhs, rhs in rules]
+        self._start()
+        self._term()
+        self._bin()
+        self._del()
+        self._unit()
+        self._remove_useless()
+        self._merge()
+        self.variables = set(lhs for lhs, _, _ in self.rules)
+        self.templates = {}
+        for lhs, rhs, template in self.rules:
+            self.templates[lhs, rhs] = template
+
+    def _fresh(self, name):
+        """Return a symbol based on name that is not used in the grammar"""
+        while name in self._names:
+            name += "'"
+        self._names.add(name)
+        self._variables.add(name)
+        return name
+
+    def _start(self):
+        """START: add a new start symbol if the start symbol is on a RHS"""
+        if any(self.start in rhs for _, rhs, _ in self.rules):
+            start = self._fresh(self.start + '_0')
+            self.rules.insert(0, (start, (self.start,), [0]))
+            self.start = start
+
+    def _term(self):
+        """TERM: replace terminals in rules of two or more symbols"""
+        variables = self._variables
+        wrappers = {}
+        rules = []
+        for lhs, rhs, template in self.rules:
+            if len(rhs) > 1:
+                for symbol in rhs:
+                    if symbol not in variables and symbol not in wrappers:
+                        wrappers[symbol] = self._fresh('T_' + symbol)
+                rhs = tuple(wrappers.get(symbol, symbol) for symbol in rhs)
+            rules.append((lhs, rhs, template))
+        for terminal, wrapper in wrappers.items():
+            rules.append((wrapper, (terminal,), [0]))
+        self.rules = rules
+
+    def _bin(self):
+        """
+        BIN: split rules of more than two symbols into a chain of rules of
+        two symbols, whose new variables splice their children into the node
+        of the first rule
+        """
+        rules = []
+        for lhs, rhs, template in self.rules:
+            if len(rhs) <= 2:
+                rules.append((lhs, rhs, template))
+                continue
+            # every child after the first is under the next variable
+            chain = [self._fresh('{lhs}_{index}'.format(lhs=lhs, index=index)) \
+                     for index in range(1, len(rhs) - 1)]
+            rules.append((lhs, (rhs[0], chain[0]),
+                          _substitute(template, dict(
+                              [(0, [0]), (1, [1])] + \
+                              [(index, []) for index in range(2, len(rhs))]))))
+            for index, variable in enumerate(chain):
+                rest = chain[index+1] if index + 1 < len(chain) else rhs[-1]
+                rules.append((variable, (rhs[index+1], rest), [0, 1]))
+        self.rules = rules
+
+    def _del(self):
+        """
+        DEL: remove rules for the empty string, adding a copy of each rule
+        without every combination of its nullable symbols. The subtrees the
+        removed symbols derived are kept in the template.
+        """
+        # the subtrees of the first derivation of the empty string found
+        empty = {}
+        changed = True
+        while changed:
+            changed = False
+            for lhs, rhs, template in self.rules:
+                if lhs not in empty and all(symbol in empty for symbol in rhs):
+                    empty[lhs] = _expand(template, [empty[symbol] for symbol in rhs])
+                    changed = True
+        rules = []
+        for lhs, rhs, template in self.rules:
+            nullable = [index for index, symbol in enumerate(rhs) if symbol in empty]
+            for removed in range(1 << len(nullable)):
+                dropped = set(index for bit, index in enumerate(nullable) \
+                              if removed & (1 << bit))
+                kept = [index for index in range(len(rhs)) if index not in dropped]
+                if not kept:
+                    continue
+                mapping = {}
+                for index in range(len(rhs)):
+                    if index in dropped:
+                        mapping[index] = [('const', empty[rhs[index]])]
+                    else:
+                        mapping[index] = [kept.index(index)]
+                rules.append((lhs, tuple(rhs[index] for index in kept),
+                              _substitute(template, mapping)))
+        self.rules = rules
+
+    def _unit(self):
+        """
+        UNIT: replace each chain of rules A -> B -> ... with the rules of the
+        last variable in the chain. The nodes of the chain are kept in the
+        template.
+        """
+        variables = self._variables
+        is_unit = lambda rhs: len(rhs) == 1 and rhs[0] in variables
+        rules_of = defaultdict(list)
+        for lhs, rhs, template in self.rules:
+            rules_of[lhs].append((rhs, template))
+        rules = []
+        for lhs in _ordered(lhs for lhs, _, _ in self.rules):
+            # the template of each variable reachable by unit rules, where 0
+            # stands for the subtrees of that variable
+            reached = {lhs: [0]}
+            queue = deque([lhs])
+            while queue:
+                variable = queue.popleft()
+                for rhs, template in rules_of[variable]:
+                    path = _substitute(reached[variable], {0: template})
+                    if not is_unit(rhs):
+                        rules.append((lhs, rhs, path))
+                    elif rhs[0] not in reached:
+                        reached[rhs[0]] = path
+                        queue.append(rhs[0])
+        self.rules = rules
+
+    def _remove_useless(self):
+        """Remove rules with unproductive or unreachable symbols"""
+        variables = self._variables
+        productive = set()
+        changed = True
+        while changed:
+            changed = False
+            for lhs, rhs, _ in self.rules:
+                if lhs not in productive and all(symbol in productive or \
+                                                 symbol not in variables \
+                                                 for symbol in rhs):
+                    productive.add(lhs)
+                    changed = True
+        rules = [rule for rule in self.rules if all(
+            symbol in productive or symbol not in variables \
+            for symbol in (rule[0],) + rule[1])]
+        reachable = set([self.start])
+        changed = True
+        while changed:
+            changed = False
+            for lhs, rhs, _ in rules:
+                if lhs in reachable:
+                    for symbol in rhs:
+                        if symbol not in reachable:
+                            reachable.add(symbol)
+                            changed = True
+        self.rules = [rule for rule in rules if rule[0] in reachable]
+
+    def _merge(self):
+        """
+        Merge variables that have the same rules with the same templates,
+        until there are none left. Only the first rule for each (lhs, rhs) is
+        kept, which is the one `restore` uses.
+        """
+        while True:
+            rules = []
+            seen = set()
+            for lhs, rhs, template in self.rules:
+                if (lhs, rhs) not in seen:
+                    seen.add((lhs, rhs))
+                    rules.append((lhs, rhs, template))
+            self.rules = rules
+            signatures = defaultdict(set)
+            for lhs, rhs, template in rules:
+                signatures[lhs].add((rhs, repr(template)))
+            merged = {}
+            first = {}
+            for lhs in _ordered(lhs for lhs, _, _ in rules):
+                signature = frozenset(signatures[lhs])
+                if signature in first:
+                    merged[lhs] = first[signature]
+                else:
+                    first[signature] = lhs
+            if not merged:
+                return
+            self.start = merged.get(self.start, self.start)
+            self.rules = [(lhs, tuple(merged.get(symbol, symbol) for symbol in rhs),
+                           template) for lhs, rhs, template in rules \
+                          if lhs not in merged]
+
+    def restore(self, tree):
+        """
+        Return the tree of the original grammar for a tree of the converted
+        grammar, given as nested lists [symbol, left, right] as made by
+        CYKParser._generate_tree. The nodes of the returned tree are lists of
+        a symbol followed by all of its children, and a variable that derived
+        the empty string has no children. The tree is rebuilt from its leaves
+        up with an explicit stack.
+        """
+        # the subtrees rebuilt for each walked child, in order
+        results = []
+        pending = [(False, tree)]
+        while pending:
+            walked, node = pending.pop()
+            if isinstance(node, str):
+                results.append([node])
+                continue
+            children = [child for child in node[1:] if child is not None]
+            if not walked:
+                pending.append((True, node))
+                pending.extend((False, child) for child in reversed(children))
+                continue
+            rhs = tuple(child if isinstance(child, str) else child[0] \
+                        for child in children)
+            subtrees = results[len(results)-len(children):]
+            del results[len(results)-len(children):]
+            results.append(_expand(self.templates[node[0], rhs], subtrees))
+        return results[0][0]
+
+
+def _substitute(template, mapping):
+    """
+    Return a template with each child index replaced by the list of entries
+    `mapping` gives for it
+    """
+    result = []
+    for entry in template:
+        if isinstance(entry, int):
+            result.extend(mapping[entry])
+        elif entry[0] == 'node':
+            result.append(('node', entry[1], _substitute(entry[2], mapping)))
+        else:
+            result.append(entry)
+    return result
+
+
+def _expand(template, children):
+    """
+    Return the subtrees of the original grammar for a template, given the
+    list of subtrees rebuilt for each child
+    """
+    subtrees = []
+    for entry in template:
+        if isinstance(entry, int):
+            subtrees.extend(children[entry])
+        elif entry[0] == 'node':
+            subtrees.append([entry[1]] + _expand(entry[2], children))
+        else:
+            subtrees.extend(entry[1])
+    return subtrees
+
+
+def _ordered(symbols):
+    """Return the distinct symbols in the order they first appear"""
+    seen = set()
+    return [symbol for symbol in symbols if not (symbol in seen or seen.add(symbol))]
+
+
+class CYKTable:
+    """
+    A triangular matrix of the right size to parse `string`
+    :param: string A list of tokens representing the string that needs to be
+            parsed.
+    :param: sparse If True, only cells that have been set are stored, which
+            saves memory for long strings where most cells are empty.
+    :param: empty The value of a cell that has not been set. If it is
+            callable (like the default, list), it is called to make a new
+            value for each cell.
+
+    The cells are stored in one flat list (or a dictionary if sparse) in
+    row order, so cell [row, column] is at `cells[offsets[row] + column]`.
+    Indexing with [row, column] accepts negative indices and checks bounds;
+    the engines use `get`, `set` or the cells directly, which do not.
+    """
+
+    def __init__(self, string, sparse=False, empty=list):
+        length = len(string)
+        self.length = length
+        self.offsets = [row * length - row * (row - 1) // 2 for row in range(0, length)]
+        size = length * (length + 1) // 2
+        if sparse:
+            self.cells = SparseCells(empty)
+        elif callable(empty):
+            self.cells = [empty() for _ in range(0, size)]
+        else:
+            self.cells = [empty] * size
+
+    def rows(self):
+        """Return the table as a list of rows, shortest span first"""
+        return [[self.cells[self.offsets[row] + column] \
+                 for column in range(0, self.length - row)] \
+                for row in range(0, self.length)]
+
+    def __repr__(self):
+        return '\n'.join(reversed(["{i}: {stringified_row}".format(
+            i=i, stringified_row=[str(node) for node in row]) \
+            for i, row in enumerate(self.rows())]))
+
+    def get(self, row, column):
+        """Return cell [row, column] without checking the indices"""
+        return self.cells[self.offsets[row] + column]
+
+    def set(self, row, column, value):
+        """Set cell [row, column] without checking the indices"""
+        self.cells[self.offsets[row] + column] = value
+
+    def _index(self, row, column):
+        """Return the position of cell [row, column] in `cells`"""
+        length = self.length
+        if row < 0:
+            row += length
+        if column < 0:
+            column += length
+        if 0 <= row < length and 0 <= column < length - row:
+            return self.offsets[row] + column
+        raise IndexError("Index out of range: [{row}, {column}]".format(
+            row=row, column=column))
+
+    def __getitem__(self, rowcolumn):
+        return self.cells[self._index(*rowcolumn)]
+
+    def __setitem__(self, rowcolumn, value):
+        self.cells[self._index(*rowcolumn)] = value
+
+
+class SparseCells(dict):
+    """
+    The cells of a sparse CYKTable. Looking up a cell that has not been set
+    returns the empty value; if it is made by a factory (like list), the new
+    value is stored so that changes to it are kept.
+    """
+
+    def __init__(self, empty):
+        super().__init__()
+        self.empty = empty
+
+    def __missing__(self, index):
+        if callable(self.empty):
+            value = self[index] = self.empty()
+            return value
+        return self.empty
+
+class SharedCells:
+    """
+    The cells of a dense bitset table in a shared memory buffer, for grammars
+    with more than 64 variables, so that several processes can fill one
+    table. Each cell is `words` unsigned 64 bit words, lowest first, and
+    cells are indexed like the list of a dense CYKTable. With 64 variables
+    or fewer a cell is one word, and `shared_cells` returns the buffer cast
+    to words instead, which is indexed the same way.
+    """
+
+    def __init__(self, view, words):
+        self.view = view
+        self.words = words
+
+    def __getitem__(self, index):
+        words = self.words
+        cell = 0
+        for word in reversed(self.view[index * words:(index + 1) * words]):
+            cell = (cell << 64) | word
+        return cell
+
+    def __setitem__(self, index, value):
+        words = self.words
+        for word in range(index * words, (index + 1) * words):
+            self.view[word] = value & 0xffffffffffffffff
+            value >>= 64
+
+    def tolist(self):
+        """Return every cell as a list"""
+        return [self[index] for index in range(0, len(self.view) // self.words)]
+
+    def release(self):
+        """Release the view of the shared memory"""
+        self.view.release()
+
+
+def shared_cells(buffer, words):
+    """
+    Return the cells of a dense bitset table of `words` words per cell in a
+    shared memory buffer (see SharedCells)
+    """
+    view = buffer.cast('Q')
+    return view if words == 1 else SharedCells(view, words)
+
+
+class CYKNode:
+    """
+    A node of a binary search tree used to store information about the
+    production rule used to populate an entry of a CYKTable in order to
+    reconstruct a binary search tree from the table.
+    For nonterminal rules, the Node contains Ra at the root and the children
+    Rb, Rc from the right hand side
+    of the rule Ra -> Rb Rc. Rules of the form
+    Ra -> b used to construct terminal symbols will only have a left child.
+    """
+
+    __slots__ = ('symbol', 'left', 'right')
+
+    def __init__(self, symbol, left=None, right=None):
+        self.symbol = symbol
+        self.left = left
+        self.right = right
+
+    def __repr__(self):
+        return "{symbol}".format(symbol=self.symbol)
+
+    def get_symbol(self):
+        """Get the symbol at the root of this node"""
+        return self.symbol
+
+    def get_left(self):
+        """Get the left part of the right hand side of the rule"""
+        return self.left
+
+    def get_right(self):
+        """Get the right part of the right hand side of the rule"""
+        return self.right
+
+    def is_unit_rule(self):
+        """Return True if the current node represents a unit production rule"""
+        return self.left is not None and self.right is None
+
+    def is_terminal(self):
+        """Return True if the current node represents a terminal symbol"""
+        return self.left is None and self.right is None
+
+class CYKNodeArena:
+    """
+    Stores CYK tree nodes as parallel arrays of integers instead of objects.
+    Node i has the symbol `names[symbols[i]]`, covers `lengths[i]` tokens
+    from `starts[i]`, and has the children `lefts[i]` and `rights[i]`, or -1
+    if there is no such child. As with CYKNode, a terminal has no children
+    and a unit production has only a left child. `node(i)` returns a
+    CYKNodeView with the same methods as CYKNode.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.name_ids = {}
+        self.symbols = array('i')
+        self.starts = array('i')
+        self.lengths = array('i')
+        self.lefts = array('i')
+        self.rights = array('i')
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def add(self, symbol, start, length, left=-1, right=-1):
+        """Add a node and return its index"""
+        if symbol not in self.name_ids:
+            self.name_ids[symbol] = len(self.names)
+            self.names.append(symbol)
+        self.symbols.append(self.name_ids[symbol])
+        self.starts.append(start)
+        self.lengths.append(length)
+        self.lefts.append(left)
+        self.rights.append(right)
+        return len(self.symbols) - 1
+
+    def symbol(self, index):
+        """Get the symbol of node `index`"""
+        return self.names[self.symbols[index]]
+
+    def node(self, index):
+        """Return a CYKNodeView of node `index`"""
+        return CYKNodeView(self, index)
+
+
+class CYKNodeView:
+    """
+    A CYKNode-like view of a node in a CYKNodeArena. Views are only made when
+    a tree is walked, and the children are made as they are requested.
+    """
+
+    __slots__ = ('arena', 'index')
+
+    def __init__(self, arena, index):
+        self.arena = arena
+        self.index = index
+
+    def __repr__(self):
+        return "{symbol}".format(symbol=self.get_symbol())
+
+    def get_symbol(self):
+        """Get the symbol at the root of this node"""
+        return self.arena.symbol(self.index)
+
+    def get_left(self):
+        """Get the left part of the right hand side of the rule"""
+        left = self.arena.lefts[self.index]
+        return None if left < 0 else CYKNodeView(self.arena, left)
+
+    def get_right(self):
+        """Get the right part of the right hand side of the rule"""
+        right = self.arena.rights[self.index]
+        return None if right < 0 else CYKNodeView(self.arena, right)
+
+    def is_unit_rule(self):
+        """Return True if the current node represents a unit production rule"""
+        return self.arena.lefts[self.index] >= 0 and self.arena.rights[self.index] < 0
+
+    def is_terminal(self):
+        """Return True if the current node represents a terminal symbol"""
+        return self.arena.lefts[self.index] < 0 and self.arena.rights[self.index] < 0
+
+
+class CYKParser:
+    """
+    The CYKParser expects a grammar file, from which it constructs the lists
+    of rules that will be used to parse a string. Each rule in the grammar file
+    consist of a token on the left hand side and a list of one terminal
+    token or two variable tokens on the right hand side separated by spaces.
+    The tokens may be more than one character long, since a grammar might
+    include more variables than the number of uppercase letters.
+
+    The method `parse` is used to parse an input string, and prints the tree
+    generated by the string for unambiguous grammars. The method `recognise`
+    merely recognises the string, and prints the parse table generated while
+    recognising the string. The method `recognise_bitset` recognises a string
+    with a faster engine in which each cell of the table is a bitmask of
+    variables. If NumPy is installed, `accepts` recognises strings of at
+    least `numpy_threshold` tokens whose chart looks dense with
+    `recognise_numpy` instead (see `_engine`).
+
+    For ambiguous grammars `parse` prints only one tree; the method `forest`
+    returns a ParseForest holding every derivation.
+
+    For input that changes a few tokens at a time, `parse_state` keeps the
+    sparse bitset table of a parse, and `reparse` applies an edit to it,
+    filling only the cells whose spans overlap the edit.
+
+    With `parallel_threshold`, strings of at least that many tokens are
+    recognised and parsed with a table filled by `processes` worker
+    processes (see `parallel_table`), if their chart is dense enough for
+    the parallel dense fill to beat the sparse engine (see `_is_parallel`)
+    and the NumPy engine is not used instead. The pool is started by the
+    first such string and kept for later ones until `close_pool`.
+
+    With `stats`, a ParseStats, the phases of `parse` are timed and the
+    bitset engines count the cells of their tables, the rules checked for
+    each new pair of cells and the nodes of the tree. Worker processes do
+    not count the rules they check.
+    """
+
+    def __init__(self, grammar_file, error_invalid_symbol=ERROR_INVALID_SYMBOL,
+                 numpy_threshold=NUMPY_THRESHOLD, artifact=None, cnf=False,
+                 parallel_threshold=None, processes=None, stats=None):
+        self.grammar_file = grammar_file
+        self.stats = stats
+        self.parallel_threshold = parallel_threshold
+        self.processes = processes
+        self.artifact = artifact
+        # the CNFGrammar the rules were converted by, if any
+        self.cnf = None
+        self.numpy_threshold = numpy_threshold
+        self._matrix_engine = None
+        # the worker pool of parallel_table, kept until close_pool
+        self._pool = None
+        self._pool_processes = None
+        self._pool_tables = 0
+        self.rules = None
+        self.unit_productions = defaultdict(list)
+        self.nonterminal_rules = []
+        self.error_invalid_symbol = error_invalid_symbol
+        self.start_symbol = None
+        self.rule_weights = {}
+        # add the rules from the grammar to terminal and variable rules, and
+        # index them by bitmask for the bitset engine. A compiled grammar
+        # artifact holds the index as well.
+        if artifact is not None:
+            self._load_artifact(artifact)
+            return
+        if cnf:
+            self._read_cnf_grammar(grammar_file)
+        else:
+            self._read_grammar(grammar_file)
+        self._index_rules()
+
+    @classmethod
+    def from_grammar(cls, grammar_file, cache_dir=CACHE_DIR, cnf=False, **kwargs):
+        """
+        Create a CYKParser from the compiled artifact for a grammar file,
+        compiling it into `cache_dir` first if needed (see compile_grammar).
+        The artifact only holds the rules, so trees of a grammar converted
+        with `cnf` are printed in terms of the converted grammar.
+        """
+        return cls(grammar_file, artifact=compile_grammar(grammar_file, cache_dir, cnf),
+                   **kwargs)
+
+    def __reduce__(self):
+        # a parser loaded from an artifact is sent to other processes as the
+        # path of the artifact, which each process reads instead of parsing
+        # the grammar file and indexing its rules, and the settings that are
+        # not in the artifact
+        if self.artifact is not None:
+            return (self.__class__, (self.grammar_file, self.error_invalid_symbol,
+                                     self.numpy_threshold, self.artifact),
+                    {'cnf': self.cnf, 'parallel_threshold': self.parallel_threshold,
+                     'processes': self.processes})
+        return super().__reduce__()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_matrix_engine'] = None
+        state['stats'] = None
+        state['_pool'] = None
+        state['_pool_processes'] = None
+        return state
+
+    def _load_artifact(self, path):
+        """
+        Read a compiled grammar artifact (see write_grammar_artifact), add its
+        rules to the terminal and variable rules and load the rule index that
+        `_index_rules` would build
+        """
+        with open(path, 'rb') as file:
+            data = file.read()
+        if data[:len(ARTIFACT_MAGIC)] != ARTIFACT_MAGIC:
+            raise ValueError("{path} is not a compiled grammar".format(path=path))
+        version, header_length = struct.unpack_from('<II', data, len(ARTIFACT_MAGIC))
+        if version != CYK_ARTIFACT_VERSION:
+            raise ValueError("{path} is version {version} of the grammar format, \
+expected {expected}".format(path=path, version=version,
+                            expected=CYK_ARTIFACT_VERSION))
+        offset = len(ARTIFACT_MAGIC) + 8
+        header = json.loads(data[offset:offset+header_length].decode())
+        offset += header_length
+        view = memoryview(data)
+        symbols = header['symbols']
+        arrays = {}
+        for name, typecode, count in header['arrays']:
+            size = struct.calcsize(typecode) * count
+            arrays[name] = view[offset:offset+size].cast(typecode)
+            offset += size
+        self.start_symbol = symbols[header['start']]
+        units = arrays['unit_rules']
+        for index in range(0, len(units), 2):
+            self.unit_productions[symbols[units[index]]].append(symbols[units[index+1]])
+        binary = arrays['binary_rules']
+        for index in range(0, len(binary), 3):
+            self.nonterminal_rules.append((symbols[binary[index]],
+                                           [symbols[binary[index+1]],
+                                            symbols[binary[index+2]]]))
+        for rule, weight in zip(header['weighted'], arrays['weights']):
+            self.rule_weights[symbols[rule[0]], tuple(symbols[symbol] \
+                                                      for symbol in rule[1:])] = weight
+        self.variables = [symbols[symbol] for symbol in arrays['variables']]
+        self.variable_bits = {symbol: 1 << index \
+                              for index, symbol in enumerate(self.variables)}
+        width = header['mask_bytes']
+        masks = arrays['masks']
+        masks = iter([int.from_bytes(masks[index:index+width], 'little') \
+                      for index in range(0, len(masks), width)])
+        self.terminal_masks = {symbols[terminal]: next(masks) \
+                               for terminal in arrays['terminals']}
+        pairs = arrays['pairs']
+        self.pair_masks = {(1 << pairs[index], 1 << pairs[index+1]): next(masks) \
+                           for index in range(0, len(pairs), 2)}
+        self.rights_of = {1 << left: next(masks) for left in arrays['rights']}
+        self.length_masks = [next(masks) for _ in range(0, header['length_masks'])]
+        self.corner_masks = {corner: next(masks) for corner in \
+                             ((True, True), (True, False), (False, True), (False, False))}
+        self.left_mask = next(masks)
+        self.right_mask = next(masks)
+        yields = [int(length) if length < math.inf else math.inf \
+                  for length in arrays['yields']]
+        count = len(self.variables)
+        self.min_yield = dict(zip(self.variables, yields[:count]))
+        self.max_yield = dict(zip(self.variables, yields[count:2*count]))
+        self.partition_bounds = tuple(yields[2*count:])
+        self.rules_of = defaultdict(list)
+        for lhs, (left, right) in self.nonterminal_rules:
+            self.rules_of[lhs].append((left, right))
+        self.rules_of = dict(self.rules_of)
+
+    def _index_rules(self):
+        """
+        Give every variable a bit and index the rules for the bitset engine.
+        `terminal_masks` maps a terminal to the mask of the variables that
+        produce it. For a rule A -> B C, `rights_of[bit(B)]` includes bit(C),
+        and `pair_masks[bit(B), bit(C)]` is the mask of every such A, so the
+        variables produced by a pair of cells are found with one lookup for
+        each (B, C) pair that has a rule.
+        """
+        self.variables = []
+        self.variable_bits = {}
+        def bit(symbol):
+            if symbol not in self.variable_bits:
+                self.variable_bits[symbol] = 1 << len(self.variables)
+                self.variables.append(symbol)
+            return self.variable_bits[symbol]
+        bit(self.start_symbol)
+        self.terminal_masks = {}
+        for terminal, lhses in self.unit_productions.items():
+            mask = 0
+            for lhs in lhses:
+                mask |= bit(lhs)
+            self.terminal_masks[terminal] = mask
+        self.rights_of = defaultdict(int)
+        self.pair_masks = defaultdict(int)
+        self.left_mask = 0
+        self.right_mask = 0
+        for lhs, (left, right) in self.nonterminal_rules:
+            lhs_bit, left_bit, right_bit = bit(lhs), bit(left), bit(right)
+            self.rights_of[left_bit] |= right_bit
+            self.pair_masks[left_bit, right_bit] |= lhs_bit
+            self.left_mask |= left_bit
+            self.right_mask |= right_bit
+        # the rules for each variable, for walking the table top down
+        self.rules_of = defaultdict(list)
+        for lhs, (left, right) in self.nonterminal_rules:
+            self.rules_of[lhs].append((left, right))
+        self.rules_of = dict(self.rules_of)
+        self.rights_of = dict(self.rights_of)
+        self.pair_masks = dict(self.pair_masks)
+        self._index_yields()
+
+    def _index_yields(self):
+        """
+        Work out which variables the bitset engine can keep in each cell.
+        `min_yield` and `max_yield` map each variable to the shortest and
+        longest string it derives (math.inf if there is no longest), and
+        `length_masks[length]` is the mask of the variables that derive some
+        string of that length (the last mask is used for longer spans). A
+        span starting at 0 can only hold left corners of the start symbol,
+        and a span starting later must be a left corner of the right child
+        of some rule; likewise for right corners at the end of the string.
+        `corner_masks[at_start, at_end]` is the mask of the variables allowed
+        by both. Variables outside these masks cannot be part of any
+        derivation of the whole string, so dropping them from a cell leaves
+        the answer and the trees unchanged.
+        """
+        bits = self.variable_bits
+        rules = self.nonterminal_rules
+        min_yield = {symbol: math.inf for symbol in self.variables}
+        for lhses in self.unit_productions.values():
+            for lhs in lhses:
+                min_yield[lhs] = 1
+        changed = True
+        while changed:
+            changed = False
+            for lhs, (left, right) in rules:
+                length = min_yield[left] + min_yield[right]
+                if length < min_yield[lhs]:
+                    min_yield[lhs] = length
+                    changed = True
+        # only rules whose children both derive some string can be used
+        rules = [(lhs, rhs) for lhs, rhs in rules \
+                 if min_yield[rhs[0]] < math.inf and min_yield[rhs[1]] < math.inf]
+        # a variable has no longest string if it reaches a recursive variable
+        children = defaultdict(set)
+        for lhs, rhs in rules:
+            children[lhs].update(rhs)
+        reachable = {}
+        for symbol in self.variables:
+            seen = set()
+            pending = list(children[symbol])
+            while pending:
+                child = pending.pop()
+                if child not in seen:
+                    seen.add(child)
+                    pending.extend(children[child])
+            reachable[symbol] = seen
+        recursive = set(symbol for symbol in self.variables if symbol in reachable[symbol])
+        max_yield = {symbol: 0 if min_yield[symbol] == math.inf else 1 \
+                     for symbol in self.variables}
+        for symbol in self.variables:
+            if symbol in recursive or reachable[symbol] & recursive:
+                max_yield[symbol] = math.inf
+        changed = True
+        while changed:
+            changed = False
+            for lhs, (left, right) in rules:
+                length = max_yield[left] + max_yield[right]
+                if length > max_yield[lhs]:
+                    max_yield[lhs] = length
+                    changed = True
+        self.min_yield = min_yield
+        self.max_yield = max_yield
+        bounds = [length for length in list(min_yield.values()) + list(max_yield.values()) \
+                  if length < math.inf]
+        self.length_masks = [0] * (max(bounds, default=0) + 2)
+        for length in range(1, len(self.length_masks)):
+            for symbol in self.variables:
+                if min_yield[symbol] <= length <= max_yield[symbol]:
+                    self.length_masks[length] |= bits[symbol]
+        # the range of lengths of the left and right children of any rule
+        lefts = [rhs[0] for _, rhs in rules]
+        rights = [rhs[1] for _, rhs in rules]
+        self.partition_bounds = (
+            min((min_yield[left] for left in lefts), default=1),
+            max((max_yield[left] for left in lefts), default=0),
+            min((min_yield[right] for right in rights), default=1),
+            max((max_yield[right] for right in rights), default=0))
+        # left_corners[A] is the mask of A and every variable that can be the
+        # first child of first children of A, and right_corners likewise
+        left_corners = {symbol: bits[symbol] for symbol in self.variables}
+        right_corners = dict(left_corners)
+        changed = True
+        while changed:
+            changed = False
+            for lhs, (left, right) in rules:
+                for corners, child in ((left_corners, left), (right_corners, right)):
+                    mask = corners[lhs] | corners[child]
+                    if mask != corners[lhs]:
+                        corners[lhs] = mask
+                        changed = True
+        after_start = 0
+        before_end = 0
+        for lhs, (left, right) in rules:
+            after_start |= left_corners[right]
+            before_end |= right_corners[left]
+        start = self.start_symbol
+        self.corner_masks = {
+            (True, True): bits[start],
+            (True, False): left_corners[start] & before_end,
+            (False, True): right_corners[start] & after_start,
+            (False, False): after_start & before_end}
+
+    def span_mask(self, start, length, len_string):
+        """
+        Return the mask of the variables that may be kept in the cell of a
+        span in a string of `len_string` tokens (see `_index_yields`)
+        """
+        return self._length_mask(length) & \
+            self.corner_masks[start == 0, start + length == len_string]
+
+    def _length_mask(self, length):
+        """Return the mask of the variables that derive a string of `length`"""
+        masks = self.length_masks
+        return masks[min(length, len(masks)-1)]
+
+    def _partitions(self, length):
+        """
+        Return the range of partitions of a span of `length` tokens for which
+        both halves can hold the child of some rule
+        """
+        min_left, max_left, min_right, max_right = self.partition_bounds
+        return range(max(1, min_left, length - max_right),
+                     min(length - 1, max_left, length - min_right) + 1)
+
+    def mask_symbols(self, mask):
+        """Return the list of variables whose bits are set in mask"""
+        return [symbol for symbol in self.variables \
+                if mask & self.variable_bits[symbol]]
+
+    def is_valid(self, string):
+        """
+        Returns True if all tokens in the string are terminals from the
+        grammar
+        """
+        for token in string:
+            if not token in self.unit_productions:
+                return False
+        return True
+
+    def _read_grammar(self, grammar_file):
+        """
+        Reads a grammar file and appends the rules to the list of
+        terminal and nonterminal rules in the grammar. The start symbol
+        must be the LHS of the first rule in the file. A rule may end in a
+        weight in square brackets, e.g. `VP -> V NP [0.7] | eats [0.3]`, which
+        is stored in `rule_weights`; rules without one have weight 1. A
+        weight that is not a positive number raises a GrammarError, since
+        `viterbi` takes its log.
+        """
+        grammar_rhs = lambda rule: rule.strip().split('->')[1].strip()
+        grammar_lhs = lambda rule: rule.strip().split('->')[0].strip()
+        with open(grammar_file) as file:
+            lines = file.readlines()
+        self.start_symbol = grammar_lhs(lines[0])
+        for line in lines:
+            # Get and check the LHS of the rule
+            lhs = grammar_lhs(line)
+            if len(grammar_lhs(line).split(' ')) != 1:
+                raise CNFError(line)
+            # Get the RHSes for this LHS
+            multirule_rhs = [rule.strip().split(' ') for rule in grammar_rhs(line).split('|')]
+            for rule in multirule_rhs:
+                weight = RULE_WEIGHT.match(rule[-1])
+                if weight and len(rule) > 1:
+                    rule = rule[:-1]
+                    try:
+                        value = float(weight.group(1))
+                    except ValueError:
+                        value = 0.0
+                    if not 0 < value < math.inf:
+                        raise GrammarError(line.strip())
+                    self.rule_weights[lhs, tuple(rule)] = value
+                if len(rule) == 1:
+                    self.unit_productions[rule[0]].append(lhs)
+                elif len(rule) == 2:
+                    self.nonterminal_rules.append((lhs, rule))
+                else:
+                    raise CNFError("{lhs} -> {rule}".format(lhs=lhs, rule=rule))
+
+    def _read_cnf_grammar(self, grammar_file):
+        """
+        Reads a grammar file that need not be in CNF, converts it with
+        CNFGrammar and appends the converted rules to the list of terminal and
+        nonterminal rules. Trees are printed in terms of the original grammar
+        (see CNFGrammar.restore). Rule weights are not read.
+        """
+        self.cnf = CNFGrammar(grammar_file)
+        self.start_symbol = self.cnf.start
+        for lhs, rhs, _ in self.cnf.rules:
+            if len(rhs) == 1:
+                self.unit_productions[rhs[0]].append(lhs)
+            else:
+                self.nonterminal_rules.append((lhs, list(rhs)))
+
+    def read_input(self, path):
+        """Read and strip all whitespace from input (see `read_input`)"""
+        return read_input(path)[0]
+
+    def _generate_tree(self, node):
+        """
+        Return the tree with node at the root as nested lists. The tree is
+        walked with an explicit stack, so deep trees do not reach the
+        recursion limit.
+        """
+        if node.is_terminal():
+            return node.get_symbol()
+        tree = []
+        pending = [(node, tree)]
+        while pending:
+            node, output = pending.pop()
+            output.append(node.get_symbol())
+            for child in (node.get_left(), node.get_right()):
+                if child is None or child.is_terminal():
+                    output.append(None if child is None else child.get_symbol())
+                else:
+                    subtree = []
+                    output.append(subtree)
+                    pending.append((child, subtree))
+        return tree
+
+    def write_tree(self, tree, file=None, tree_format='list'):
+        """Write a tree to file (stdout by default), see `write_tree`"""
+        write_tree(tree, sys.stdout if file is None else file, tree_format)
+
+    def recognise(self, infile):
+        """
+        Print the parse table and returns True if a string is in the language,
+        otherwise return False
+        """
+        string = self.read_input(infile)
+        table = self._recognition_table(string)
+        if table is not None and self._table_accepts(table, len(string)):
+            print(table)
+            return True
+        return False
+
+    def recognise_string(self, string):
+        """
+        Returns True if a string of terminals (with whitespace already
+        stripped) is in the language, without printing anything
+        """
+        table = self._recognition_table(string)
+        return table is not None and self._table_accepts(table, len(string))
+
+    def check(self, string):
+        """
+        Strip whitespace from a string and return ACCEPTED, REJECTED or the
+        invalid symbol error, without printing or exiting
+        """
+        string = WHITESPACE.sub('', string)
+        if not self.is_valid(string):
+            return self.error_invalid_symbol
+        return ACCEPTED if self.accepts(string) else REJECTED
+
+    def recognise_tokens(self, tokens, lexer):
+        """
+        Returns True if a sequence of token ids from a Lexer is in the
+        language, with the token names as terminals (see `accepts`)
+        """
+        return self.accepts(lexer.symbols(tokens))
+
+    def accepts(self, string):
+        """
+        Returns True if a string of terminals is in the language, using the
+        engine chosen by `_engine`
+        """
+        engine = self._engine(string)
+        if engine == 'numpy':
+            return self.recognise_numpy(string)
+        if engine == 'parallel':
+            return self._state_accepts(self.parallel_table(string, self.processes),
+                                       len(string))
+        return self.recognise_bitset(string)
+
+    def _engine(self, string):
+        """
+        Return the engine that `accepts` and the tree methods use for a
+        string: 'numpy' if NumPy is installed, the string has at least
+        `numpy_threshold` tokens, its arrays fit in NUMPY_MAX_BYTES and its
+        sampled chart density is at least NUMPY_MIN_DENSITY, 'parallel' if
+        `_is_parallel`, and 'sparse' otherwise. Serial NumPy beat the
+        parallel dense fill on every dense chart we have measured, so it is
+        tried first.
+        """
+        density = None
+        if numpy is not None and self.numpy_threshold is not None and \
+            len(string) >= self.numpy_threshold and \
+            self.numpy_bytes(len(string)) <= NUMPY_MAX_BYTES:
+            density = self._sampled_density(string)
+            if density >= NUMPY_MIN_DENSITY:
+                return 'numpy'
+        if self._is_parallel(string, density):
+            return 'parallel'
+        return 'sparse'
+
+    def numpy_bytes(self, len_string):
+        """
+        Return an upper bound on the bytes that the NumPy engine allocates
+        for a string of this length: its boolean chart and pairs arrays, the
+        operands, float32 copies and result of its largest matrix product
+        (a quarter of the chart along each side), and the diagonals of a leaf
+        """
+        positions = len_string + 1
+        pairs = len(self.pair_masks)
+        quarter = (positions + 3) // 4
+        leaf = CYKMatrixEngine.LEAF
+        return (len(self.variables) + pairs) * positions ** 2 + \
+            15 * pairs * quarter ** 2 + \
+            8 * (len(self.variables) + pairs) * leaf ** 2
+
+    def recognise_numpy(self, string):
+        """
+        Returns True if a string of terminals is in the language, filling the
+        table with NumPy boolean matrix products. Requires NumPy.
+        """
+        chart = self.numpy_chart(string)
+        return chart is not None and len(string) > 0 and \
+            bool(chart[self.variables.index(self.start_symbol), 0, len(string)])
+
+    def numpy_chart(self, string):
+        """
+        Return the chart filled by a CYKMatrixEngine for this grammar, or None
+        if the string contains a symbol with no unit production. Requires
+        NumPy.
+        """
+        if self._matrix_engine is None:
+            self._matrix_engine = CYKMatrixEngine(self)
+        return self._matrix_engine.chart(string)
+
+    def numpy_table(self, string):
+        """
+        Return the same dense bitset table as `bitset_table`, filled by the
+        NumPy engine, or None if the string contains a symbol with no unit
+        production. Requires NumPy.
+        """
+        chart = self.numpy_chart(string)
+        if chart is None:
+            return None
+        len_string = len(string)
+        table = CYKTable(string, empty=0)
+        cells = table.cells
+        offsets = table.offsets
+        for length in range(1, len_string+1):
+            starts = numpy.arange(0, len_string - length + 1)
+            # one row of little endian bytes per span, bit v for variable v
+            packed = numpy.packbits(chart[:, starts, starts + length], axis=0,
+                                    bitorder='little').T.copy()
+            offset = offsets[length-1]
+            for start in range(0, len(starts)):
+                cells[offset + start] = int.from_bytes(packed[start].tobytes(), 'little')
+        if self.stats is not None:
+            self._count_table(table, {})
+        return table
+
+    def recognise_bitset(self, string, sparse=True):
+        """
+        Returns True if a string of terminals is in the language, using the
+        bitset engine. Gives the same answer as `recognise_string`. The sparse
+        table is the default since it only visits non-empty cells, which is
+        faster for every grammar we have measured.
+        """
+        table = self.bitset_table(string, sparse)
+        return table is not None and len(string) > 0 and \
+            bool(table[len(string)-1, 0] & self.variable_bits[self.start_symbol])
+
+    def bitset_table(self, string, sparse=False):
+        """
+        Fill a CYKTable in which each cell is the bitmask of the variables
+        that can produce that span, or return None if the string contains a
+        symbol with no unit production. Use `mask_symbols` to turn a cell back
+        into a list of variables. With sparse=True only the spans that some
+        variable produces are stored.
+
+        Each cell only keeps the variables allowed by `span_mask`, and only
+        the partitions given by `_partitions` are tried, which skips spans
+        that cannot be part of a derivation of the whole string without
+        changing the answer or the trees.
+        """
+        table = CYKTable(string, sparse=sparse, empty=0)
+        # the engine works on the cells of the table directly, since every
+        # index it uses is in range
+        cells = table.cells
+        offsets = table.offsets
+        len_string = len(string)
+        terminal_masks = self.terminal_masks
+        for start in range(0, len_string):
+            if string[start] not in terminal_masks:
+                return None
+        for start in range(0, len_string):
+            cell = terminal_masks[string[start]] & self.span_mask(start, 1, len_string)
+            if cell or not sparse:
+                cells[start] = cell
+        # the same pair of cells often appears in many spans, so remember the
+        # variables each (left, right) pair produces
+        produced = {}
+        if sparse:
+            self._fill_sparse_bitset(cells, offsets, len_string, produced)
+        else:
+            for length in range(2, len_string+1): # length of span
+                self._fill_bitset_row(cells, offsets, len_string, length, 0,
+                                      len_string-length+1, produced)
+        if self.stats is not None:
+            self._count_table(table, produced)
+        return table
+
+    def _count_table(self, table, produced):
+        """
+        Add the cells of a filled bitset table, the cells that hold some
+        variable and the pairs of cells combined to the parser's stats
+        """
+        cells = table.cells
+        if isinstance(cells, SparseCells):
+            filled = len(cells)
+        else:
+            filled = len(cells) - cells.count(0)
+        self.stats.add('cells', table.length * (table.length + 1) // 2)
+        self.stats.add('cells_filled', filled)
+        self.stats.add('pairs', len(produced))
+
+    def parallel_table(self, string, processes=None):
+        """
+        Fill the same dense bitset table as `bitset_table` with a pool of
+        worker processes (one per CPU by default), or return None if the
+        string contains a symbol with no unit production. With processes=1
+        the table is filled in this process. The cells live in shared memory
+        (see `shared_cells`). The spans of each length only depend
+        on shorter spans, so each length is split into blocks that the
+        workers fill at the same time. Spans get fewer as they get longer but
+        each has more partitions, so the number of blocks for a length
+        follows the number of partitions to try (see `_parallel_blocks`),
+        and lengths with too little work are filled in this process.
+        """
+        len_string = len(string)
+        terminal_masks = self.terminal_masks
+        if not all(symbol in terminal_masks for symbol in string):
+            return None
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if processes == 1 or not len_string:
+            return self.bitset_table(string)
+        table = CYKTable(string, empty=0)
+        offsets = table.offsets
+        words = max(1, (len(self.variables) + 63) // 64)
+        memory = shared_memory.SharedMemory(create=True, size=len(table.cells) * words * 8)
+        cells = shared_cells(memory.buf, words)
+        try:
+            for start in range(0, len_string):
+                cells[start] = terminal_masks[string[start]] & \
+                    self.span_mask(start, 1, len_string)
+            produced = {}
+            pool = None
+            # workers attach to the shared memory of a new table when they
+            # see a new number
+            self._pool_tables += 1
+            for length in range(2, len_string+1): # length of span
+                blocks = self._parallel_blocks(length, len_string, processes)
+                if len(blocks) == 1:
+                    self._fill_bitset_row(cells, offsets, len_string, length,
+                                          0, len_string-length+1, produced)
+                else:
+                    if pool is None:
+                        pool = self._parallel_pool(processes)
+                    pool.map(_fill_parallel_block,
+                             [(self._pool_tables, memory.name, words, len_string) + block \
+                              for block in blocks])
+            table.cells = cells.tolist()
+            if self.stats is not None:
+                self._count_table(table, produced)
+        finally:
+            cells.release()
+            memory.close()
+            memory.unlink()
+        return table
+
+    def _parallel_pool(self, processes):
+        """
+        Return the pool of `processes` workers that fill tables for
+        `parallel_table`, starting it (and sending the parser to each worker)
+        only if the parser has no pool of that size yet
+        """
+        if self._pool is not None and self._pool_processes != processes:
+            self.close_pool()
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(processes, _init_parallel_worker, (self,))
+            self._pool_processes = processes
+        return self._pool
+
+    def close_pool(self):
+        """Stop the worker processes of `parallel_table`, if any were started"""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._pool_processes = None
+
+    def _parallel_blocks(self, length, len_string, processes):
+        """
+        Split the spans of `length` tokens into (length, first, last) blocks
+        of at least PARALLEL_BLOCK_WORK partitions, and at most
+        PARALLEL_BLOCKS_PER_PROCESS blocks for each process
+        """
+        spans = len_string - length + 1
+        work = spans * len(self._partitions(length))
+        count = max(1, min(spans, processes * PARALLEL_BLOCKS_PER_PROCESS,
+                           work // PARALLEL_BLOCK_WORK))
+        bounds = [spans * block // count for block in range(0, count + 1)]
+        return [(length, first, last) for first, last in zip(bounds, bounds[1:])]
+
+    def _is_parallel(self, string, density=None):
+        """
+        Returns True if a string is long enough to be filled in parallel, and
+        its chart looks dense enough (see PARALLEL_MIN_DENSITY). `density` is
+        its `_sampled_density`, if already known. A pool worker cannot start
+        processes of its own, so it never is.
+        """
+        if self.parallel_threshold is None or len(string) < self.parallel_threshold or \
+            multiprocessing.current_process().daemon:
+            return False
+        if density is None:
+            density = self._sampled_density(string)
+        return density >= PARALLEL_MIN_DENSITY
+
+    def _sampled_density(self, string):
+        """
+        Return the mean `_chart_density` of DENSITY_WINDOWS windows of
+        DENSITY_WINDOW tokens spread evenly across a string, so that the
+        cost of estimating it does not grow with the string
+        """
+        len_string = len(string)
+        if len_string <= DENSITY_WINDOW:
+            return self._chart_density(string)
+        starts = [window * (len_string - DENSITY_WINDOW) // (DENSITY_WINDOWS - 1) \
+                  for window in range(0, DENSITY_WINDOWS)]
+        return sum(self._chart_density(string[start:start + DENSITY_WINDOW]) \
+                   for start in starts) / DENSITY_WINDOWS
+
+    def _chart_density(self, string):
+        """
+        Return the fraction of the cells of the sparse bitset table for a
+        string that hold some variable, or 0 if the string is empty or has a
+        symbol with no unit production
+        """
+        len_string = len(string)
+        if not len_string or not all(symbol in self.terminal_masks for symbol in string):
+            return 0
+        table = CYKTable(string, sparse=True, empty=0)
+        cells = table.cells
+        for start in range(0, len_string):
+            cell = self.terminal_masks[string[start]] & self.span_mask(start, 1, len_string)
+            if cell:
+                cells[start] = cell
+        self._fill_sparse_bitset(cells, table.offsets, len_string, {})
+        return len(cells) / (len_string * (len_string + 1) // 2)
+
+    def _tree_table(self, string):
+        """
+        Return the bitset table that trees are built from, filled by the
+        engine that `_engine` chooses
+        """
+        engine = self._engine(string)
+        if engine == 'numpy':
+            return self.numpy_table(string)
+        if engine == 'parallel':
+            return self.parallel_table(string, self.processes)
+        return self.bitset_table(string, sparse=True)
+
+    def _fill_bitset_row(self, cells, offsets, len_string, length, first, last,
+                         produced):
+        """
+        Fill the cells of a dense bitset table for the spans of `length`
+        tokens that start at first..last-1. The cells of every shorter span
+        must already be filled.
+        """
+        left_mask = self.left_mask
+        right_mask = self.right_mask
+        row = offsets[length-1]
+        # spans that do not start at 0 or end at the end of the string
+        inner_mask = self._length_mask(length) & self.corner_masks[False, False]
+        # for each partition of the span, the cells of its two halves are
+        # at cells[left_offset + start] and cells[right_offset + start]
+        partitions = [(offsets[partition-1], offsets[length-partition-1] + partition) \
+                      for partition in self._partitions(length)]
+        for start in range(first, last): # start of span
+            cell = 0
+            for left_offset, right_offset in partitions:
+                left = cells[left_offset + start] & left_mask
+                if not left:
+                    continue
+                right = cells[right_offset + start] & right_mask
+                if not right:
+                    continue
+                found = produced.get((left, right))
+                if found is None:
+                    found = produced[left, right] = self._pair_variables(left, right)
+                cell |= found
+            if start and start + length < len_string:
+                cells[row + start] = cell & inner_mask
+            else:
+                cells[row + start] = cell & self.span_mask(start, length, len_string)
+
+    def _fill_sparse_bitset(self, cells, offsets, len_string, produced):
+        """
+        Fill the spans of two or more tokens of a sparse bitset table, only
+        visiting partitions whose left half is a non-empty cell. Returns the
+        lists of spans made by `_fill_sparse_row`.
+        """
+        # spans[start] lists the (length, mask) of each non-empty cell
+        # starting at start, shortest first
+        spans = [[(1, cells[start])] if start in cells else [] \
+                 for start in range(0, len_string)]
+        for length in range(2, len_string+1): # length of span
+            self._fill_sparse_row(cells, offsets, spans, len_string, length, 0,
+                                  len_string-length+1, produced)
+        return spans
+
+    def _fill_sparse_row(self, cells, offsets, spans, len_string, length, first,
+                         last, produced):
+        """
+        Fill the cells of a sparse bitset table for the spans of `length`
+        tokens that start at first..last-1. spans[start] lists the (length,
+        mask) of each non-empty cell starting at start, shortest first; it
+        must hold every shorter cell and no longer one, and the non-empty
+        cells filled here are added to it.
+        """
+        partitions = self._partitions(length)
+        if not partitions:
+            return
+        get = cells.get
+        left_mask = self.left_mask
+        right_mask = self.right_mask
+        row = offsets[length-1]
+        inner_mask = self._length_mask(length) & self.corner_masks[False, False]
+        # a left half shorter than the partitions is already empty of
+        # left children, since its cell only holds variables of its length
+        highest = partitions[-1]
+        for start in range(first, last): # start of span
+            cell = 0
+            for partition, left in spans[start]:
+                if partition > highest:
+                    break
+                left &= left_mask
+                if not left:
+                    continue
+                right = get(offsets[length-partition-1] + start+partition, 0) & right_mask
+                if not right:
+                    continue
+                found = produced.get((left, right))
+                if found is None:
+                    found = produced[left, right] = self._pair_variables(left, right)
+                cell |= found
+            if not cell:
+                continue
+            if start and start + length < len_string:
+                cell &= inner_mask
+            else:
+                cell &= self.span_mask(start, length, len_string)
+            if cell:
+                cells[row + start] = cell
+                spans[start].append((length, cell))
+
+    def parse_state(self, string):
+        """
+        Recognise a string of terminals with the sparse bitset engine and
+        return a CYKParseState that `reparse` can update after an edit. This
+        is `reparse` inserting the whole string into an empty one.
+        """
+        empty = CYKParseState('', CYKTable('', sparse=True, empty=0), False, spans=[])
+        return self.reparse(empty, 0, 0, string)
+
+    def reparse(self, state, offset, deleted, inserted):
+        """
+        Apply an edit to the string of a CYKParseState: remove `deleted`
+        tokens at `offset` and put the tokens of `inserted` in their place
+        (see `apply_edit`). Returns a new CYKParseState, equal to the one
+        `parse_state` gives for the edited string. The non-empty cells whose
+        spans end before the edit or start after it are moved from the old
+        table, so only the spans that overlap the edit are filled again.
+        """
+        string, inserted = apply_edit(state.string, offset, deleted, inserted)
+        if state.table is None:
+            # the old string had an invalid symbol, which may have been deleted
+            return self.parse_state(string)
+        terminal_masks = self.terminal_masks
+        if not all(symbol in terminal_masks for symbol in inserted):
+            return CYKParseState(string, None, False)
+        len_string = len(string)
+        table = CYKTable(string, sparse=True, empty=0)
+        cells = table.cells
+        offsets = table.offsets
+        # the edited tokens are string[offset:end], and the tokens after them
+        # have moved `shift` places from where they were in the old string
+        end = offset + len(inserted)
+        shift = len(inserted) - deleted
+        # a span that now starts at 0 or ends at the end of the string, or no
+        # longer does, may keep different variables (see `span_mask`), so
+        # those spans next to the edit are filled again
+        ends_moved = (offset == len(state.string)) != (offset == len_string)
+        starts_moved = (offset + deleted == 0) != (end == 0)
+        # the spans of each length that start at firsts[length] up to
+        # afters[length] overlap the edit, and are filled again
+        firsts = [0] * (len_string + 1)
+        afters = [0] * (len_string + 1)
+        for length in range(1, len_string+1): # length of span
+            last = len_string - length + 1
+            first = min(max(offset - length + 1, 0), last)
+            if ends_moved and 0 <= offset - length < first:
+                first = offset - length
+            after = max(end, first)
+            if starts_moved and after == end:
+                after += 1
+            firsts[length] = first
+            afters[length] = min(after, last)
+        # the non-empty cells of the old table that are kept, by length
+        kept = [[] for _ in range(0, len_string+1)]
+        for start, old_spans in enumerate(state.spans):
+            if start < offset:
+                for length, cell in old_spans:
+                    # firsts only gets lower as spans get longer
+                    if length > len_string or start >= firsts[length]:
+                        break
+                    kept[length].append((start, cell))
+            elif start >= offset + deleted:
+                for length, cell in old_spans:
+                    if start + shift >= afters[length]:
+                        kept[length].append((start + shift, cell))
+        spans = [[] for _ in range(0, len_string)]
+        produced = state.produced
+        for length in range(1, len_string+1): # length of span
+            row = offsets[length-1]
+            for start, cell in kept[length]:
+                cells[row + start] = cell
+                spans[start].append((length, cell))
+            if length > 1:
+                self._fill_sparse_row(cells, offsets, spans, len_string, length,
+                                      firsts[length], afters[length], produced)
+                continue
+            for start in range(firsts[1], afters[1]):
+                cell = terminal_masks[string[start]] & self.span_mask(start, 1, len_string)
+                if cell:
+                    cells[start] = cell
+                    spans[start].append((1, cell))
+        return CYKParseState(string, table, self._state_accepts(table, len_string),
+                             produced, spans)
+
+    def _state_accepts(self, table, len_string):
+        """
+        Returns True if the start symbol is in the top cell of a bitset table
+        """
+        return table is not None and len_string > 0 and \
+            bool(table.get(len_string-1, 0) & self.variable_bits[self.start_symbol])
+
+    def _pair_variables(self, left, right):
+        """
+        Return the mask of the variables A with a rule A -> B C where B is in
+        the left mask and C is in the right mask
+        """
+        if self.stats is not None:
+            return self._count_pair_variables(left, right)
+        found = 0
+        lefts = left
+        while lefts:
+            left_bit = lefts & -lefts
+            lefts ^= left_bit
+            rights = right & self.rights_of[left_bit]
+            while rights:
+                right_bit = rights & -rights
+                rights ^= right_bit
+                found |= self.pair_masks[left_bit, right_bit]
+        return found
+
+    def _count_pair_variables(self, left, right):
+        """
+        `_pair_variables`, adding the (B, C) pairs it checks and the pairs
+        that some rule A -> B C matches to the parser's stats
+        """
+        found = 0
+        checks = matches = 0
+        lefts = left
+        while lefts:
+            left_bit = lefts & -lefts
+            lefts ^= left_bit
+            rights = right & self.rights_of[left_bit]
+            while rights:
+                right_bit = rights & -rights
+                rights ^= right_bit
+                checks += 1
+                mask = self.pair_masks[left_bit, right_bit]
+                if mask:
+                    matches += 1
+                    found |= mask
+        self.stats.add('rule_checks', checks)
+        self.stats.add('rule_matches', matches)
+        return found
+
+    def _table_accepts(self, table, len_string):
+        """Returns True if the start symbol is in the top cell of the table"""
+        # Empty string will cause an index error so check that length of string (n) > 0
+        return len_string > 0 and self.start_symbol in table[len_string-1, 0]
+
+    def _recognition_table(self, string):
+        """
+        Fill a CYKTable of variables for the string and return it, or return
+        None if the string contains a symbol with no unit production
+        """
+        table = CYKTable(string)
+        # Fill the first row of the matrix with the variables
+        # that could have created the terminal at that position
+        # in the string. All the terminals are stored in the
+        # dictionary `unit_productions` along with the list of
+        # terminals that could create them, so just add this
+        # list to the table.
+        len_string = len(string)
+        for start in range(0, len_string):
+            # Reject the string if it contains a symbol for which there is no unit production
+            if string[start] not in self.unit_productions:
+                return None
+            table[0, start] = self.unit_productions[string[start]]
+        # Find the rules that could have generated each substring
+        # and add them to the table.
+        for length in range(2, len_string+1): # length of span
+            for start in range(0, len_string-length+1): # start of span
+                for partition in range(1, length-1+1): # partition of span
+                    for lhs, rhs in self.nonterminal_rules:
+                        if rhs[0] in table[partition-1, start] and \
                             rhs[1] in table[(length-partition)-1,
-                                            start+partition]: # don't decrement
+                                            start+partition] and \
+                            lhs not in table[length-1, start]: # don't decrement
                             table[length-1, start].append(lhs)
+        return table
+
+    def viterbi(self, string, beam=None, threshold=None):
+        """
+        Return the (log probability, tree) of the most likely derivation of a
+        string of terminals using the rule weights, or None if the string is
+        not in the language. Each cell keeps only the best derivation of each
+        variable. With `beam`, only the `beam` most likely variables are kept
+        in each cell, and with `threshold`, variables more than `threshold`
+        (in natural log units) less likely than the best in the cell are
+        dropped, which bounds the work for each span. Pruning may reject
+        strings that are in the language, or return a tree that is not the
+        most likely one.
+        """
+        len_string = len(string)
+        if not len_string:
+            return None
+        weight = lambda lhs, rhs: math.log(self.rule_weights.get((lhs, rhs), 1.0))
+        # scores[lhs, rhs] for A -> B C is indexed as by_left[B] = [(C, A, log weight)]
+        by_left = defaultdict(list)
+        for lhs, (left, right) in self.nonterminal_rules:
+            by_left[left].append((right, lhs, weight(lhs, (left, right))))
+        table = CYKTable(string, empty=None)
+        # each cell maps a variable to (log probability, partition, left, right)
+        for start in range(0, len_string):
+            if string[start] not in self.unit_productions:
+                return None
+            table[0, start] = self._prune(
+                {lhs: (weight(lhs, (string[start],)), None, None, None) \
+                 for lhs in self.unit_productions[string[start]]},
+                beam, threshold)
+        for length in range(2, len_string+1): # length of span
+            for start in range(0, len_string-length+1): # start of span
+                cell = {}
+                for partition in range(1, length): # partition of span
+                    left_cell = table.get(partition-1, start)
+                    right_cell = table.get(length-partition-1, start+partition)
+                    if not left_cell or not right_cell:
+                        continue
+                    for left, left_entry in left_cell.items():
+                        for right, lhs, score in by_left.get(left, ()):
+                            right_entry = right_cell.get(right)
+                            if right_entry is None:
+                                continue
+                            score += left_entry[0] + right_entry[0]
+                            if lhs not in cell or score > cell[lhs][0]:
+                                cell[lhs] = (score, partition, left, right)
+                table.set(length-1, start, self._prune(cell, beam, threshold))
+        root = table[len_string-1, 0].get(self.start_symbol)
+        if root is None:
+            return None
+        # rebuild the tree from the backpointers without recursion
+        tree = []
+        pending = [(self.start_symbol, 0, len_string, tree)]
+        while pending:
+            symbol, start, length, output = pending.pop()
+            _, partition, left, right = table[length-1, start][symbol]
+            if partition is None:
+                output.extend([symbol, string[start], None])
+                continue
+            left_output, right_output = [], []
+            output.extend([symbol, left_output, right_output])
+            pending.append((left, start, partition, left_output))
+            pending.append((right, start+partition, length-partition, right_output))
+        return root[0], tree
+
+    def _prune(self, cell, beam, threshold):
+        """Apply beam and threshold pruning to a Viterbi cell"""
+        if not cell or (beam is None and threshold is None):
+            return cell
+        ranked = sorted(cell.items(), key=lambda item: item[1][0], reverse=True)
+        if threshold is not None:
+            cutoff = ranked[0][1][0] - threshold
+            ranked = [item for item in ranked if item[1][0] >= cutoff]
+        if beam is not None:
+            ranked = ranked[:beam]
+        return dict(ranked)
+
+    def parse_viterbi(self, infile, beam=None, threshold=None, tree_format='list'):
+        """
+        Like `parse`, but prints only the most likely tree using the rule
+        weights, with optional beam and threshold pruning (see `viterbi`)
+        """
+        string, valid = read_input(infile, self.unit_productions)
+        if not valid:
+            print(self.error_invalid_symbol)
+            sys.exit(0)
+        best = self.viterbi(string, beam, threshold)
+        if best is None:
+            return False
+        self.write_tree(best[1], tree_format=tree_format)
+        print()
+        return True
+
+    def forest(self, string):
+        """
+        Return the ParseForest of every derivation of a string of terminals,
+        or None if the string is not in the language
+        """
+        table = self._tree_table(string)
+        if table is None or not len(string) or \
+            not table[len(string)-1, 0] & self.variable_bits[self.start_symbol]:
+            return None
+        return ParseForest(self, string, table)
+
+    def parse(self, infile, tree_format='list'):
+        """
+        Reads and formats the string from the input file, initialises a table
+        for parsing the string, and parses the string using the CYK Algorithm:
+
+        Wikipedia:
+        for each s = 1 to n
+          for each unit production Rv -> as
+              set P[1,s,v] = true -> i.e. add Rv to table[1, s]
+        for each l = 2 to n -- Length of span
+          for each s = 1 to n-l+1 -- Start of span
+              for each p = 1 to l-1 -- Partition of span
+                  for each production Ra -> Rb Rc
+                      if P[p,s,b] and P[l-p,s+p,c] then set P[l,s,a] = true
+        if P[n,1,1] is true then
+          accept the string
+        else reject the string
+
+        Instead of using a three dimensional matrix, the variable Rk is stored
+        at position P[i,j] iff P[i,j,k] is true.
+
+        The table is filled with bitmasks of variables (see `bitset_table`),
+        and the tree is then rebuilt from the table by `derivation`, which
+        stores its nodes in a CYKNodeArena rather than allocating a CYKNode
+        for every entry of the table.
+
+        For ambiguous grammars only one tree is printed (see `forest`). The
+        tree is written as it is walked, in the format given by `tree_format`
+        (see `write_tree`).
+        """
+        stats = self.stats
+        if stats is None:
+            string, valid = read_input(infile, self.unit_productions)
+        else:
+            # read and validate in separate passes, so that each can be timed
+            with stats.phase('read'):
+                string = read_input(infile)[0]
+            with stats.phase('validate'):
+                valid = set(string).issubset(self.unit_productions)
+        # check if input contains only terminals from the grammar
+        if not valid:
+            print(self.error_invalid_symbol)
+            sys.exit(0)
+
+        arena, root = self.derivation(string)
+        if root is None:
+            return False
+        tree = arena.node(root)
+        if self.cnf is not None:
+            with phase(stats, 'tree'):
+                tree = self.cnf.restore(self._generate_tree(tree))
+        with phase(stats, 'output'):
+            self.write_tree(tree, tree_format=tree_format)
+            print()
+        return True
+
+    def derivation(self, string):
+        """
+        Return a CYKNodeArena holding the tree printed by `parse` and the
+        index of its root, or (None, None) if the string is not in the
+        language. The table is filled by the bitset engine, and only the nodes
+        of the tree are added to the arena. For each node, the derivation
+        chosen is the first partition, and then the first rule in the grammar
+        file, whose children are in the table.
+        """
+        with phase(self.stats, 'fill'):
+            table = self._tree_table(string)
+        len_string = len(string)
+        if table is None or not len_string or \
+            not table[len_string-1, 0] & self.variable_bits[self.start_symbol]:
+            return None, None
+        with phase(self.stats, 'tree'):
+            arena, root = self._derive(string, table)
+        if self.stats is not None:
+            self.stats.add('nodes', len(arena))
+        return arena, root
+
+    def _derive(self, string, table):
+        """
+        Add the tree chosen by `derivation` from a filled bitset table that
+        accepts the string to a new CYKNodeArena, and return the arena and
+        the index of its root
+        """
+        len_string = len(string)
+        bits = self.variable_bits
+        arena = CYKNodeArena()
+        root = arena.add(self.start_symbol, 0, len_string)
+        pending = [root]
+        while pending:
+            index = pending.pop()
+            symbol = arena.symbol(index)
+            start = arena.starts[index]
+            length = arena.lengths[index]
+            if length == 1:
+                # the unit production's terminal is the only child
+                arena.lefts[index] = arena.add(string[start], start, 1)
+                continue
+            for partition in range(1, length): # partition of span
+                left_cell = table.get(partition-1, start)
+                right_cell = table.get(length-partition-1, start+partition)
+                rule = next(((left, right) for left, right in self.rules_of.get(symbol, []) \
+                             if left_cell & bits[left] and right_cell & bits[right]), None)
+                if rule is not None:
+                    break
+            left = arena.add(rule[0], start, partition)
+            right = arena.add(rule[1], start+partition, length-partition)
+            arena.lefts[index] = left
+            arena.rights[index] = right
+            pending.append(right)
+            pending.append(left)
+        return arena, root
+
+
+class CYKParseState:
+    """
+    The result of parsing a string with CYKParser.parse_state or
+    CYKParser.reparse. `table` is the sparse bitset table of the string, or
+    None if the string contains a symbol with no unit production, and
+    `accepted` is True if the string is in the language. spans[start] lists
+    the (length, mask) of each non-empty cell starting at start, shortest
+    first. `produced` caches the variables produced by each pair of cells,
+    and is shared with the states made from this one.
+    """
+
+    def __init__(self, string, table, accepted, produced=None, spans=None):
+        self.string = string
+        self.table = table
+        self.accepted = accepted
+        self.produced = {} if produced is None else produced
+        self.spans = spans
+
+
+class ParseForest:
+    """
+    A shared packed parse forest of every derivation of a string, built from
+    a CYKParser bitset table. Each node is a (symbol, start, length) span,
+    stored once however many derivations use it, and `alternatives[node]` is
+    the list of ways it is derived: the terminal for spans of length one,
+    otherwise (left child, right child) pairs of nodes. Only nodes reachable
+    from the root are stored, so memory is polynomial in the length of the
+    string even when the number of trees is exponential.
+
+    Trees use the nested list format printed by CYKParser.parse.
+    """
+
+    def __init__(self, parser, string, table):
+        self.string = string
+        self.root = (parser.start_symbol, 0, len(string))
+        self.alternatives = {}
+        bits = parser.variable_bits
+        pending = [self.root]
+        while pending:
+            node = pending.pop()
+            if node in self.alternatives:
+                continue
+            symbol, start, length = node
+            if length == 1:
+                self.alternatives[node] = [string[start]]
+                continue
+            derivations = []
+            for partition in range(1, length): # partition of span
+                left_cell = table[partition-1, start]
+                right_cell = table[length-partition-1, start+partition]
+                for left, right in parser.rules_of.get(symbol, []):
+                    if left_cell & bits[left] and right_cell & bits[right]:
+                        children = ((left, start, partition),
+                                    (right, start+partition, length-partition))
+                        derivations.append(children)
+                        pending.extend(children)
+            self.alternatives[node] = derivations
+        self._counts = None
+
+    def count(self, node=None):
+        """
+        Return the number of trees for a node (the root by default), counted
+        from the shared nodes without building any trees
+        """
+        if self._counts is None:
+            counts = {}
+            # children are shorter than their parents, so count short spans first
+            for current in sorted(self.alternatives, key=lambda node: node[2]):
+                if current[2] == 1:
+                    counts[current] = 1
+                else:
+                    counts[current] = sum(counts[left] * counts[right] \
+                                          for left, right in self.alternatives[current])
+            self._counts = counts
+        return self._counts[self.root if node is None else node]
+
+    def tree(self, index):
+        """
+        Return tree number `index` (counting from 0) without building any
+        other tree. Trees are numbered by their first alternative that differs,
+        in the order the alternatives are stored.
+        """
+        if not 0 <= index < self.count():
+            raise IndexError("Tree index out of range: {index}".format(index=index))
+        # each entry is a node, the index of the tree wanted from it, and the
+        # list that its subtree will be written into
+        result = []
+        pending = [(self.root, index, result)]
+        while pending:
+            node, index, output = pending.pop()
+            symbol, start, length = node
+            if length == 1:
+                output.extend([symbol, self.string[start], None])
+                continue
+            for left, right in self.alternatives[node]:
+                trees = self.count(left) * self.count(right)
+                if index < trees:
+                    break
+                index -= trees
+            right_index, left_index = divmod(index, self.count(left))
+            left_output, right_output = [], []
+            output.extend([symbol, left_output, right_output])
+            pending.append((left, left_index, left_output))
+            pending.append((right, right_index, right_output))
+        return result
+
+    def trees(self):
+        """Yield every tree, one at a time"""
+        for index in range(0, self.count()):
+            yield self.tree(index)
+
+
+class CYKMatrixEngine:
+    """
+    A CYK recogniser that fills the table with boolean matrix products, using
+    Okhotin's simplification of Valiant's reduction of CYK to matrix
+    multiplication. The chart is indexed by the positions between tokens:
+    chart[v, i, j] is True if variable v produces tokens i to j-1. For each
+    pair (B, C) that is the right hand side of a rule, `pairs[p, i, j]`
+    collects whether some k between i and j has B in chart[i, k] and C in
+    chart[k, j].
+
+    `_complete` fills a rectangle of the chart by splitting it in four and
+    adding the products of the known rectangles between them to `pairs`, so
+    most of the work is done by a few large matrix products instead of one
+    small step per cell. Rectangles of at most LEAF rows and columns are
+    filled one diagonal at a time with vectorized operations. Each cell keeps
+    only the variables allowed by the parser's `span_mask`, like the bitset
+    engine.
+    """
+
+    LEAF = 32
+
+    def __init__(self, parser):
+        if numpy is None:
+            raise ImportError("CYKMatrixEngine requires NumPy")
+        self.num_variables = len(parser.variables)
+        self.terminal_rows = {}
+        for terminal, mask in parser.terminal_masks.items():
+            self.terminal_rows[terminal] = numpy.array(
+                [bool(mask & (1 << index)) for index in range(self.num_variables)])
+        pairs = sorted(parser.pair_masks.items())
+        self.lefts = numpy.array([left.bit_length() - 1 for (left, _), _ in pairs],
+                                 dtype=numpy.intp)
+        self.rights = numpy.array([right.bit_length() - 1 for (_, right), _ in pairs],
+                                  dtype=numpy.intp)
+        # rules[p, v] is 1 if variable v produces the pair p
+        self.rules = numpy.array([[float(bool(mask & (1 << index))) \
+                                   for index in range(self.num_variables)] \
+                                  for _, mask in pairs], dtype=numpy.float32) \
+            .reshape(len(pairs), self.num_variables)
+        # the masks of `span_mask` as rows of booleans, indexed by length and
+        # by whether a span is at the start and at the end of the string
+        rows = lambda mask: [bool(mask & (1 << index)) \
+                             for index in range(self.num_variables)]
+        self.length_rows = numpy.array([rows(mask) for mask in parser.length_masks],
+                                       dtype=bool)
+        self.corner_rows = numpy.array([[rows(parser.corner_masks[at_start, at_end]) \
+                                         for at_end in (False, True)] \
+                                        for at_start in (False, True)], dtype=bool)
+        self.chart_ = None
+        self.pairs = None
+
+    def chart(self, string):
+        """
+        Return the chart for a string, or None if it contains a symbol with no
+        unit production
+        """
+        positions = len(string) + 1
+        self.chart_ = numpy.zeros((self.num_variables, positions, positions),
+                                  dtype=bool)
+        self.pairs = numpy.zeros((len(self.rules), positions, positions),
+                                 dtype=bool)
+        for start in range(0, len(string)):
+            if string[start] not in self.terminal_rows:
+                return None
+        for start in range(0, len(string)):
+            self.chart_[:, start, start+1] = self.terminal_rows[string[start]] & \
+                self._allowed(numpy.array([start]), numpy.array([start+1]))[0]
+        if len(self.rules):
+            self._compute(0, positions)
+        chart, self.chart_, self.pairs = self.chart_, None, None
+        return chart
+
+    def _allowed(self, starts, ends):
+        """
+        Return the rows of the variables that may be kept in the cells from
+        each of `starts` to each of `ends`
+        """
+        lengths = numpy.minimum(ends - starts, len(self.length_rows) - 1)
+        at_start = (starts == 0).astype(numpy.intp)
+        at_end = (ends == self.chart_.shape[1] - 1).astype(numpy.intp)
+        return self.length_rows[lengths] & self.corner_rows[at_start, at_end]
+
+    def _compute(self, low, high):
+        """Fill every cell of the chart between positions low..high-1"""
+        if high - low < 2:
+            return
+        middle = (low + high) // 2
+        self._compute(low, middle)
+        self._compute(middle, high)
+        self._complete(low, middle, middle, high)
 
-        # If the start symbol is in the last cell then return True
-        # Empty string will cause an index error so check that length of string (n) > 0
-        if len_string > 0 and self.start_symbol in table[len_string-1, 0]:
-            print(table)
-            return True
-        return False
+    def _product(self, rows, inner, columns):
+        """
+        Add to `pairs` over rows x columns the pairs produced by splitting at
+        a position in inner
+        """
+        if rows[0] == rows[1] or inner[0] == inner[1] or columns[0] == columns[1]:
+            return
+        chart = self.chart_
+        left = chart[self.lefts, rows[0]:rows[1], inner[0]:inner[1]]
+        right = chart[self.rights, inner[0]:inner[1], columns[0]:columns[1]]
+        if not left.any() or not right.any():
+            return
+        products = numpy.matmul(left.astype(numpy.float32),
+                                right.astype(numpy.float32))
+        self.pairs[:, rows[0]:rows[1], columns[0]:columns[1]] |= products > 0
 
-    def parse(self, infile):
+    def _complete(self, low, middle, low2, high):
         """
-        Reads and formats the string from the input file, initialises a table
-        for parsing the string, and parses the string using the CYK Algorithm:
+        Fill the cells with a start in low..middle-1 and an end in
+        low2..high-1. Every cell inside either range must already be filled,
+        and `pairs` must hold the pairs split at positions middle..low2-1.
+        """
+        if middle - low <= self.LEAF and high - low2 <= self.LEAF:
+            self._leaf(low, middle, low2, high)
+            return
+        split = (low + middle) // 2
+        split2 = (low2 + high) // 2
+        rows, rows2 = (low, split), (split, middle)
+        columns, columns2 = (low2, split2), (split2, high)
+        self._complete(split, middle, low2, split2)
+        self._product(rows, rows2, columns)
+        self._complete(low, split, low2, split2)
+        self._product(rows2, columns, columns2)
+        self._complete(split, middle, split2, high)
+        self._product(rows, rows2, columns2)
+        self._product(rows, columns, columns2)
+        self._complete(low, split, split2, high)
 
-        Wikipedia:
-        for each s = 1 to n
-          for each unit production Rv -> as
-              set P[1,s,v] = true -> i.e. add Rv to table[1, s]
-        for each l = 2 to n -- Length of span
-          for each s = 1 to n-l+1 -- Start of span
-              for each p = 1 to l-1 -- Partition of span
-                  for each production Ra -> Rb Rc
-                      if P[p,s,b] and P[l-p,s+p,c] then set P[l,s,a] = true
-        if P[n,1,1] is true then
-          accept the string
-        else reject the string
+    def _leaf(self, low, middle, low2, high):
+        """
+        Fill a small rectangle of cells one diagonal at a time, starting from
+        the cell (middle-1, low2), whose dependencies are all outside it
+        """
+        chart = self.chart_
+        height, width = middle - low, high - low2
+        for distance in range(0, height + width - 1):
+            # cells (middle-1-up, low2+right) with up + right == distance
+            up = numpy.arange(max(0, distance - width + 1), min(distance, height - 1) + 1)
+            right = distance - up
+            starts = middle - 1 - up
+            ends = low2 + right
+            if distance == 0 and middle == low2:
+                # the terminal at this position has already been filled in
+                continue
+            found = self.pairs[:, starts, ends]
+            if distance:
+                # split points between the start and the end of each cell,
+                # skipping the positions middle..low2-1 already in `pairs`
+                offsets = numpy.arange(distance)[None, :]
+                splits = numpy.where(offsets < up[:, None],
+                                     starts[:, None] + 1 + offsets,
+                                     low2 + offsets - up[:, None])
+                left = chart[:, starts[:, None], splits][self.lefts]
+                right_cells = chart[:, splits, ends[:, None]][self.rights]
+                found = found | (left & right_cells).any(axis=2)
+            produced = self.rules.T @ found.astype(numpy.float32)
+            chart[:, starts, ends] = (produced > 0) & self._allowed(starts, ends).T
 
-        Instead of using a three dimensional matrix, the variable Rk is stored
-        at position P[i,j] iff P[i,j,k] is true.
 
-        To allow the parse tree to be reconstructed from the table, instead of
-        storing variables in the table, we store binary tree nodes of class CYKNode
+class EarleyParser:
+    """
+    An Earley parser for any context free grammar in the format read by
+    read_grammar, which need not be in CNF. Items are (dotted rule, origin)
+    pairs, where the dotted rules of rule r are numbered from
+    `first_dotted[r]` with the dot at the start.
+
+    Nullable variables are handled as by Aycock and Horspool: when an item
+    predicts a nullable variable, the dot is also moved past it. Right
+    recursion is handled as by Leo: when a variable completes and the only
+    item waiting for it in its origin set has it as the last symbol, the
+    item at the top of that deterministic chain is added instead of every
+    item on the way, so that right recursive grammars, and so LL(1) and most
+    LR(1) grammars, are parsed in linear time.
+    """
+
+    def __init__(self, grammar_file, error_invalid_symbol=ERROR_INVALID_SYMBOL):
+        self.error_invalid_symbol = error_invalid_symbol
+        self.start_symbol, self.rules = read_grammar(grammar_file)
+        self.variables = set(lhs for lhs, _ in self.rules)
+        self.terminals = set(symbol for _, rhs in self.rules for symbol in rhs \
+                             if symbol not in self.variables)
+        self.first_dotted = []
+        # for each dotted rule: the symbol after the dot (None if complete),
+        # the LHS of its rule, and whether the dot is before the last symbol
+        self.next_symbol = []
+        self.lhs_of = []
+        self.is_last = []
+        self.predictions = defaultdict(list)
+        self.rules_of = defaultdict(list)
+        for index, (lhs, rhs) in enumerate(self.rules):
+            self.rules_of[lhs].append(index)
+            self.first_dotted.append(len(self.next_symbol))
+            self.predictions[lhs].append(len(self.next_symbol))
+            for dot in range(len(rhs) + 1):
+                self.next_symbol.append(rhs[dot] if dot < len(rhs) else None)
+                self.lhs_of.append(lhs)
+                self.is_last.append(dot == len(rhs) - 1)
+        # the first tree found for the empty string, for each nullable variable
+        self.empty_trees = {}
+        changed = True
+        while changed:
+            changed = False
+            for lhs, rhs in self.rules:
+                if lhs not in self.empty_trees and \
+                    all(symbol in self.empty_trees for symbol in rhs):
+                    self.empty_trees[lhs] = [lhs] + [self.empty_trees[symbol] \
+                                                     for symbol in rhs]
+                    changed = True
 
-        This does not handle ambiguous grammars.
+    def read_input(self, path):
+        """Read and strip all whitespace from input (see `read_input`)"""
+        return read_input(path)[0]
+
+    def is_valid(self, string):
         """
-        string = self.read_input(infile)
-        # check if input contains only terminals from the grammar
+        Returns True if all tokens in the string are terminals from the
+        grammar
+        """
+        return all(token in self.terminals for token in string)
+
+    def check(self, string):
+        """
+        Strip whitespace from a string and return ACCEPTED, REJECTED or the
+        invalid symbol error, without printing or exiting
+        """
+        string = WHITESPACE.sub('', string)
         if not self.is_valid(string):
+            return self.error_invalid_symbol
+        return ACCEPTED if self.recognise(string) else REJECTED
+
+    def recognise_tokens(self, tokens, lexer):
+        """
+        Returns True if a sequence of token ids from a Lexer is in the
+        language, with the token names as terminals
+        """
+        return self.recognise(lexer.symbols(tokens))
+
+    def recognise(self, string):
+        """Returns True if a string of terminals is in the language"""
+        return self.chart(string).accepts()
+
+    def chart(self, string):
+        """
+        Fill and return the EarleyChart for a string of terminals. The chart
+        stops at the first set that is empty, after which no item can be
+        added.
+        """
+        chart = EarleyChart(self, string)
+        seen, items, waiting = chart.seen, chart.items, chart.waiting
+        next_symbol, lhs_of = self.next_symbol, self.lhs_of
+        variables, predictions = self.variables, self.predictions
+        nullable = self.empty_trees
+        for dotted in predictions[self.start_symbol]:
+            chart.add(0, dotted, 0)
+        for position in range(len(string) + 1):
+            token = string[position] if position < len(string) else None
+            current = items[position]
+            current_seen = seen[position]
+            current_waiting = waiting[position]
+            completed = chart.completed[position]
+            predicted = set()
+            index = 0
+            while index < len(current):
+                dotted, origin = current[index]
+                index += 1
+                symbol = next_symbol[dotted]
+                if symbol is None:
+                    lhs = lhs_of[dotted]
+                    if (lhs, origin) in completed:
+                        continue
+                    completed.add((lhs, origin))
+                    # items waiting in this set for a nullable variable have
+                    # already moved past it when they predicted it
+                    if origin == position:
+                        continue
+                    top = chart.leo_item(origin, lhs)
+                    if top is not None:
+                        chart.leo_used[position].append((lhs, origin))
+                        items_to_add = (top,)
+                    else:
+                        items_to_add = [(waiter + 1, waiter_origin) for waiter, waiter_origin \
+                                        in waiting[origin].get(lhs, ())]
+                    for item in items_to_add:
+                        if item not in current_seen:
+                            current_seen.add(item)
+                            current.append(item)
+                elif symbol in variables:
+                    current_waiting.setdefault(symbol, []).append((dotted, origin))
+                    if symbol not in predicted:
+                        predicted.add(symbol)
+                        for prediction in predictions[symbol]:
+                            if (prediction, position) not in current_seen:
+                                current_seen.add((prediction, position))
+                                current.append((prediction, position))
+                    if symbol in nullable and (dotted + 1, origin) not in current_seen:
+                        current_seen.add((dotted + 1, origin))
+                        current.append((dotted + 1, origin))
+                elif symbol == token:
+                    chart.add(position + 1, dotted + 1, origin)
+            if token is not None and not items[position + 1]:
+                break
+        return chart
+
+    def derivation(self, string):
+        """
+        Return the tree of a string of terminals as nested lists of a symbol
+        followed by all of its children, or None if the string is not in the
+        language. A variable that derives the empty string has no children.
+        """
+        chart = self.chart(string)
+        if not chart.accepts():
+            return None
+        root = [self.start_symbol]
+        pending = [(root, self.start_symbol, 0, len(string))]
+        while pending:
+            node, symbol, start, end = pending.pop()
+            for child in chart.children(symbol, start, end):
+                if isinstance(child, tuple):
+                    subtree = [child[0]]
+                    node.append(subtree)
+                    pending.append((subtree,) + child)
+                else:
+                    node.append(child)
+        return root
+
+    def parse(self, infile, tree_format='list'):
+        """
+        Reads the string from the input file and prints its tree (see
+        `derivation` and `write_tree`). Returns True if the string is in
+        the language, otherwise it returns False.
+        """
+        string, valid = read_input(infile, self.terminals)
+        # check if input contains only terminals from the grammar
+        if not valid:
             print(self.error_invalid_symbol)
             sys.exit(0)
+        tree = self.derivation(string)
+        if tree is None:
+            return False
+        write_tree(tree, sys.stdout, tree_format)
+        print()
+        return True
 
-        table = CYKTable(string)
-        # Fill the first row of the matrix with the variables
-        # that could have created the terminal at that position
-        # in the string. All the terminals are stored in the
-        # dictionary `unit_productions` along with the list of
-        # terminals that could create them, so just add this
-        # list to the table.
-        len_string = len(string)
-        for start in range(0, len_string):
-            try:
-                table[0, start] = [CYKNode(symbol,
-                                           left=CYKNode(string[start])) \
-                                   for symbol in \
-                                   self.unit_productions[string[start]]]
-            # Reject the string if it contains a symbol for which there is no unit production
-            except KeyError:
-                return False
-        # Find the rules that could have generated each substring
-        # and add them to the table.
-        for length in range(2, len_string+1): # length of span
-            for start in range(0, len_string-length+1): # start of span
-                for partition in range(1, length-1+1): # partition of span
-                    for lhs, rhs in self.nonterminal_rules:
-                        # The right hand side of the rule will become
-                        # left and right children in the parse tree, if they
-                        # can be found in the right cells in the table
-                        left_child_symbol, right_child_symbol = rhs[0], rhs[1]
-                        # We will look in these cells to find the left and right
-                        # symbols from the right hand side of the rule
-                        search_left = table[partition-1, start]
-                        search_right = table[(length-partition)-1, start+partition]
-                        # Get the next item in search_left/search_right that
-                        # matches left_child_symbol/right_child_symbol (there
-                        # should only be one)
-                        left_child = next((node for node in search_left if \
-                            node.get_symbol() == left_child_symbol), None)
-                        right_child = next((node for node in search_right if \
-                            node.get_symbol() == right_child_symbol), None)
-                        # If we found a left child and right child in the right
-                        # places we add them as children of the variable on the
-                        # left hand side of the rule and enter the node representing
-                        # that rule into the table.
-                        if left_child and right_child:
-                            table[length-1, start].extend([CYKNode(lhs, left_child, right_child)])
-
-
-        # If the start symbol is in the last cell then return True
-        # Empty string will cause an index error so check that length of string (n) > 0
-        if len_string > 0 and self.start_symbol in [node.get_symbol() for node \
-            in table[len_string-1, 0]]:
-            start_node = next((node for node in table[len_string-1, 0] \
-                if node.get_symbol() == self.start_symbol), None)
-            print(self._generate_tree(start_node))
-            return True
-        return False
 
+class EarleyChart:
+    """
+    The Earley sets for a string. For each position, `items` holds the
+    items in the order they were added, `seen` the same items as a set,
+    `waiting` the items whose next symbol is each variable, and `completed`
+    the (variable, origin) pairs completed there. `leo` memoizes the top of
+    the deterministic chain for each (position, variable), and `leo_used`
+    records the completions that jumped to the top of one, whose skipped
+    items `expand` adds back when the chart is read.
+    """
+
+    def __init__(self, parser, string):
+        self.parser = parser
+        self.string = string
+        size = len(string) + 1
+        self.items = [[] for _ in range(size)]
+        self.seen = [set() for _ in range(size)]
+        self.waiting = [{} for _ in range(size)]
+        self.completed = [set() for _ in range(size)]
+        self.leo = [{} for _ in range(size)]
+        self.leo_used = [[] for _ in range(size)]
+        self.expanded = [False] * size
+
+    def add(self, position, dotted, origin):
+        """Add the item (dotted, origin) to the set at position"""
+        if (dotted, origin) not in self.seen[position]:
+            self.seen[position].add((dotted, origin))
+            self.items[position].append((dotted, origin))
+
+    def accepts(self):
+        """Returns True if the start symbol derives the whole string"""
+        end = len(self.string)
+        if not self.items[end]:
+            return False
+        self.expand(end)
+        return (self.parser.start_symbol, 0) in self.completed[end]
+
+    def leo_item(self, position, symbol):
+        """
+        Return the complete item at the top of the deterministic chain above
+        `symbol` completing from the set at `position`, or None if there is
+        no such chain. The chain is followed with an explicit stack, and
+        every step of it is memoized.
+        """
+        parser = self.parser
+        chain = []
+        top = None
+        while True:
+            memo = self.leo[position]
+            if symbol in memo:
+                top = memo[symbol]
+                break
+            waiters = self.waiting[position].get(symbol, ())
+            if len(waiters) != 1 or not parser.is_last[waiters[0][0]]:
+                memo[symbol] = None
+                break
+            waiter, origin = waiters[0]
+            # marks this step so that a cycle ends the chain
+            memo[symbol] = None
+            chain.append((position, symbol, (waiter + 1, origin)))
+            position, symbol = origin, parser.lhs_of[waiter]
+        for position, symbol, item in reversed(chain):
+            top = top if top is not None else item
+            self.leo[position][symbol] = top
+        return top
+
+    def expand(self, position):
+        """
+        Add the complete items skipped by Leo's chains in the set at
+        position to `seen` and `completed`
+        """
+        if self.expanded[position]:
+            return
+        self.expanded[position] = True
+        parser = self.parser
+        seen, completed = self.seen[position], self.completed[position]
+        for symbol, origin in self.leo_used[position]:
+            top = self.leo[origin][symbol]
+            while True:
+                waiter, waiter_origin = self.waiting[origin][symbol][0]
+                if (waiter + 1, waiter_origin) == top:
+                    break
+                symbol, origin = parser.lhs_of[waiter], waiter_origin
+                seen.add((waiter + 1, origin))
+                completed.add((symbol, origin))
+
+    def children(self, symbol, start, end):
+        """
+        Return the children of a node for `symbol` deriving string[start:end].
+        Each child is a terminal, the tree of a variable deriving the empty
+        string, or a (variable, start, end) tuple for a variable still to be
+        expanded.
+
+        A rule whose only nonempty child spans the whole of string[start:end]
+        is used only when no rule splits it (see `_split`), and then only on
+        the shortest such chain of variables down to one that does, so that
+        expanding the tree always ends, even for cyclic grammars.
+        """
+        parser = self.parser
+        if start == end:
+            return parser.empty_trees[symbol][1:]
+        self.expand(end)
+        seen = self.seen
+        # the variable each one on a chain was reached from, with its children
+        parents = {symbol: None}
+        queue = deque([symbol])
+        while queue:
+            variable = queue.popleft()
+            rules = [rule for rule in parser.rules_of[variable] \
+                     if (parser.first_dotted[rule] + len(parser.rules[rule][1]),
+                         start) in seen[end]]
+            for rule in rules:
+                children = self._split(rule, start, end)
+                if children is not None:
+                    while variable != symbol:
+                        variable, children = parents[variable]
+                    return children
+            for rule in rules:
+                rhs = parser.rules[rule][1]
+                first = parser.first_dotted[rule]
+                for dot, child in enumerate(rhs):
+                    if child in parents or (child, start) not in self.completed[end]:
+                        continue
+                    if all(other in parser.empty_trees for other in rhs[:dot] + rhs[dot+1:]) \
+                        and all((first + before, start) in seen[start] \
+                                for before in range(dot + 1)) \
+                        and all((first + after, start) in seen[end] \
+                                for after in range(dot + 1, len(rhs) + 1)):
+                        parents[child] = (variable, [
+                            (child, start, end) if index == dot else \
+                            parser.empty_trees[other] for index, other in enumerate(rhs)])
+                        queue.append(child)
+        raise ValueError("{symbol} does not derive {string}".format(
+            symbol=symbol, string=self.string[start:end]))
+
+    def _split(self, rule, start, end):
+        """
+        Return the children of `rule` deriving string[start:end] where no
+        child spans all of it, or None if there are none. The rule is walked
+        back from its last symbol with an explicit stack, and each child must
+        end where the item before it in the rule is in the chart.
+        """
+        parser = self.parser
+        rhs = parser.rules[rule][1]
+        first = parser.first_dotted[rule]
+        seen = self.seen
+        visited = set()
+        # each entry is a state to walk back from, or with a split, a child
+        # whose splits from that one on are still to be tried
+        pending = [(len(rhs), end, [], None)]
+        while pending:
+            dot, position, children, middle = pending.pop()
+            if middle is not None:
+                child = rhs[dot-1]
+                before = (first + dot - 1, start)
+                completed = self.completed[position]
+                while middle < position and not ((child, middle) in completed and \
+                    before in seen[middle] and not (middle == start and position == end)):
+                    middle += 1
+                if middle < position:
+                    pending.append((dot, position, children, middle + 1))
+                    pending.append((dot - 1, middle, children + [(child, middle, position)],
+                                    None))
+                continue
+            if dot == 0:
+                if position == start:
+                    return children[::-1]
+                continue
+            if (dot, position) in visited:
+                continue
+            visited.add((dot, position))
+            child = rhs[dot-1]
+            before = (first + dot - 1, start)
+            if child not in parser.variables:
+                if position > start and self.string[position-1] == child and \
+                    before in seen[position-1]:
+                    pending.append((dot - 1, position - 1, children + [child], None))
+                continue
+            self.expand(position)
+            if child in parser.empty_trees and before in seen[position]:
+                pending.append((dot - 1, position, children + [parser.empty_trees[child]],
+                                None))
+            # the leftmost split is tried first, and the empty string last
+            pending.append((dot, position, children, start))
+        return None
+
+
+def write_tree(tree, file, tree_format='list'):
+    """
+    Write a parse tree to a file as it is walked, without building the
+    whole output in memory. The tree may be a CYKNode, a CYKNodeView, or
+    nested lists of the form [symbol, left, right] with terminals as strings,
+    or more generally [symbol, children...] as made by CNFGrammar.restore.
+    tree_format 'list' writes the nested list format printed by
+    CYKParser.parse (the same as printing the nested lists), and 'json'
+    writes it as compact JSON arrays with null for a missing right child.
+    """
+    if tree_format == 'list':
+        quote, none, separator = repr, 'None', ', '
+    elif tree_format == 'json':
+        quote, none, separator = json.dumps, 'null', ','
+    else:
+        raise ValueError("Unknown tree format: {tree_format}".format(
+            tree_format=tree_format))
+    buffer = []
+    # the stack holds text to write, and subtrees to walk
+    pending = [(False, tree)]
+    while pending:
+        is_text, item = pending.pop()
+        if is_text:
+            buffer.append(item)
+        elif item is None:
+            buffer.append(none)
+        elif isinstance(item, str):
+            buffer.append(quote(item))
+        elif isinstance(item, list):
+            buffer.append('[' + quote(item[0]))
+            pending.append((True, ']'))
+            for child in reversed(item[1:]):
+                pending.extend([(False, child), (True, separator)])
+        elif item.is_terminal():
+            buffer.append(quote(item.get_symbol()))
+        else:
+            buffer.append('[' + quote(item.get_symbol()) + separator)
+            pending.extend([(True, ']'), (False, item.get_right()),
+                            (True, separator), (False, item.get_left())])
+        if len(buffer) >= 4096:
+            file.write(''.join(buffer))
+            buffer = []
+    file.write(''.join(buffer))
+
+
+def write_grammar_artifact(parser, path):
+    """
+    Write the rules of a CYKParser to a compiled grammar artifact. The file
+    holds ARTIFACT_MAGIC, the format version and the length of a JSON header,
+    then the header, which has the interned symbols, the start symbol and the
+    weighted rules, followed by the arrays it lists: the weights of the
+    weighted rules as doubles, then the (terminal, lhs) unit rules and
+    (lhs, left, right) binary rules in grammar file order as 32 bit symbol ids.
+
+    The other arrays hold the rule index built by `_index_rules`, so that
+    loading the artifact does not rebuild it: the minimum and maximum yields
+    of the variables and the `partition_bounds` as doubles (after the
+    weights), the variables in bit order, the terminals of `terminal_masks`,
+    the (left, right) bit numbers of `pair_masks` and the left bit numbers
+    of `rights_of`, and last the masks of each of these, then the length
+    masks, corner masks, `left_mask` and `right_mask`, as little endian
+    integers of `mask_bytes` bytes.
+    """
+    symbols = []
+    ids = {}
+    def intern(symbol):
+        if symbol not in ids:
+            ids[symbol] = len(symbols)
+            symbols.append(symbol)
+        return ids[symbol]
+    start = intern(parser.start_symbol)
+    unit_rules = array('i')
+    for terminal, lhses in parser.unit_productions.items():
+        for lhs in lhses:
+            unit_rules.extend([intern(terminal), intern(lhs)])
+    binary_rules = array('i')
+    for lhs, (left, right) in parser.nonterminal_rules:
+        binary_rules.extend([intern(lhs), intern(left), intern(right)])
+    weighted = [[intern(lhs)] + [intern(symbol) for symbol in rhs] \
+                for lhs, rhs in parser.rule_weights]
+    weights = array('d', parser.rule_weights.values())
+    variables = array('i', [intern(symbol) for symbol in parser.variables])
+    terminals = array('i', [intern(terminal) for terminal in parser.terminal_masks])
+    pairs = array('i')
+    for left, right in parser.pair_masks:
+        pairs.extend([left.bit_length() - 1, right.bit_length() - 1])
+    rights = array('i', [left.bit_length() - 1 for left in parser.rights_of])
+    yields = array('d', [parser.min_yield[symbol] for symbol in parser.variables] + \
+                   [parser.max_yield[symbol] for symbol in parser.variables] + \
+                   list(parser.partition_bounds))
+    width = max(1, (len(parser.variables) + 7) // 8)
+    masks = array('B')
+    for mask in list(parser.terminal_masks.values()) + list(parser.pair_masks.values()) + \
+        list(parser.rights_of.values()) + parser.length_masks + \
+        [parser.corner_masks[corner] for corner in \
+         ((True, True), (True, False), (False, True), (False, False))] + \
+        [parser.left_mask, parser.right_mask]:
+        masks.frombytes(mask.to_bytes(width, 'little'))
+    # the doubles come first, so that every array is aligned to its type
+    sections = [('weights', weights), ('yields', yields), ('unit_rules', unit_rules),
+                ('binary_rules', binary_rules), ('variables', variables),
+                ('terminals', terminals), ('pairs', pairs), ('rights', rights),
+                ('masks', masks)]
+    header = json.dumps({'symbols': symbols, 'start': start, 'weighted': weighted,
+                         'mask_bytes': width, 'length_masks': len(parser.length_masks),
+                         'arrays': [[name, values.typecode, len(values)] \
+                                    for name, values in sections]}).encode()
+    # pad the header so that every array starts on an 8 byte boundary
+    header += b' ' * (-(len(ARTIFACT_MAGIC) + 8 + len(header)) % 8)
+    temporary = temporary_path(path)
+    with open(temporary, 'wb') as file:
+        file.write(ARTIFACT_MAGIC)
+        file.write(struct.pack('<II', CYK_ARTIFACT_VERSION, len(header)))
+        file.write(header)
+        for name, values in sections:
+            file.write(values.tobytes())
+    os.replace(temporary, path)
+
+
+def compile_grammar(grammar_file, cache_dir=CACHE_DIR, cnf=False):
+    """
+    Return the path of the compiled artifact for a CYK grammar file in
+    `cache_dir`, named by a hash of the grammar file, compiling the grammar
+    first if it is not there or was written by another version. With `cnf`,
+    the grammar is converted to CNF first (see CNFGrammar).
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    version = "{version}{cnf}".format(version=CYK_ARTIFACT_VERSION,
+                                      cnf='-cnf' if cnf else '')
+    path = os.path.join(cache_dir, "{digest}.cyk".format(
+        digest=grammar_hash(grammar_file, version)))
+    if exists(path):
+        with open(path, 'rb') as file:
+            prefix = file.read(len(ARTIFACT_MAGIC) + 4)
+        if prefix == ARTIFACT_MAGIC + struct.pack('<I', CYK_ARTIFACT_VERSION):
+            return path
+    write_grammar_artifact(CYKParser(grammar_file, cnf=cnf), path)
+    return path
+
+
+def batch_inputs(sources, jsonl=False):
+    """
+    Yield (name, string) pairs for parse_batch from a list of sources. A
+    source may be a file, whose whole contents is one input, a directory,
+    whose files are read in sorted order, or '-' or an open file, which is
+    read as a stream with one input per line, skipping blank lines. With
+    jsonl=True each line of a stream is a JSON string, or an object with an
+    "input" and an optional "id"; otherwise inputs are named by their line
+    number. A JSON line that
+    cannot be read is yielded as a MalformedInput, whose result is its
+    error, so the rest of the batch is still checked.
+    """
+    for source in sources:
+        if source == '-' or hasattr(source, 'read'):
+            stream = sys.stdin if source == '-' else source
+            for number, line in enumerate(stream, 1):
+                if not line.strip():
+                    continue
+                if jsonl:
+                    try:
+                        item = json.loads(line)
+                    except ValueError as error:
+                        yield number, MalformedInput(error)
+                        continue
+                    name = number
+                    if isinstance(item, dict):
+                        name, item = item.get('id', number), item.get('input')
+                    if isinstance(item, str):
+                        yield name, item
+                    else:
+                        yield name, MalformedInput("no input string")
+                else:
+                    yield number, line
+        elif os.path.isdir(source):
+            for name in sorted(os.listdir(source)):
+                path = os.path.join(source, name)
+                if os.path.isfile(path):
+                    with open(path) as file:
+                        yield path, file.read()
+        else:
+            with open(source) as file:
+                yield source, file.read()
+
+
+class MalformedInput:
+    """An input of a batch that could not be read (see batch_inputs)"""
+    def __init__(self, reason):
+        self.reason = reason
+
+    def __str__(self):
+        return "Malformed input: {reason}".format(reason=self.reason)
+
+
+def check_input(parser, string):
+    """
+    Return parser.check(string), or the error of a MalformedInput
+    """
+    if isinstance(string, MalformedInput):
+        return str(string)
+    return parser.check(string)
+
+
+# the parser used by each process in a parse_batch pool
+_BATCH_PARSER = None
+# the parser used by each process in a CYKParser.parallel_table pool, and
+# the number, shared memory, cells, row offsets and pair cache of the table
+# it last filled
+_PARALLEL_PARSER = None
+_PARALLEL_FILL = None
+
+
+def _init_batch_worker(parser):
+    """Store the parser sent to a pool worker"""
+    global _BATCH_PARSER
+    _BATCH_PARSER = parser
+
+
+def _check_batch_item(item):
+    """Check one (name, string) input with the pool worker's parser"""
+    name, string = item
+    return name, check_input(_BATCH_PARSER, string)
+
+
+def _init_parallel_worker(parser):
+    """Store the parser sent to a CYKParser.parallel_table pool worker"""
+    global _PARALLEL_PARSER
+    _PARALLEL_PARSER = parser
+
+
+def _attach_parallel_table(number, name, words, len_string):
+    """
+    Attach a pool worker to the shared memory of the table being filled by
+    CYKParser.parallel_table, detaching it from the table it last filled
+    """
+    global _PARALLEL_FILL
+    if _PARALLEL_FILL is not None:
+        _, memory, cells, _, _ = _PARALLEL_FILL
+        cells.release()
+        memory.close()
+    memory = shared_memory.SharedMemory(name=name)
+    offsets = [row * len_string - row * (row - 1) // 2 for row in range(0, len_string)]
+    _PARALLEL_FILL = (number, memory, shared_cells(memory.buf, words), offsets, {})
+
+
+def _fill_parallel_block(block):
+    """
+    Fill one (number, name, words, len_string, length, first, last) block of
+    spans in the shared table
+    """
+    number, name, words, len_string, length, first, last = block
+    if _PARALLEL_FILL is None or _PARALLEL_FILL[0] != number:
+        _attach_parallel_table(number, name, words, len_string)
+    _, _, cells, offsets, produced = _PARALLEL_FILL
+    _PARALLEL_PARSER._fill_bitset_row(cells, offsets, len_string, length, first, last,
+                                      produced)
+
+
+def parse_batch(parser, inputs, processes=None, ordered=True, chunksize=64):
+    """
+    Check every (name, string) pair in `inputs` with `parser` and yield
+    (name, result) pairs, where result is ACCEPTED, REJECTED or the invalid
+    symbol error. The parser is sent once to each of `processes` worker
+    processes (one per CPU by default) and reused for all of its inputs. With
+    processes=1 the inputs are checked in this process. If `ordered` is
+    False, results are yielded as soon as they are ready.
+    """
+    if processes == 1:
+        for name, string in inputs:
+            yield name, check_input(parser, string)
+        return
+    with multiprocessing.Pool(processes, _init_batch_worker, (parser,)) as pool:
+        run = pool.imap if ordered else pool.imap_unordered
+        for result in run(_check_batch_item, inputs, chunksize):
+            yield result
+
+
+def main_batch(sources, cyk=False, grammar=None, ll1_grammar=None,
+               processes=None, ordered=True, jsonl=False, cnf=False,
+               earley_grammar=None, lalr_grammar=None):
+    """
+    Check every input from `sources` (see batch_inputs) and print one
+    result per input, either as `name<TAB>result` or, with jsonl=True, as a
+    JSON object with an "id" and a "result"
+    """
+    if cyk:
+        parser = CYKParser.from_grammar(grammar, cnf=cnf)
+    elif earley_grammar is not None:
+        parser = EarleyParser(earley_grammar)
+    elif lalr_grammar is not None:
+        parser = LALR1Parser.from_grammar(lalr_grammar)
+    elif ll1_grammar is not None:
+        parser = LL1Parser.from_grammar(ll1_grammar, compiled=True)
+    else:
+        parser = LL1Parser(compiled=True)
+    for name, result in parse_batch(parser, batch_inputs(sources, jsonl),
+                                    processes, ordered):
+        if jsonl:
+            print(json.dumps({'id': name, 'result': result}))
+        else:
+            print("{name}\t{result}".format(name=name, result=result))
+
+
+def parse_tree(parser, string):
+    """
+    Return the tree that `parser.parse` prints for a string of terminals,
+    or None if the string is not in the language. The parser may be a
+    CYKParser, an EarleyParser or an LALR1Parser.
+    """
+    if not isinstance(parser, CYKParser):
+        return parser.derivation(string)
+    arena, root = parser.derivation(string)
+    if root is None:
+        return None
+    tree = arena.node(root)
+    if parser.cnf is not None:
+        tree = parser.cnf.restore(parser._generate_tree(tree))
+    return tree
+
+
+class ParserServer:
+    """
+    Parses requests with parsers that are loaded once and kept between
+    requests, so a request does not pay for starting Python or loading its
+    grammar. Requests and responses are JSON objects, one per line. A
+    request has the "input" to parse, and may give
+      "id": copied to the response
+      "parser": 'll1' (the default), 'cyk', 'earley' or 'lalr'
+      "grammar": the grammar file, which only 'll1' may leave out to use G'
+      "cnf": with 'cyk', convert a grammar that is not in CNF
+      "tree": whether to return the tree of an accepted input (true by
+              default for the parsers that print one)
+      "tree_format": 'list' (the default) or 'json', see write_tree
+    Whitespace is stripped from the input. The response has the "id", the
+    "result" (ACCEPTED, REJECTED or the invalid symbol error), whether the
+    input was "accepted", and the "tree", written as text; a request that
+    cannot be parsed gets an "error" instead.
+
+    LL(1) parsers use the compiled engine and CYK parsers the compiled
+    grammar artifact (see CYKParser.from_grammar), except with "cnf", since
+    the artifact does not keep what CNFGrammar needs to print trees in
+    terms of the original grammar. Before each request the modification
+    time and size of its grammar file are checked, and a grammar that has
+    changed is loaded again. Each parser is loaded by one request at a
+    time, while requests for other parsers load theirs.
+
+    Each request is parsed in a thread pool, so requests from any number of
+    connections are read and answered while others are being parsed, and
+    responses are written as they are ready, which need not be in the order
+    of the requests. Parsers keep state while they parse, so each resident
+    parser parses one request at a time. Any error while answering a
+    request is returned as its "error".
+    """
+
+    KINDS = ('ll1', 'cyk', 'earley', 'lalr')
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+        # (kind, grammar, cnf) -> (signature of the grammar file, parser, lock)
+        self.parsers = {}
+        # (kind, grammar, cnf) -> the lock held while loading that parser, and
+        # the lock held while looking one up
+        self.load_locks = {}
+        self.loading = threading.Lock()
+
+    def _signature(self, grammar):
+        """Return the modification time and size of a grammar file"""
+        if grammar is None:
+            return None
+        info = os.stat(grammar)
+        return info.st_mtime_ns, info.st_size
+
+    def _load(self, kind, grammar, cnf):
+        """Create the parser for a request"""
+        if kind == 'll1':
+            if grammar is None:
+                parser = LL1Parser(compiled=True)
+            else:
+                parser = LL1Parser.from_grammar(grammar, self.cache_dir, compiled=True)
+            parser.compile()
+            return parser
+        if kind == 'cyk' and cnf:
+            return CYKParser(grammar, cnf=True)
+        if kind == 'cyk':
+            return CYKParser.from_grammar(grammar, self.cache_dir)
+        if kind == 'earley':
+            return EarleyParser(grammar)
+        return LALR1Parser.from_grammar(grammar, self.cache_dir)
+
+    def parser(self, kind='ll1', grammar=None, cnf=False):
+        """
+        Return the resident parser and its lock for a kind of parser and a
+        grammar file, loading it if it has not been loaded or its grammar
+        has changed since
+        """
+        if kind not in self.KINDS:
+            raise ValueError("Unknown parser: {kind}".format(kind=kind))
+        if grammar is None and kind != 'll1':
+            raise ValueError("The {kind} parser needs a grammar".format(kind=kind))
+        key = (kind, grammar, bool(cnf))
+        with self.loading:
+            load_lock = self.load_locks.setdefault(key, threading.Lock())
+        with load_lock:
+            signature = self._signature(grammar)
+            entry = self.parsers.get(key)
+            if entry is None or entry[0] != signature:
+                entry = (signature, self._load(kind, grammar, cnf), threading.Lock())
+                self.parsers[key] = entry
+        return entry[1], entry[2]
+
+    def handle(self, request):
+        """Parse one request (a dictionary) and return its response"""
+        response = {'id': request.get('id')}
+        if not isinstance(request.get('input'), str):
+            response['error'] = "The request has no input string"
+            return response
+        tree = None
+        try:
+            kind = request.get('parser', 'll1')
+            parser, lock = self.parser(kind, request.get('grammar'),
+                                       request.get('cnf', False))
+            string = WHITESPACE.sub('', request['input'])
+            with lock:
+                if not parser.is_valid(string):
+                    result = parser.error_invalid_symbol
+                elif kind != 'll1' and request.get('tree', True):
+                    tree = parse_tree(parser, string)
+                    result = REJECTED if tree is None else ACCEPTED
+                    if tree is not None:
+                        text = io.StringIO()
+                        write_tree(tree, text, request.get('tree_format', 'list'))
+                        tree = text.getvalue()
+                else:
+                    result = parser.check(string)
+        except Exception as error:
+            # a bad grammar may fail anywhere in loading it, and every
+            # request must still be answered
+            response['error'] = str(error) or type(error).__name__
+            return response
+        response['result'] = result
+        response['accepted'] = result == ACCEPTED
+        if tree is not None:
+            response['tree'] = tree
+        return response
+
+    def respond(self, line):
+        """Return the JSON response to one line of JSON"""
+        try:
+            request = json.loads(line)
+        except ValueError as error:
+            response = {'id': None, 'error': str(error)}
+        else:
+            if not isinstance(request, dict):
+                request = {'input': request}
+            response = self.handle(request)
+        return json.dumps(response)
+
+    async def _answer(self, line, write):
+        response = await asyncio.get_running_loop().run_in_executor(
+            None, self.respond, line)
+        write(response + '\n')
+
+    async def serve_lines(self, readline, write):
+        """
+        Answer requests read with `readline`, a coroutine function that
+        returns b'' or '' at the end of the input, writing each response
+        with `write` as it is ready. Returns when every request has been
+        answered.
+        """
+        pending = set()
+        while True:
+            line = await readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            task = asyncio.ensure_future(self._answer(line, write))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.gather(*pending)
+
+    async def _connection(self, reader, writer):
+        """Answer the requests from one client of the Unix socket"""
+        try:
+            await self.serve_lines(reader.readline,
+                                   lambda text: writer.write(text.encode()))
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def start_unix(self, path=SERVER_SOCKET):
+        """
+        Listen on a Unix socket at `path`, replacing a socket left there by
+        a server that has stopped, and return the asyncio server
+        """
+        if exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        return await asyncio.start_unix_server(self._connection, path)
+
+    async def serve_unix(self, path=SERVER_SOCKET):
+        """Answer requests on a Unix socket at `path` until cancelled"""
+        server = await self.start_unix(path)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if exists(path):
+                os.unlink(path)
+
+    async def serve_stdin(self, source=None, output=None):
+        """
+        Answer JSON lines read from `source` (stdin by default), writing the
+        responses to `output` (stdout by default), until the input ends
+        """
+        source = sys.stdin if source is None else source
+        output = sys.stdout if output is None else output
+        loop = asyncio.get_running_loop()
+        def write(text):
+            output.write(text)
+            output.flush()
+        await self.serve_lines(lambda: loop.run_in_executor(None, source.readline),
+                               write)
+
+
+def request_server(request, path=SERVER_SOCKET):
+    """
+    Send one request (a dictionary) to a ParserServer listening on a Unix
+    socket and return its response
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        client.sendall(json.dumps(request).encode() + b'\n')
+        client.shutdown(socket.SHUT_WR)
+        with client.makefile('rb') as reply:
+            line = reply.readline()
+    if not line:
+        raise ConnectionError("The server closed the connection without a response")
+    return json.loads(line)
+
+
+def main_client(input_file, path=SERVER_SOCKET, kind='ll1', grammar=None,
+                cnf=False, tree_format='list'):
+    """
+    Parse an input file with a ParserServer and print what main prints for
+    the same parser: the tree of an accepted input for the parsers that
+    print one, then the ACCEPTED or REJECTED message, or only the invalid
+    symbol error. The LL(1) stack trace is not printed, as with --compiled.
+    The grammar is sent as an absolute path, since the server may have been
+    started in another directory.
+    """
+    string = read_input(input_file)[0]
+    if grammar is not None:
+        grammar = os.path.abspath(grammar)
+    try:
+        response = request_server({'input': string, 'parser': kind, 'grammar': grammar,
+                                   'cnf': cnf, 'tree_format': tree_format}, path)
+    except OSError as error:
+        response = {'error': str(error)}
+    if 'error' in response:
+        print(response['error'], file=sys.stderr)
+        sys.exit(1)
+    if 'tree' in response:
+        print(response['tree'])
+    print(response['result'])
+
+
+class GrammarGenerator:
+    """
+    Generates random strings of a context free grammar for benchmarks.
+    `rules` maps each variable to a list of right hand sides (tuples of
+    symbols), and every symbol that is not a variable is a terminal.
+
+    `generate` expands a leftmost derivation, choosing at random among the
+    rules that can keep growing the string (those with a variable that
+    derives unboundedly long strings) until the target length or depth is
+    reached, and then closes every open variable with a rule of the least
+    height. The string is usually a little longer than the target, since the
+    open variables must still be closed. `near_valid` makes a few random
+    edits to a string, which usually takes it out of the language.
+    """
+
+    def __init__(self, rules, start, seed=None):
+        self.rules = rules
+        self.start = start
+        self.random = random.Random(seed)
+        self.terminals = sorted(set(symbol for rhses in rules.values() for rhs in rhses \
+                                    for symbol in rhs if symbol not in rules))
+        # the shortest string and the least height of a tree for each variable
+        self.min_length = {variable: math.inf for variable in rules}
+        self.height = {variable: math.inf for variable in rules}
+        changed = True
+        while changed:
+            changed = False
+            for variable, rhses in rules.items():
+                for rhs in rhses:
+                    length = sum(self._min_length(symbol) for symbol in rhs)
+                    height = 1 + max([self.height[symbol] for symbol in rhs \
+                                      if symbol in rules], default=0)
+                    if length < self.min_length[variable]:
+                        self.min_length[variable] = length
+                        changed = True
+                    if height < self.height[variable]:
+                        self.height[variable] = height
+                        changed = True
+        # a variable is unbounded if it can derive itself through productive rules
+        productive = lambda rhs: all(self._min_length(symbol) < math.inf for symbol in rhs)
+        reaches = {variable: set(symbol for rhs in rhses if productive(rhs) \
+                                 for symbol in rhs if symbol in rules) \
+                   for variable, rhses in rules.items()}
+        changed = True
+        while changed:
+            changed = False
+            for variable in rules:
+                reached = set(reaches[variable])
+                for symbol in reaches[variable]:
+                    reached |= reaches[symbol]
+                if reached != reaches[variable]:
+                    reaches[variable] = reached
+                    changed = True
+        unbounded = set(variable for variable in rules if variable in reaches[variable])
+        unbounded |= set(variable for variable in rules if reaches[variable] & unbounded)
+        self.closing = {}
+        self.growing = {}
+        for variable, rhses in rules.items():
+            usable = [rhs for rhs in rhses if productive(rhs)]
+            self.growing[variable] = [rhs for rhs in usable \
+                                      if any(symbol in unbounded for symbol in rhs)] or usable
+            self.closing[variable] = min(usable, default=None, key=lambda rhs: max(
+                [self.height[symbol] for symbol in rhs if symbol in rules], default=0))
+
+    def _min_length(self, symbol):
+        return self.min_length[symbol] if symbol in self.rules else 1
+
+    @classmethod
+    def from_grammar(cls, grammar_file, seed=None):
+        """Create a generator for the grammar in a grammar file"""
+        start, rules = read_grammar(grammar_file)
+        rhses = defaultdict(list)
+        for lhs, rhs in rules:
+            rhses[lhs].append(rhs)
+        return cls(dict(rhses), start, seed)
+
+    @classmethod
+    def from_ll1_table(cls, table=LL1TABLE, start=START, seed=None):
+        """
+        Create a generator for the grammar of an LL(1) table (by default the
+        table for G'), whose rules are the distinct entries of each row
+        """
+        rules = {}
+        for variable, row in table.items():
+            rules[variable] = sorted(set(tuple(entry) for entry in row.values()))
+        return cls(rules, start, seed)
+
+    def generate(self, length=None, depth=None):
+        """
+        Return a random string of the language as a list of terminals, at
+        least `length` terminals long if the grammar allows it, or with a
+        derivation tree about `depth` deep
+        """
+        if self.min_length[self.start] == math.inf:
+            raise ValueError("{start} derives no strings".format(start=self.start))
+        output = []
+        # the shortest string the symbols still on the stack can derive
+        pending = self.min_length[self.start]
+        stack = [(self.start, 0)]
+        while stack:
+            symbol, level = stack.pop()
+            if symbol not in self.rules:
+                output.append(symbol)
+                pending -= 1
+                continue
+            pending -= self.min_length[symbol]
+            if (length is not None and len(output) + pending < length) or \
+                (depth is not None and level < depth):
+                rhs = self.random.choice(self.growing[symbol])
+            else:
+                rhs = self.closing[symbol]
+            pending += sum(self._min_length(child) for child in rhs)
+            stack.extend((child, level + 1) for child in reversed(rhs))
+        return output
+
+    def near_valid(self, string, edits=1):
+        """
+        Return a copy of a list of terminals with `edits` random insertions,
+        deletions or substitutions of terminals
+        """
+        string = list(string)
+        for _ in range(0, edits):
+            position = self.random.randrange(0, len(string) + 1)
+            edit = self.random.choice(['insert', 'delete', 'substitute'])
+            if edit == 'insert' or position == len(string):
+                string.insert(position, self.random.choice(self.terminals))
+            elif edit == 'delete':
+                del string[position]
+            else:
+                string[position] = self.random.choice(self.terminals)
+        return string
+
+
+def write_grammar(rules, start, path):
+    """
+    Write the rules of a GrammarGenerator (a dict from each variable to a
+    list of right hand sides) as a grammar file, with the start symbol's
+    rules first
+    """
+    with open(path, 'w') as file:
+        for variable in [start] + sorted(set(rules) - set([start])):
+            file.write("{variable} -> {alternatives}\n".format(
+                variable=variable, alternatives=' | '.join(
+                    ' '.join(rhs) or EPSILON_SYMBOL for rhs in rules[variable])))
+
+
+def benchmark_engines(grammar_file=None, directory=None):
+    """
+    Return a list of (name, recognise) pairs for every engine that can
+    parse the grammar in `grammar_file`, or G' if it is None, where
+    recognise takes a list of terminals and returns True if it is in the
+    language. The LL(1) and LALR(1) engines are left out if the grammar is
+    not LL(1) or LALR(1), and a grammar that is not in CNF is converted for
+    the CYK engines. G' is written as a grammar file in `directory` for the
+    engines that need one.
+    """
+    engines = []
+    if grammar_file is None:
+        ll1 = LL1Parser()
+        generator = GrammarGenerator.from_ll1_table()
+        grammar_file = os.path.join(directory, 'grammar')
+        write_grammar(generator.rules, generator.start, grammar_file)
+    else:
+        try:
+            table, terminals, start = LL1Grammar(grammar_file).compile()
+            ll1 = LL1Parser(table=table, terminals=terminals, start=start)
+        except LL1ConflictError:
+            ll1 = None
+    if ll1 is not None:
+        compiled = ll1.compile()
+        engines.append(('ll1', lambda string: ll1.recognise(''.join(string))))
+        engines.append(('ll1-compiled', lambda string: compiled.recognise(''.join(string))))
+    try:
+        cyk = CYKParser(grammar_file)
+    except CNFError:
+        cyk = CYKParser(grammar_file, cnf=True)
+    engines.append(('cyk-sparse', lambda string: cyk.recognise_bitset(string)))
+    engines.append(('cyk-dense', lambda string: cyk.recognise_bitset(string, sparse=False)))
+    if numpy is not None:
+        engines.append(('cyk-numpy', cyk.recognise_numpy))
+    earley = EarleyParser(grammar_file)
+    engines.append(('earley', earley.recognise))
+    try:
+        action, goto, rules, terminals, start = LALR1Grammar(grammar_file).compile()
+        lalr = LALR1Parser(action, goto, rules, terminals, start)
+        engines.append(('lalr', lalr.recognise))
+    except LALR1ConflictError:
+        pass
+    return engines
+
+
+def percentile(values, fraction):
+    """Return a percentile of a sorted list, interpolating between values"""
+    position = (len(values) - 1) * fraction
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def scaling_exponent(sizes, times):
+    """
+    Return the exponent k of the least squares fit of times = c * sizes^k
+    on a log-log scale, or None if there are fewer than two points
+    """
+    points = [(math.log(size), math.log(seconds)) for size, seconds in zip(sizes, times) \
+              if size > 0 and seconds > 0]
+    if len(set(x for x, _ in points)) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / \
+        sum((x - mean_x) ** 2 for x, _ in points)
+
+
+def run_benchmark(grammar_file=None, lengths=None, repeats=BENCHMARK_REPEATS,
+                  near_valid=0.5, seed=0, time_limit=BENCHMARK_TIME_LIMIT,
+                  engines=None):
+    """
+    Benchmark every engine for a grammar file (or G') on random strings of
+    each target length, and return the results as a dictionary that can be
+    saved as JSON. At each length, `repeats` strings are generated with a
+    fixed seed and the fraction `near_valid` of them are edited (see
+    GrammarGenerator), and every engine parses the same strings. For each
+    engine and length the results hold the mean number of tokens, the
+    number accepted, the throughput in tokens per second, the latency
+    percentiles in seconds and the peak memory allocated by one parse of the
+    longest string, measured with tracemalloc in a separate run. Each engine
+    also gets the exponent of the fitted power law of its median latency.
+    An engine is not run on longer strings once a parse takes more than
+    `time_limit` seconds. `engines` limits the run to the engines named.
+    Each engine parses one string before it is timed, to fill its caches.
+    """
+    lengths = BENCHMARK_LENGTHS if lengths is None else lengths
+    if grammar_file is None:
+        generator = GrammarGenerator.from_ll1_table(seed=seed)
+    else:
+        generator = GrammarGenerator.from_grammar(grammar_file, seed)
+    inputs = []
+    for length in lengths:
+        strings = [generator.generate(length) for _ in range(0, repeats)]
+        for index in range(0, int(round(repeats * near_valid))):
+            strings[index] = generator.near_valid(strings[index])
+        inputs.append((length, strings))
+    results = {'grammar': grammar_file or "G'", 'seed': seed, 'repeats': repeats,
+               'near_valid': near_valid, 'python': platform.python_version(),
+               'numpy': None if numpy is None else numpy.__version__,
+               'engines': {}}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, recognise in benchmark_engines(grammar_file, directory):
+            if engines is not None and name not in engines:
+                continue
+            # the first parse may fill caches, so it is not timed
+            recognise(inputs[0][1][0])
+            rows = []
+            for length, strings in inputs:
+                latencies = []
+                accepted = 0
+                for string in strings:
+                    started = time.perf_counter()
+                    accepted += bool(recognise(string))
+                    latencies.append(time.perf_counter() - started)
+                tracemalloc.start()
+                recognise(max(strings, key=len))
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                latencies.sort()
+                tokens = sum(len(string) for string in strings)
+                rows.append({
+                    'length': length,
+                    'tokens': tokens / len(strings),
+                    'accepted': accepted,
+                    'throughput': tokens / sum(latencies) if sum(latencies) else None,
+                    'latency': {'mean': sum(latencies) / len(latencies),
+                                'p50': percentile(latencies, 0.5),
+                                'p90': percentile(latencies, 0.9),
+                                'p99': percentile(latencies, 0.99)},
+                    'peak_memory': peak})
+                if latencies[-1] > time_limit:
+                    break
+            results['engines'][name] = {
+                'lengths': rows,
+                'exponent': scaling_exponent([row['tokens'] for row in rows],
+                                             [row['latency']['p50'] for row in rows])}
+    return results
+
+
+def main_benchmark(output, grammar_file=None, lengths=None,
+                   repeats=BENCHMARK_REPEATS, seed=0, engines=None):
+    """
+    Run the benchmark (see `run_benchmark`), save the results as JSON to
+    `output` and print a summary line for each engine and length
+    """
+    results = run_benchmark(grammar_file, lengths, repeats, seed=seed, engines=engines)
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2)
+    for name, result in results['engines'].items():
+        for row in result['lengths']:
+            print("{name}\t{tokens:.0f} tokens\t{throughput:.0f} tokens/s\t"
+                  "p50 {p50:.6f}s\tp99 {p99:.6f}s\t{memory} bytes".format(
+                      name=name, tokens=row['tokens'], throughput=row['throughput'] or 0,
+                      p50=row['latency']['p50'], p99=row['latency']['p99'],
+                      memory=row['peak_memory']))
+        exponent = result['exponent']
+        print("{name}\texponent {exponent}".format(
+            name=name, exponent='n/a' if exponent is None else round(exponent, 2)))
 
-def main(input_file, cyk=False, grammar=None):
+
+def main(input_file, cyk=False, grammar=None, ll1_grammar=None,
+         compiled=False, stream=False, trace=True, viterbi=False, beam=None,
+         threshold=None, tree_format='list', cnf=False, earley_grammar=None,
+         lalr_grammar=None, lexer=None, errors=False, recover=False,
+         parallel=None, processes=None, stats=False):
     """
     Select a parser, parse the input given on the command line, and
-    print the ACCEPTED or REJECTED message
+    print the ACCEPTED or REJECTED message. The LL(1) parser prints its stack
+    trace while parsing unless `trace` is False or the compiled engine is
+    used; `trace` may also be a tracer such as a RingBufferTracer, whose
+    steps are printed if the string is rejected. With `viterbi`, the CYK
+    parser prints only the most likely tree, pruned by `beam` and `threshold`.
+    The CYK parser writes its tree in `tree_format` (see `write_tree`), and
+    with `cnf` converts a grammar that is not in CNF (see CNFGrammar). With
+    `earley_grammar` or `lalr_grammar`, the Earley or LALR(1) parser is used
+    with that grammar file and writes its tree in the same way. With
+    `lexer`, a token spec file, the input is split into tokens (see Lexer)
+    and only the result is printed. With `errors`, the LL(1) parser prints
+    the line, column and expected terminals of the first error before the
+    result, and with `recover` it prints every error (see
+    LL1Parser.errors); symbols that are not terminals are reported as errors
+    instead of exiting. With `parallel`, the CYK parser fills the table for
+    inputs of at least that many tokens with `processes` worker processes.
+    With `stats`, the LL(1) and CYK parsers time each phase and count the
+    work done by their engines, and the ParseStats is printed to stderr
+    after the result; `stats` may also be a ParseStats to add to.
     """
-    parser = LL1Parser() if not cyk else CYKParser(grammar)
-    accepted = parser.parse(input_file)
-    if accepted:
-        print(ACCEPTED)
+    if stats is True:
+        stats = ParseStats()
+    stats = stats if stats else None
+    if trace is True:
+        trace = None if compiled or stream else TextTracer()
+    tracer = trace if trace else None
+    # the CYK, Earley and LALR(1) parsers print a tree instead of a trace
+    prints_tree = cyk or earley_grammar is not None or lalr_grammar is not None
+    if cyk:
+        parser = CYKParser(grammar, cnf=cnf, parallel_threshold=parallel,
+                           processes=processes, stats=stats)
+    elif earley_grammar is not None:
+        parser = EarleyParser(earley_grammar)
+    elif lalr_grammar is not None:
+        parser = LALR1Parser.from_grammar(lalr_grammar)
+    elif ll1_grammar is not None:
+        parser = LL1Parser.from_grammar(ll1_grammar, compiled=compiled,
+                                        tracer=tracer, stats=stats)
+    else:
+        parser = LL1Parser(compiled=compiled, tracer=tracer, stats=stats)
+    if lexer is not None:
+        with open(input_file) as file:
+            print(check_tokens(parser, Lexer.from_file(lexer), file.read()))
+        if cyk:
+            parser.close_pool()
+        return
+    if (errors or recover) and not prints_tree:
+        found = parser.report(input_file, recover)
+        for error in found:
+            print(error)
+        accepted = not found
+    elif stream and not prints_tree:
+        accepted = parser.parse_stream(input_file)
+    elif viterbi and cyk:
+        accepted = parser.parse_viterbi(input_file, beam, threshold, tree_format)
+    elif prints_tree:
+        accepted = parser.parse(input_file, tree_format)
     else:
-        print(REJECTED)
+        accepted = parser.parse(input_file)
+    with phase(stats, 'output'):
+        if accepted:
+            print(ACCEPTED)
+        else:
+            if isinstance(tracer, RingBufferTracer) and not prints_tree:
+                print('\n'.join(tracer.lines()))
+            print(REJECTED)
+    if stats is not None:
+        print(stats, file=sys.stderr)
+    if cyk:
+        parser.close_pool()
 
 
 if __name__ == '__main__':
     ARGPARSER = argparse.ArgumentParser(description='Parse a string in an input \
                                      file.')
-    ARGPARSER.add_argument('input_file',
-                           help='The file containing the string to parse. \
-                           Whitespace will be stripped from the file before \
-                           parsing')
+    ARGPARSER.add_argument('input_file', nargs='*',
+                           help='The file containing the string to parse, or \
+                           - to read it from stdin. Whitespace will be \
+                           stripped from the file before parsing. With --batch, any number of files, \
+                           directories, or - to read one input per line \
+                           from stdin')
     ARGPARSER.add_argument('--cyk',
                            help='Add this flag to use the CYK parser. Requires \
                            a grammar file')
+    ARGPARSER.add_argument('--ll1',
+                           help='Use the LL(1) parser with a parse table \
+                           generated from this grammar file instead of the \
+                           built in table for G\'')
+    ARGPARSER.add_argument('--earley',
+                           help='Use the Earley parser with this grammar file, \
+                           which need not be in Chomsky normal form')
+    ARGPARSER.add_argument('--lalr',
+                           help='Use the LALR(1) parser with tables generated \
+                           from this grammar file')
+    ARGPARSER.add_argument('--lexer',
+                           help='Split the input into tokens with the token \
+                           spec in this file, whose names are the terminals \
+                           of the grammar')
+    ARGPARSER.add_argument('--compiled', action='store_true',
+                           help='Use the integer-interned LL(1) engine. The \
+                           result is the same but the stack trace is not \
+                           printed')
+    ARGPARSER.add_argument('--stream', action='store_true',
+                           help='Parse the input with the compiled LL(1) \
+                           engine as it is read, in constant memory')
+    ARGPARSER.add_argument('--errors', action='store_true',
+                           help='Print the line, column and expected \
+                           terminals of the first LL(1) syntax error')
+    ARGPARSER.add_argument('--recover', action='store_true',
+                           help='Recover from LL(1) syntax errors and print \
+                           every error found in one pass')
+    ARGPARSER.add_argument('--stats', action='store_true',
+                           help='Print the time spent in each phase and the \
+                           work done by the LL(1) or CYK engine to stderr')
+    ARGPARSER.add_argument('--serve', nargs='?', const=SERVER_SOCKET, metavar='SOCKET',
+                           help='Run a server that keeps parsers loaded and \
+                           answers JSON line requests on this Unix socket \
+                           (default: ' + SERVER_SOCKET + '), or on stdin and \
+                           stdout for -. No input file is needed')
+    ARGPARSER.add_argument('--client', nargs='?', const=SERVER_SOCKET, metavar='SOCKET',
+                           help='Parse the input file with the server on this \
+                           Unix socket (default: ' + SERVER_SOCKET + ') and \
+                           print the same output as without it')
+
+    ARGPARSER.add_argument('--trace', choices=['text', 'none', 'last', 'binary'],
+                           default='text',
+                           help='How to trace the LL(1) parser: print every \
+                           step (the default), nothing, only the last \
+                           --trace-size steps if the string is rejected, or \
+                           write a binary trace to --trace-file')
+    ARGPARSER.add_argument('--trace-size', type=int, default=20,
+                           help='Number of steps kept by --trace last')
+    ARGPARSER.add_argument('--trace-file', default='trace.bin',
+                           help='File written by --trace binary')
+
+    ARGPARSER.add_argument('--viterbi', action='store_true',
+                           help='With --cyk, print only the most likely tree \
+                           using the rule weights in the grammar file')
+    ARGPARSER.add_argument('--beam', type=int, default=None,
+                           help='With --viterbi, keep only this many variables \
+                           in each cell')
+    ARGPARSER.add_argument('--threshold', type=float, default=None,
+                           help='With --viterbi, drop variables whose log \
+                           probability is this much lower than the best in \
+                           their cell')
+    ARGPARSER.add_argument('--tree-format', choices=['list', 'json'],
+                           default='list',
+                           help='How the CYK, Earley and LALR(1) parsers write \
+                           the tree: as nested lists (the default) or as JSON')
+    ARGPARSER.add_argument('--parallel', type=int, default=None,
+                           help='With --cyk, fill the table with --jobs worker \
+                           processes for inputs of at least this many tokens, \
+                           if most spans of the input are in the grammar')
+    ARGPARSER.add_argument('--cnf', action='store_true',
+                           help='With --cyk, convert a grammar that is not in \
+                           Chomsky normal form, and print trees in terms of \
+                           the original grammar')
+    ARGPARSER.add_argument('--batch', action='store_true',
+                           help='Check every input and print one result per \
+                           input instead of exiting on an invalid symbol')
+    ARGPARSER.add_argument('--jobs', type=int, default=None,
+                           help='Number of processes used by --batch and \
+                           --parallel (default: one per CPU)')
+    ARGPARSER.add_argument('--unordered', action='store_true',
+                           help='Print --batch results as soon as they are \
+                           ready instead of in input order')
+    ARGPARSER.add_argument('--jsonl', action='store_true',
+                           help='Read --batch input streams and write results \
+                           as JSON lines')
+
+    ARGPARSER.add_argument('--benchmark', metavar='OUTPUT',
+                           help='Benchmark every engine on random strings of \
+                           G\' (or the grammar given with --cyk, --ll1, \
+                           --earley or --lalr) and save the results to this \
+                           JSON file. No input file is needed')
+    ARGPARSER.add_argument('--lengths', type=int, nargs='+', default=None,
+                           help='Target string lengths for --benchmark')
+    ARGPARSER.add_argument('--repeats', type=int, default=BENCHMARK_REPEATS,
+                           help='Strings of each length for --benchmark')
+    ARGPARSER.add_argument('--engines', nargs='+', default=None,
+                           help='Only benchmark these engines (ll1, \
+                           ll1-compiled, cyk-sparse, cyk-dense, cyk-numpy, \
+                           earley, lalr)')
 
     ARGS = ARGPARSER.parse_args()
-    INPUT_FILE = ARGS.input_file
+    if ARGS.benchmark is not None:
+        main_benchmark(ARGS.benchmark, ARGS.cyk or ARGS.ll1 or ARGS.earley or ARGS.lalr,
+                       ARGS.lengths, ARGS.repeats, engines=ARGS.engines)
+        sys.exit(0)
+    if ARGS.serve is not None:
+        SERVER = ParserServer()
+        if ARGS.serve == '-':
+            asyncio.run(SERVER.serve_stdin())
+        else:
+            try:
+                asyncio.run(SERVER.serve_unix(ARGS.serve))
+            except KeyboardInterrupt:
+                pass
+        sys.exit(0)
+    if not ARGS.input_file:
+        ARGPARSER.error('an input file is required')
+    if ARGS.batch:
+        main_batch(ARGS.input_file, ARGS.cyk is not None, ARGS.cyk, ARGS.ll1,
+                   ARGS.jobs, not ARGS.unordered, ARGS.jsonl, ARGS.cnf,
+                   ARGS.earley, ARGS.lalr)
+        sys.exit(0)
+    if len(ARGS.input_file) != 1:
+        ARGPARSER.error('only one input file can be parsed without --batch')
+    INPUT_FILE = ARGS.input_file[0]
     if INPUT_FILE is None:
         ARGPARSER.print_help()
-    if not exists(INPUT_FILE):
+    if INPUT_FILE != '-' and not exists(INPUT_FILE):
         raise FileNotFoundError
+    if ARGS.client is not None:
+        KIND = 'cyk' if ARGS.cyk else 'earley' if ARGS.earley else \
+            'lalr' if ARGS.lalr else 'll1'
+        main_client(INPUT_FILE, ARGS.client, KIND,
+                    ARGS.cyk or ARGS.earley or ARGS.lalr or ARGS.ll1, ARGS.cnf,
+                    ARGS.tree_format)
+        sys.exit(0)
     CYK = ARGS.cyk if ARGS.cyk else None
     GRAMMAR = CYK if CYK is not None else None
-    main(INPUT_FILE, CYK, GRAMMAR)
+    TRACE = {'text': True, 'none': False,
+             'last': RingBufferTracer(ARGS.trace_size),
+             'binary': BinaryTracer(ARGS.trace_file)}[ARGS.trace]
+    main(INPUT_FILE, CYK, GRAMMAR, ARGS.ll1, ARGS.compiled, ARGS.stream, TRACE,
+         ARGS.viterbi, ARGS.beam, ARGS.threshold, ARGS.tree_format, ARGS.cnf,
+         ARGS.earley, ARGS.lalr, ARGS.lexer, ARGS.errors, ARGS.recover,
+         ARGS.parallel, ARGS.jobs, ARGS.stats)
@@ -1,9 +1,15 @@
 import unittest
-# When testing this I called my main file parsing.py, not parser.py
-# because there is already a parser module in the Python 3 standard library
-import parsing as parsing
+# The tests call the module `parsing`, since before Python 3.10 there was a
+# parser module in the standard library. The directory of this file comes
+# first on sys.path, so parser.py is the module imported either way.
+import parser as parsing
 import io
 import sys
+import tempfile
+import math
+import json
+import os
+import pickle
 
 class TestParser(unittest.TestCase):
 
@@ -479,3 +485,1225 @@ class TestParser(unittest.TestCase):
         parser = parsing.CYKParser(grammar)
         accepted = parser.parse(input)
         self.assertEqual(accepted, True)
+
+    # Test LL(1) table generation
+    def test_LL1Grammar_generates_LL1TABLE(self):
+        # test/ll1_grammar is the grammar G' written out as a grammar file
+        grammar = parsing.LL1Grammar('test/ll1_grammar')
+        table, conflicts = grammar.build_table()
+        self.assertEqual(conflicts, [])
+        self.assertEqual({variable: {token: ''.join(entry) for token, entry \
+                                     in row.items()} \
+                          for variable, row in table.items()}, parsing.LL1TABLE)
+        self.assertEqual(grammar.terminals, parsing.TERMINALS)
+
+    def test_LL1Grammar_reports_conflicts(self):
+        # VP -> VP PP is left recursive, so the grammar is not LL(1)
+        grammar = parsing.LL1Grammar('test/test5_cyk_ambiguous_grammar')
+        with self.assertRaises(parsing.LL1ConflictError) as context:
+            grammar.compile()
+        self.assertIn(('VP', 'eats'), [(variable, token) for variable, token, _ \
+                                      in context.exception.conflicts])
+
+    def test_LL1Parser_from_grammar_uses_cached_table(self):
+        input = 'test/test1_accepted'
+        grammar = 'test/ll1_grammar'
+        with tempfile.TemporaryDirectory() as cache_dir:
+            parser = parsing.LL1Parser.from_grammar(grammar, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            cached = parsing.LL1Parser.from_grammar(grammar, cache_dir=cache_dir)
+            self.assertEqual(cached.table, parser.table)
+            self.assertEqual(cached.parse(input), True)
+            self.assertEqual(cached.parse('test/test3_rejected'), False)
+
+    # Test the compiled LL(1) engine gives the same results
+    def test_LL1Parser_compiled_matches_LL1Parser(self):
+        out = io.StringIO()
+        sys.stdout = out
+        for input in sorted(os.listdir('test')):
+            if not input.startswith(('accept_', 'reject_', 'test1_accepted',
+                                     'test3_rejected')) or \
+                input.endswith(('_derivation', '_expected_output')):
+                continue
+            input = os.path.join('test', input)
+            self.assertEqual(parsing.LL1Parser(compiled=True).parse(input),
+                             parsing.LL1Parser().parse(input), input)
+
+    def test_CompiledLL1Table_stores_productions_reversed(self):
+        compiled = parsing.LL1Parser().compile()
+        entry = compiled.table[(compiled.ids['F'] - compiled.num_terminals) * \
+                               compiled.num_terminals + compiled.ids['p']]
+        self.assertEqual(''.join(compiled.symbols[symbol] for symbol \
+                                 in compiled.productions[entry]), 'Ltnirp')
+
+    def test_CompiledLL1Table_grows_stack_for_deep_nesting(self):
+        compiled = parsing.LL1Parser().compile()
+        self.assertEqual(compiled.recognise('(-' * 100 + 'a' + ')' * 100), True)
+        self.assertEqual(compiled.recognise('(-' * 100 + 'a' + ')' * 99), False)
+
+    # Test streaming LL(1) parsing
+    def test_LL1Parser_parse_stream_accepts_whitespace_test1(self):
+        input = 'test/accept_whitespace_test1'
+        parser = parsing.LL1Parser()
+        self.assertEqual(parser.parse_stream(input), True)
+
+    def test_LL1Parser_parse_stream_rejects_test3(self):
+        input = 'test/test3_rejected'
+        parser = parsing.LL1Parser()
+        self.assertEqual(parser.parse_stream(input), False)
+
+    def test_LL1Parser_parse_stream_prints_invalid_test4(self):
+        input = 'test/test4_invalid'
+        parser = parsing.LL1Parser()
+        out = io.StringIO()
+        sys.stdout = out
+        last_output = None
+        try:
+            parser.parse_stream(input)
+        except SystemExit:
+            last_output = [line for line in out.getvalue().strip().split('\n')][-1]
+        self.assertEqual(last_output, parsing.ERROR_INVALID_SYMBOL)
+
+    def test_LL1Stream_reports_valid_prefix_after_each_chunk(self):
+        # input: (if(-1a)(print1)) split across chunks and whitespace
+        chunks = ['(i', 'f (-1', 'a)\n(pr', 'int1', '))']
+        progress = []
+        parser = parsing.LL1Parser()
+        self.assertEqual(parser.parse_stream(chunks, progress.append), True)
+        self.assertEqual(progress, [True] * len(chunks))
+        # the input stops being a valid prefix at the second ')'
+        stream = parser.stream()
+        self.assertEqual([stream.feed(chunk) for chunk in ['(+a', ')', ')', 'a']],
+                         [True, True, False, False])
+        self.assertEqual(stream.close(), False)
+
+    # Test LL(1) tracers
+    def test_LL1Parser_without_tracer_prints_nothing(self):
+        input = 'test/test1_accepted'
+        out = io.StringIO()
+        sys.stdout = out
+        accepted = parsing.LL1Parser().parse(input)
+        self.assertEqual(accepted, True)
+        self.assertEqual(out.getvalue(), '')
+
+    def test_RingBufferTracer_keeps_last_steps_test3(self):
+        # input ()if+-*printabcd0123
+        input = 'test/test3_rejected'
+        tracer = parsing.RingBufferTracer(size=2)
+        parser = parsing.LL1Parser(tracer=tracer)
+        self.assertEqual(parser.parse(input), False)
+        self.assertEqual(tracer.accepted, False)
+        self.assertEqual(tracer.lines(), ['()if+-*printabcd0123$ (MR$',
+                                          ')if+-*printabcd0123$ MR$'])
+
+    def test_BinaryTracer_matches_text_trace_test1(self):
+        input = 'test/test1_accepted'
+        expected = 'test/test1_accepted_expected_output'
+        with open(expected) as file:
+            expected_lines = file.read().strip().split('\n')[:-1]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'trace.bin')
+            parser = parsing.LL1Parser(tracer=parsing.BinaryTracer(path))
+            self.assertEqual(parser.parse(input), True)
+            steps = parsing.read_binary_trace(path)
+        self.assertEqual(len(steps), len(expected_lines))
+        for (index, depth, top), line in zip(steps, expected_lines):
+            tokens, stack = line.split(' ')
+            self.assertEqual((index, depth, top),
+                             (len('(if(-1a)(print1))$') - len(tokens),
+                              len(stack), stack[0]))
+
+    # Test batch parsing
+    def test_parse_batch_returns_result_per_input(self):
+        inputs = ['test/test1_accepted', 'test/test3_rejected',
+                  'test/test4_invalid', 'test/accept_whitespace_test1']
+        expected = [parsing.ACCEPTED, parsing.REJECTED,
+                    parsing.ERROR_INVALID_SYMBOL, parsing.ACCEPTED]
+        parser = parsing.LL1Parser(compiled=True)
+        for processes in [1, 2]:
+            results = list(parsing.parse_batch(
+                parser, parsing.batch_inputs(inputs), processes=processes))
+            self.assertEqual(results, list(zip(inputs, expected)))
+
+    def test_parse_batch_unordered_CYKParser(self):
+        grammar = 'test/test6_cyk_unambiguous_grammar'
+        inputs = [(number, string) for number, string in \
+                  enumerate(['(ifaa)', '(-+a)', '9', '(*abcd0123)'] * 5)]
+        results = parsing.parse_batch(parsing.CYKParser(grammar), inputs,
+                                      processes=2, ordered=False, chunksize=1)
+        self.assertEqual(sorted(results), [
+            (number, [parsing.ACCEPTED, parsing.REJECTED,
+                      parsing.ERROR_INVALID_SYMBOL, parsing.ACCEPTED][number % 4]) \
+            for number in range(20)])
+
+    def test_batch_inputs_reads_jsonl_stream(self):
+        stream = io.StringIO('{"id": "a", "input": "(+a)"}\n\n"(if a"\n')
+        self.assertEqual(list(parsing.batch_inputs([stream], jsonl=True)),
+                         [('a', '(+a)'), (3, '(if a')])
+        # a line that cannot be read gets an error result, and the rest are checked
+        stream = io.StringIO('{"id": "a", "input": "(+ab)"}\n{"input": \n{"id": 5}\n"(+ab)"\n')
+        results = list(parsing.parse_batch(parsing.LL1Parser(compiled=True),
+                                           parsing.batch_inputs([stream], jsonl=True),
+                                           processes=1))
+        self.assertEqual([name for name, _ in results], ['a', 2, 5, 4])
+        self.assertEqual(results[0][1], parsing.ACCEPTED)
+        self.assertTrue(results[1][1].startswith('Malformed input'))
+        self.assertEqual(results[2][1], 'Malformed input: no input string')
+        self.assertEqual(results[3][1], parsing.ACCEPTED)
+
+    def test_batch_inputs_skips_blank_lines_of_text_stream(self):
+        stream = io.StringIO('(+ab)\n\n  \n(if a\n')
+        self.assertEqual(list(parsing.batch_inputs([stream])),
+                         [(1, '(+ab)\n'), (4, '(if a\n')])
+
+    # Test the bitset CYK engine
+    def test_CYKParser_bitset_matches_recognise_string(self):
+        grammar = 'test/test6_cyk_unambiguous_grammar'
+        parser = parsing.CYKParser(grammar)
+        for input in ['test/test1_accepted', 'test/test3_rejected',
+                      'test/accept_nested_condition', 'test/accept_whitespace_test1',
+                      'test/reject_if_missing_expression',
+                      'test/reject_too_many_parentheses', 'test/reject_empty_string']:
+            string = parser.read_input(input)
+            self.assertEqual(parser.recognise_bitset(string),
+                             parser.recognise_string(string), input)
+
+    def test_CYKParser_bitset_table_ambiguous_test5(self):
+        # input: she eats a fish with a fork, as a list of word tokens
+        grammar = 'test/test5_cyk_ambiguous_grammar'
+        string = 'she eats a fish with a fork'.split()
+        parser = parsing.CYKParser(grammar)
+        table = parser.bitset_table(string)
+        self.assertEqual(parser.recognise_bitset(string), True)
+        self.assertEqual(parser.mask_symbols(table[0, 1]), ['VP', 'V'])
+        self.assertEqual(parser.mask_symbols(table[6, 0]), ['S'])
+        self.assertEqual(parser.mask_symbols(table[2, 4]), ['PP'])
+
+    def test_CYKParser_check_returns_results(self):
+        grammar = 'test/test6_cyk_unambiguous_grammar'
+        parser = parsing.CYKParser(grammar)
+        self.assertEqual(parser.check('(if(-1a)\n(print1))'), parsing.ACCEPTED)
+        self.assertEqual(parser.check('()if+-*printabcd0123'), parsing.REJECTED)
+        self.assertEqual(parser.check('if(9)'), parsing.ERROR_INVALID_SYMBOL)
+
+    # Test the NumPy matrix CYK engine
+    @unittest.skipIf(parsing.numpy is None, 'NumPy is not installed')
+    def test_CYKParser_numpy_matches_bitset(self):
+        grammar = 'test/test6_cyk_unambiguous_grammar'
+        parser = parsing.CYKParser(grammar)
+        strings = ['(if(-1a)(print1))', '()if+-*printabcd0123', '(if(-1))',
+                   '(*' + '(+(ifa(-b)))' * 12 + ')',
+                   '(*' + '(+(ifa(-b)))' * 12 + '))', '1', '']
+        for string in strings:
+            self.assertEqual(parser.recognise_numpy(string),
+                             parser.recognise_bitset(string), string)
+
+    @unittest.skipIf(parsing.numpy is None, 'NumPy is not installed')
+    def test_CYKParser_numpy_chart_ambiguous_test5(self):
+        grammar = 'test/test5_cyk_ambiguous_grammar'
+        string = 'she eats a fish with a fork'.split()
+        parser = parsing.CYKParser(grammar)
+        chart = parser.numpy_chart(string)
+        bitset = parser.bitset_table(string)
+        for length in range(1, len(string) + 1):
+            for start in range(0, len(string) - length + 1):
+                self.assertEqual([symbol for index, symbol \
+                                  in enumerate(parser.variables) \
+                                  if chart[index, start, start + length]],
+                                 parser.mask_symbols(bitset[length-1, start]))
+
+    @unittest.skipIf(parsing.numpy is None, 'NumPy is not installed')
+    def test_CYKParser_accepts_switches_engine_at_threshold(self):
+        grammar = 'test/test6_cyk_unambiguous_grammar'
+        parser = parsing.CYKParser(grammar, numpy_threshold=10)
+        parser._sampled_density = lambda string: 1
+        parser.recognise_bitset = None
+        self.assertEqual(parser.accepts('(if(-1a)(print1))'), True)
+        self.assertEqual(parser.check('(if(-1a)(print1)'), parsing.REJECTED)
+        # nor is it used past NUMPY_MAX_BYTES
+        parser = parsing.CYKParser(grammar, numpy_threshold=10)
+        parser.recognise_numpy = None
+        parser.numpy_bytes = lambda len_string: parsing.NUMPY_MAX_BYTES + 1
+        self.assertEqual(parser.accepts('(if(-1a)(print1))'), True)
+
+    @unittest.skipIf(parsing.numpy is None, 'NumPy is not installed')
+    def test_CYKParser_engine_uses_numpy_for_long_dense_charts(self):
+        dense = parsing.CYKParser('test/test11_cyk_dense_grammar')
+        string = 'ab' * (parsing.NUMPY_THRESHOLD // 2)
+        self.assertEqual(dense._engine(string), 'numpy')
+        self.assertEqual(dense._engine(string[:-1]), 'sparse')
+        self.assertEqual(parsing.CYKParser('test/test11_cyk_dense_grammar',
+                                           numpy_threshold=None)._engine(string), 'sparse')
+        # most cells of test6 are empty, so the sparse engine is kept however
+        # long the string is
+        sparse = parsing.CYKParser('test/test6_cyk_unambiguous_grammar')
+        string = '(if(-1a)(print1))' * 20
+        self.assertLess(sparse._sampled_density(string), parsing.NUMPY_MIN_DENSITY)
+        self.assertEqual(sparse._engine(string), 'sparse')
+
+    def test_CYKParser_sampled_density_reads_windows_across_string(self):
+        parser = parsing.CYKParser('test/test11_cyk_dense_grammar')
+        windows = []
+        parser._chart_density = lambda string: windows.append(string) or 1
+        string = 'ab' * 200
+        self.assertEqual(parser._sampled_density(string), 1)
+        self.assertEqual(len(windows), parsing.DENSITY_WINDOWS)
+        self.assertTrue(all(len(window) == parsing.DENSITY_WINDOW for window in windows))
+        self.assertEqual(windows[-1], string[-parsing.DENSITY_WINDOW:])
+        del windows[:]
+        self.assertEqual(parser._sampled_density('abab'), 1)
+        self.assertEqual(windows, ['abab'])
+
+    @unittest.skipIf(parsing.numpy is None, 'NumPy is not installed')
+    def test_CYKParser_numpy_bytes_bounds_allocations(self):
+        import tracemalloc
+        for grammar, string in [('test/test11_cyk_dense_grammar', 'abaabbbaab' * 10),
+                                ('test/test6_cyk_unambiguous_grammar',
+                                 '(if(-1a)(print1))' * 6)]:
+            parser = parsing.CYKParser(grammar)
+            tracemalloc.start()
+            try:
+                parser.numpy_chart(string)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            self.assertLessEqual(peak, parser.numpy_bytes(len(string)))
+
+    # Test the shared packed parse forest
+    def test_ParseForest_unambiguous_tree_matches_parse_test6(self):
+        input = 'test/test6_cyk_unambiguous_accepted'
+        grammar = 'test/test6_cyk_unambiguous_grammar'
+        expected = 'test/test6_cyk_unambiguous_grammar_expected_output'
+        with open(expected) as file:
+            expected_tree = file.readline().strip()
+        parser = parsing.CYKParser(grammar)
+        forest = parser.forest(parser.read_input(input))
+        self.assertEqual(forest.count(), 1)
+        self.assertEqual([str(tree) for tree in forest.trees()], [expected_tree])
+
+    def test_ParseForest_enumerates_ambiguous_trees(self):
+        # input: she eats a fish with a fork, where "with a fork" can attach
+        # to either "eats" or "a fish"
+        grammar = 'test/test7_cyk_ambiguous_grammar'
+        parser = parsing.CYKParser(grammar)
+        forest = parser.forest('she eats a fish with a fork'.split())
+        self.assertEqual(forest.count(), 2)
+        trees = list(forest.trees())
+        self.assertEqual(len(trees), 2)
+        self.assertNotEqual(trees[0], trees[1])
+        self.assertEqual(trees[1][2][1], ['VP', ['V', 'eats', None],
+                                          ['NP', ['Det', 'a', None],
+                                           ['N', 'fish', None]]])
+
+    def test_ParseForest_counts_without_expanding_trees(self):
+        # each extra "with a fork" can attach to any earlier noun phrase or
+        # verb phrase, so the number of trees grows as the Catalan numbers
+        grammar = 'test/test7_cyk_ambiguous_grammar'
+        parser = parsing.CYKParser(grammar)
+        string = ('she eats a fish' + ' with a fork' * 30).split()
+        forest = parser.forest(string)
+        self.assertEqual(forest.count(), 14544636039226909)
+        self.assertLess(len(forest.alternatives), 2000)
+        self.assertEqual(parser.forest('she with a fork'.split()), None)
+
+    # Test Viterbi CYK with rule weights
+    def test_CYKParser_viterbi_picks_most_likely_tree(self):
+        # "with a fork" is more likely to attach to "a fish" in this grammar
+        grammar = 'test/test8_cyk_weighted_grammar'
+        parser = parsing.CYKParser(grammar)
+        self.assertEqual(parser.rule_weights['VP', ('VP', 'PP')], 0.1)
+        score, tree = parser.viterbi('she eats a fish with a fork'.split())
+        self.assertAlmostEqual(score, math.log(0.3 * 0.6 * 0.2 * 0.5 ** 4))
+        self.assertEqual(tree[2][2][0], 'NP')
+        self.assertIn(tree, list(parser.forest('she eats a fish with a fork'.split()).trees()))
+
+    def test_CYKParser_viterbi_unweighted_matches_parse_test6(self):
+        input = 'test/test6_cyk_unambiguous_accepted'
+        grammar = 'test/test6_cyk_unambiguous_grammar'
+        expected = 'test/test6_cyk_unambiguous_grammar_expected_output'
+        out = io.StringIO()
+        sys.stdout = out
+        parser = parsing.CYKParser(grammar)
+        self.assertEqual(parser.parse_viterbi(input, threshold=0.0), True)
+        with open(expected) as file:
+            self.assertEqual(out.getvalue(), file.readline())
+        self.assertEqual(parser.viterbi(parser.read_input('test/test3_rejected')), None)
+
+    def test_CYKParser_viterbi_pruning_bounds_cells(self):
+        # V -> eats is more likely than VP -> eats, so keeping only the best
+        # variable for "eats" loses the only derivation of "she eats"
+        grammar = 'test/test8_cyk_weighted_grammar'
+        parser = parsing.CYKParser(grammar)
+        self.assertEqual(parser.viterbi(['she', 'eats'])[1],
+                         ['S', ['NP', 'she', None], ['VP', 'eats', None]])
+        self.assertEqual(parser.viterbi(['she', 'eats'], beam=1), None)
+        self.assertEqual(parser.viterbi(['she', 'eats'], threshold=1.0), None)
+        self.assertNotEqual(parser.viterbi(['she', 'eats'], threshold=2.0), None)
+
+    def test_CYKParser_rejects_non_positive_weights(self):
+        with tempfile.TemporaryDirectory() as directory:
+            grammar = os.path.join(directory, 'grammar')
+            for weight in ['0', '-0.5', '1e-400', '1.2.3']:
+                with open(grammar, 'w') as file:
+                    file.write('S -> A B [{weight}]\nA -> a\nB -> b\n'.format(weight=weight))
+                with self.assertRaises(parsing.GrammarError):
+                    parsing.CYKParser(grammar)
+
+    # Test CYKTable storage
+    def test_CYKTable_dense_and_sparse_indexing(self):
+        for sparse in [False, True]:
+            table = parsing.CYKTable('abcd', sparse=sparse)
+            table[0, 3].append('A')
+            table[3, 0] = ['S']
+            table[-3, 1] = ['B']
+            self.assertEqual(table[0, -1], ['A'])
+            self.assertEqual(table[-1, 0], ['S'])
+            self.assertEqual(table.get(1, 1), ['B'])
+            self.assertEqual(table[2, 1], [])
+            self.assertEqual(table.rows(), [[[], [], [], ['A']], [[], ['B'], []],
+                                            [[], []], [['S']]])
+            with self.assertRaises(IndexError):
+                table[3, 1]
+            with self.assertRaises(IndexError):
+                table[2, 2] = []
+
+    def test_CYKTable_sparse_stores_only_set_cells(self):
+        table = parsing.CYKTable('a' * 1000, sparse=True, empty=0)
+        table.set(999, 0, 1)
+        self.assertEqual(table[0, 0], 0)
+        self.assertEqual(len(table.cells), 1)
+        self.assertEqual(len(parsing.CYKTable('a' * 100, empty=0).cells), 5050)
+
+    def test_CYKParser_sparse_bitset_table_matches_dense(self):
+        grammar = 'test/test7_cyk_ambiguous_grammar'
+        parser = parsing.CYKParser(grammar)
+        string = ('she eats a fish' + ' with a fork' * 5).split()
+        dense = parser.bitset_table(string)
+        sparse = parser.bitset_table(string, sparse=True)
+        self.assertEqual(dense.rows(), sparse.rows())
+        self.assertLess(len(sparse.cells), len(dense.cells))
+
+    # Test the CYK node arena
+    def test_CYKParser_derivation_arena_test6(self):
+        input = 'test/test6_cyk_unambiguous_accepted'
+        grammar = 'test/test6_cyk_unambiguous_grammar'
+        expected = 'test/test6_cyk_unambiguous_grammar_expected_output'
+        with open(expected) as file:
+            expected_tree = file.readline().strip()
+        parser = parsing.CYKParser(grammar)
+        string = parser.read_input(input)
+        arena, root = parser.derivation(string)
+        # one node per variable and one per terminal in a binary tree
+        self.assertEqual(len(arena), 3 * len(string) - 1)
+        self.assertEqual(str(parser._generate_tree(arena.node(root))), expected_tree)
+        self.assertEqual((arena.symbol(root), arena.starts[root], arena.lengths[root]),
+                         ('S', 0, len(string)))
+        self.assertEqual(parser.derivation('()'), (None, None))
+
+    def test_CYKNodeView_matches_CYKNode(self):
+        arena = parsing.CYKNodeArena()
+        root = arena.add('S', 0, 2)
+        left = arena.add('A', 0, 1)
+        arena.lefts[left] = arena.add('a', 0, 1)
+        arena.lefts[root] = left
+        arena.rights[root] = arena.add('B', 1, 1, left=arena.add('b', 1, 1))
+        view = arena.node(root)
+        self.assertEqual(view.get_symbol(), 'S')
+        self.assertEqual(view.get_left().get_symbol(), 'A')
+        self.assertEqual(view.get_left().is_unit_rule(), True)
+        self.assertEqual(view.get_left().get_left().is_terminal(), True)
+        self.assertEqual(view.get_right().get_right(), None)
+        self.assertFalse(hasattr(parsing.CYKNode('S'), '__dict__'))
+
+    # Test streaming tree output
+    def test_write_tree_formats_test6(self):
+        input = 'test/test6_cyk_unambiguous_accepted'
+        grammar = 'test/test6_cyk_unambiguous_grammar'
+        expected = 'test/test6_cyk_unambiguous_grammar_expected_output'
+        with open(expected) as file:
+            expected_tree = file.readline().strip()
+        parser = parsing.CYKParser(grammar)
+        arena, root = parser.derivation(parser.read_input(input))
+        for tree in [arena.node(root), parser._generate_tree(arena.node(root))]:
+            out = io.StringIO()
+            parsing.write_tree(tree, out)
+            self.assertEqual(out.getvalue(), expected_tree)
+            out = io.StringIO()
+            parsing.write_tree(tree, out, 'json')
+            self.assertEqual(json.loads(out.getvalue()), eval(expected_tree))
+
+    def test_write_tree_deep_tree_without_recursion(self):
+        # a right-branching chain of R -> E R, deeper than the recursion limit
+        grammar = 'test/test6_cyk_unambiguous_grammar'
+        parser = parsing.CYKParser(grammar)
+        arena, root = parser.derivation('a' * 150)
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(100)
+        try:
+            out = io.StringIO()
+            parsing.write_tree(arena.node(root), out, 'json')
+            tree = parser._generate_tree(arena.node(root))
+        finally:
+            sys.setrecursionlimit(limit)
+        self.assertEqual(out.getvalue().count('"E","a",null'), 149)
+        self.assertEqual(tree[2][2][0], 'R')
+
+    # Test compiled CYK grammar artifacts
+    def test_compile_grammar_round_trip(self):
+        grammar = 'test/test8_cyk_weighted_grammar'
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = parsing.compile_grammar(grammar, cache_dir)
+            self.assertTrue(path.endswith('.cyk'))
+            modified = os.path.getmtime(path)
+            self.assertEqual(parsing.compile_grammar(grammar, cache_dir), path)
+            self.assertEqual(os.path.getmtime(path), modified)
+            parser = parsing.CYKParser(grammar)
+            compiled = parsing.CYKParser.from_grammar(grammar, cache_dir)
+            self.assertEqual(compiled.artifact, path)
+            self.assertEqual(compiled.start_symbol, parser.start_symbol)
+            self.assertEqual(compiled.unit_productions, parser.unit_productions)
+            self.assertEqual(compiled.nonterminal_rules, parser.nonterminal_rules)
+            self.assertEqual(compiled.rule_weights, parser.rule_weights)
+            self.assertEqual(compiled.variables, parser.variables)
+
+    def test_compiled_CYKParser_loads_rule_index(self):
+        for grammar in ['test/test6_cyk_unambiguous_grammar', 'test/test11_cyk_dense_grammar',
+                        'test/test8_cyk_weighted_grammar']:
+            with tempfile.TemporaryDirectory() as cache_dir:
+                path = parsing.compile_grammar(grammar, cache_dir)
+                index_rules = parsing.CYKParser._index_rules
+                parsing.CYKParser._index_rules = None
+                try:
+                    compiled = parsing.CYKParser(grammar, artifact=path)
+                finally:
+                    parsing.CYKParser._index_rules = index_rules
+                parser = parsing.CYKParser(grammar)
+                for name in ['variables', 'variable_bits', 'terminal_masks', 'pair_masks',
+                             'rights_of', 'left_mask', 'right_mask', 'rules_of',
+                             'min_yield', 'max_yield', 'length_masks',
+                             'partition_bounds', 'corner_masks']:
+                    self.assertEqual(getattr(compiled, name), getattr(parser, name), name)
+                self.assertEqual(compiled.check('(ifaa)'), parser.check('(ifaa)'))
+
+    def test_compile_grammar_replaces_stale_artifact(self):
+        grammar = 'test/test6_cyk_unambiguous_grammar'
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = parsing.compile_grammar(grammar, cache_dir)
+            with open(path, 'r+b') as file:
+                file.write(b'XXXX')
+            self.assertRaises(ValueError, parsing.CYKParser, grammar, artifact=path)
+            self.assertEqual(parsing.compile_grammar(grammar, cache_dir), path)
+            parser = parsing.CYKParser(grammar, artifact=path)
+            self.assertEqual(parser.check('(ifaa)'), parsing.ACCEPTED)
+
+    def test_compiled_CYKParser_pickles_artifact_path(self):
+        grammar = 'test/test6_cyk_unambiguous_grammar'
+        with tempfile.TemporaryDirectory() as cache_dir:
+            parser = parsing.CYKParser.from_grammar(grammar, cache_dir)
+            data = pickle.dumps(parser)
+            self.assertLess(len(data), len(pickle.dumps(parsing.CYKParser(grammar))))
+            self.assertEqual(pickle.loads(data).check('(ifaa)'), parsing.ACCEPTED)
+            parser.parallel_threshold = 100
+            parser.processes = 3
+            copy = pickle.loads(pickle.dumps(parser))
+            self.assertEqual((copy.parallel_threshold, copy.processes, copy.cnf),
+                             (100, 3, None))
+            inputs = list(enumerate(['(ifaa)', '(-+a)', '9'] * 3))
+            results = parsing.parse_batch(parser, inputs, processes=2)
+            self.assertEqual([result for _, result in results],
+                             [parsing.ACCEPTED, parsing.REJECTED,
+                              parsing.ERROR_INVALID_SYMBOL] * 3)
+
+    # Test CNF conversion
+    def check_original_tree(self, grammar, tree):
+        """Check a restored tree only uses rules of the original grammar"""
+        rules = set(parsing.read_grammar(grammar)[1])
+        leaves = []
+        pending = [tree]
+        while pending:
+            node = pending.pop()
+            if isinstance(node, str):
+                leaves.append(node)
+                continue
+            rhs = tuple(child if isinstance(child, str) else child[0] \
+                        for child in node[1:])
+            self.assertIn((node[0], rhs), rules)
+            pending.extend(reversed(node[1:]))
+        return ''.join(leaves)
+
+    def test_CNFGrammar_matches_hand_converted_test6(self):
+        grammar = 'test/test9_cyk_cnf_grammar'
+        expected = parsing.CYKParser('test/test6_cyk_unambiguous_grammar')
+        parser = parsing.CYKParser(grammar, cnf=True)
+        self.assertRaises(parsing.CNFError, parsing.CYKParser, grammar)
+        for string in ['(ifaa)', '(ifabc)', '(if(+1)a)', '(printab(-1))',
+                       '(-+a)', '(ifa)', '(ifabcd)', '(print)', 'ab', 'a(']:
+            self.assertEqual(parser.check(string), expected.check(string))
+        # fewer rules than the grammar converted by hand
+        self.assertLess(len(parser.nonterminal_rules), len(expected.nonterminal_rules))
+
+    def test_CNFGrammar_restores_original_tree(self):
+        grammar = 'test/test9_cyk_cnf_grammar'
+        parser = parsing.CYKParser(grammar, cnf=True)
+        for string in ['(ifaa)', '(if(-1a)(print1))', 'ab(*12)']:
+            arena, root = parser.derivation(string)
+            tree = parser.cnf.restore(parser._generate_tree(arena.node(root)))
+            self.assertEqual(tree[0], 'S')
+            self.assertEqual(self.check_original_tree(grammar, tree), string)
+        out = io.StringIO()
+        sys.stdout = out
+        try:
+            parser.parse('test/test6_cyk_unambiguous_accepted')
+        finally:
+            sys.stdout = sys.__stdout__
+        # the nullable N is kept as a node with no children
+        self.assertIn("['N'], ')']", out.getvalue().splitlines()[0])
+
+    def test_CNFGrammar_removes_useless_and_merges_variables(self):
+        with tempfile.TemporaryDirectory() as directory:
+            grammar = os.path.join(directory, 'grammar')
+            with open(grammar, 'w') as file:
+                file.write('S -> A x y z | B w y z | U\n'
+                           'A -> a\nB -> b\n'
+                           'U -> x U\nD -> d\n')
+            cnf = parsing.CNFGrammar(grammar)
+            # U is unproductive, D is unreachable
+            self.assertEqual(cnf.variables & set(['U', 'D']), set())
+            # the chains for "y z" are merged into one variable
+            self.assertEqual(len([lhs for lhs, rhs, _ in cnf.rules \
+                                  if rhs == ('T_y', 'T_z')]), 1)
+            parser = parsing.CYKParser(grammar, cnf=True)
+            self.assertEqual(parser.check('bwyz'), parsing.ACCEPTED)
+            arena, root = parser.derivation('axyz')
+            self.assertEqual(cnf.restore(parser._generate_tree(arena.node(root))),
+                             ['S', ['A', 'a'], 'x', 'y', 'z'])
+
+    # Test Earley Parser
+    def test_EarleyParser_matches_CYKParser_test9(self):
+        grammar = 'test/test9_cyk_cnf_grammar'
+        parser = parsing.EarleyParser(grammar)
+        expected = parsing.CYKParser(grammar, cnf=True)
+        for string in ['(ifaa)', '(ifabc)', '(if(+1)a)', '(printab(-1))',
+                       '(-+a)', '(ifa)', '(ifabcd)', '(print)', 'ab', 'a(', '(if a 9)']:
+            self.assertEqual(parser.check(string), expected.check(string))
+        string = parser.read_input('test/test6_cyk_unambiguous_accepted')
+        arena, root = expected.derivation(string)
+        self.assertEqual(parser.derivation(string),
+                         expected.cnf.restore(expected._generate_tree(arena.node(root))))
+
+    def test_EarleyParser_matches_LL1Parser_with_nullable_rules(self):
+        parser = parsing.EarleyParser('test/ll1_grammar')
+        expected = parsing.LL1Parser(compiled=True)
+        for path in ['test/accept_add_two_expressions', 'test/accept_if_statement',
+                     'test/accept_nested_condition', 'test/reject_if_no_parentheses',
+                     'test/reject_minus_plus', 'test/reject_too_many_parentheses']:
+            with open(path) as file:
+                string = file.read()
+            self.assertEqual(parser.check(string), expected.check(string))
+            if parser.check(string) == parsing.ACCEPTED:
+                tree = parser.derivation(parsing.WHITESPACE.sub('', string))
+                self.assertEqual(self.check_original_tree('test/ll1_grammar', tree),
+                                 parsing.WHITESPACE.sub('', string))
+
+    def test_EarleyParser_right_recursion_is_linear(self):
+        with tempfile.TemporaryDirectory() as directory:
+            grammar = os.path.join(directory, 'grammar')
+            with open(grammar, 'w') as file:
+                file.write('S -> a S | b\n')
+            parser = parsing.EarleyParser(grammar)
+            for length in [100, 1000]:
+                chart = parser.chart('a' * length + 'b')
+                self.assertTrue(chart.accepts())
+                # Leo's chains keep every set the same size
+                self.assertEqual(max(len(items) for items in chart.items), 3)
+            tree = parser.derivation('a' * 1000 + 'b')
+            self.assertEqual(self.check_original_tree(grammar, tree), 'a' * 1000 + 'b')
+            self.assertFalse(parser.recognise('a' * 10))
+
+    def test_EarleyParser_cyclic_nullable_grammar(self):
+        with tempfile.TemporaryDirectory() as directory:
+            grammar = os.path.join(directory, 'grammar')
+            with open(grammar, 'w') as file:
+                file.write('S -> B C | ε | A\nA -> B S | b\nB -> ε\nC -> A | b S B\n')
+            parser = parsing.EarleyParser(grammar)
+            self.assertTrue(parser.recognise(''))
+            self.assertEqual(parser.derivation(''), ['S'])
+            for string in ['b', 'bb', 'bbbb']:
+                tree = parser.derivation(string)
+                self.assertEqual(self.check_original_tree(grammar, tree), string)
+            self.assertEqual(parser.check('ba'), parsing.ERROR_INVALID_SYMBOL)
+
+    # Test LALR(1) Parser
+    def test_LALR1Parser_left_recursive_grammar(self):
+        grammar = 'test/test10_lalr_grammar'
+        self.assertRaises(parsing.LL1ConflictError, parsing.LL1Grammar(grammar).compile)
+        parser = parsing.LALR1Parser.from_grammar(grammar, cache_dir=None)
+        expected = parsing.EarleyParser(grammar)
+        for string in ['a', 'a+b*(c+1)', '((a))*2+3', 'a+', '(a', 'a*+b', '', 'a+9']:
+            self.assertEqual(parser.check(string), expected.check(string))
+        self.assertEqual(parser.derivation('a+b*c'), expected.derivation('a+b*c'))
+        self.assertEqual(parser.derivation('a+b*c'),
+                         ['E', ['E', ['T', ['F', 'a']]], '+',
+                          ['T', ['T', ['F', 'b']], '*', ['F', 'c']]])
+
+    def test_LALR1Grammar_lookaheads_not_SLR(self):
+        # the classic grammar that is LALR(1) but not SLR(1)
+        with tempfile.TemporaryDirectory() as directory:
+            grammar = os.path.join(directory, 'grammar')
+            with open(grammar, 'w') as file:
+                file.write('S -> L = R | R\nL -> * R | i\nR -> L\n')
+            action, goto, conflicts = parsing.LALR1Grammar(grammar).build_table()
+            self.assertEqual(conflicts, [])
+            parser = parsing.LALR1Parser.from_grammar(grammar, cache_dir=None)
+            self.assertEqual(parser.check('*i=**i'), parsing.ACCEPTED)
+            self.assertEqual(parser.check('i=i='), parsing.REJECTED)
+
+    def test_LALR1Grammar_reports_conflicts(self):
+        grammar = 'test/test7_cyk_ambiguous_grammar'
+        with self.assertRaises(parsing.LALR1ConflictError) as context:
+            parsing.LALR1Grammar(grammar).compile()
+        self.assertIn("shift 9 / reduce PP -> P NP", str(context.exception))
+
+    def test_LALR1Parser_from_grammar_uses_cached_table(self):
+        grammar = 'test/test10_lalr_grammar'
+        with tempfile.TemporaryDirectory() as cache_dir:
+            parser = parsing.LALR1Parser.from_grammar(grammar, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            cached = parsing.LALR1Parser.from_grammar(grammar, cache_dir=cache_dir)
+            self.assertEqual(cached.action, parser.action)
+            self.assertEqual(cached.rules, parser.rules)
+            self.assertEqual(cached.derivation('(a+1)*b'), parser.derivation('(a+1)*b'))
+
+    # Test Lexer
+    def test_Lexer_longest_match_and_priority(self):
+        lexer = parsing.Lexer([('if', 'if'), ('id', '[a-z]+'), ('num', r'\d+(\.\d+)?'),
+                               ('op', '[-+*/=]|=='), ('_', r'\s+')])
+        tokens = lexer.tokenize('if iffy == 3.25+x')
+        self.assertEqual(tokens.typecode, 'i')
+        self.assertEqual(lexer.symbols(tokens), ['if', 'id', 'op', 'num', 'op', 'id'])
+        with self.assertRaises(parsing.LexError) as context:
+            lexer.tokenize('x = $')
+        self.assertEqual(context.exception.offset, 4)
+        self.assertRaises(parsing.TokenSpecError, parsing.Lexer, [('a', 'a*')])
+        self.assertRaises(parsing.TokenSpecError, parsing.Lexer, [('a', '(a')])
+        # ties go to the first pattern in the spec, whatever its token id
+        lexer = parsing.Lexer([('_', 'if'), ('ID', '[a-z]+'), ('_', ' ')])
+        self.assertEqual(lexer.symbols(lexer.tokenize('if ifs')), ['ID'])
+        lexer = parsing.Lexer([('A', 'x'), ('B', 'ab'), ('A', 'ab')])
+        self.assertEqual(lexer.symbols(lexer.tokenize('abx')), ['B', 'A'])
+
+    def test_Lexer_tokens_for_LL1Parser_and_CYKParser(self):
+        lexer = parsing.Lexer.from_file('test/ll1_tokens')
+        grammar = 'test/ll1_token_grammar'
+        ll1 = parsing.LL1Parser.from_grammar(grammar, cache_dir=None)
+        cyk = parsing.CYKParser(grammar, cnf=True)
+        expected = parsing.LL1Parser(compiled=True)
+        for path in ['test/accept_add_two_expressions', 'test/accept_if_statement',
+                     'test/accept_nested_condition', 'test/accept_times_multiple_expressions',
+                     'test/reject_extra_left_parentheses', 'test/reject_if_no_parentheses',
+                     'test/reject_minus_plus', 'test/reject_too_many_parentheses',
+                     'test/test4_invalid']:
+            with open(path) as file:
+                text = file.read()
+            self.assertEqual(parsing.check_tokens(ll1, lexer, text), expected.check(text))
+            self.assertEqual(parsing.check_tokens(cyk, lexer, text), expected.check(text))
+        # keywords are single tokens
+        text = '(if(ifa0)b)'
+        self.assertEqual(len(lexer.tokenize(text)), len(text) - 2)
+        self.assertEqual(parsing.check_tokens(ll1, lexer, '(i f a b)'),
+                         parsing.ERROR_INVALID_SYMBOL)
+        # token names that are not terminals are rejected, not looked up
+        lexer = parsing.Lexer([('(', r'\('), (')', r'\)'), ('+', r'\+'), ('a', 'a'),
+                               ('b', 'b'), ('x', 'x')])
+        tokens = lexer.tokenize('(+ax)')
+        self.assertIs(ll1.recognise_tokens(tokens, lexer), False)
+        self.assertIs(cyk.recognise_tokens(tokens, lexer), False)
+        self.assertIs(ll1.recognise_tokens(lexer.tokenize('(+ab)'), lexer), True)
+
+    # Test input loading
+    def test_read_input_strips_and_validates(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'input')
+            with open(path, 'w') as file:
+                file.write(' ( i f\ta\n a )\r\n')
+            self.assertEqual(parsing.read_input(path), ('(ifaa)', None))
+            self.assertEqual(parsing.read_input(path, parsing.TERMINALS), ('(ifaa)', True))
+            self.assertEqual(parsing.read_input(path, set('(ifa')), ('(ifaa)', False))
+            # terminals that are not single characters are checked as a set
+            self.assertEqual(parsing.read_input(path, set(['(', 'if', 'a', ')'])),
+                             ('(ifaa)', False))
+            with open(path, 'w') as file:
+                file.write('(print ε)')
+            self.assertEqual(parsing.read_input(path, set('(print)ε')), ('(printε)', True))
+            open(path, 'w').close()
+            self.assertEqual(parsing.read_input(path, parsing.TERMINALS), ('', True))
+
+    def test_read_input_from_pipe(self):
+        read, write = os.pipe()
+        os.write(write, b'(ifa\n b)')
+        os.close(write)
+        try:
+            path = '/dev/fd/{fd}'.format(fd=read)
+            self.assertEqual(parsing.read_input(path, parsing.TERMINALS), ('(ifab)', True))
+        finally:
+            os.close(read)
+
+    def test_CompiledLL1Table_maps_bytes_to_ids(self):
+        compiled = parsing.LL1Parser(compiled=True).compile()
+        self.assertIsNotNone(compiled.byte_ids)
+        self.assertEqual(list(compiled.token_ids('(ifab)')),
+                         [compiled.ids[symbol] for symbol in '(ifab)'])
+        self.assertEqual(list(compiled.token_ids(['(', 'a'])),
+                         [compiled.ids['('], compiled.ids['a']])
+
+    # Test incremental re-parsing
+    def test_CYKParser_reparse_matches_full_parse(self):
+        parser = parsing.CYKParser('test/test6_cyk_unambiguous_grammar')
+        # (if(ifa0)b) is accepted, and each edit is applied to the last state
+        state = parser.parse_state('(if(ifa0)b)')
+        self.assertEqual(state.accepted, True)
+        for offset, deleted, inserted, accepted in [
+                (6, 1, 'b', True), (0, 0, '', True), (11, 0, ')', False),
+                (11, 1, '', True), (3, 6, '', False), (3, 0, '(if a 0)', True),
+                (0, 11, '(+ab)', True), (2, 1, '?', None), (1, 2, '-', True)]:
+            state = parser.reparse(state, offset, deleted, inserted)
+            table = parser.bitset_table(state.string, sparse=True)
+            if accepted is None:
+                self.assertIsNone(state.table)
+                self.assertIsNone(table)
+                continue
+            self.assertEqual(state.table.cells, table.cells, state.string)
+            self.assertEqual(state.accepted, accepted, state.string)
+            self.assertEqual(parser.recognise_bitset(state.string), accepted)
+
+    def test_LL1Parser_reparse_resumes_from_checkpoint(self):
+        parser = parsing.LL1Parser(compiled=True)
+        string = '(if(ifa0)b)'
+        state = parser.parse_state(string, interval=2)
+        self.assertEqual([position for position, stack in state.checkpoints],
+                         [0, 2, 4, 6, 8, 10])
+        edited = parser.reparse(state, 6, 1, 'b')
+        self.assertEqual(edited.accepted, True)
+        # the stacks saved before the edit are reused
+        self.assertEqual(edited.checkpoints[:4], state.checkpoints[:4])
+        self.assertEqual(edited.checkpoints,
+                         parser.parse_state(edited.string, interval=2).checkpoints)
+        rejected = parser.reparse(edited, 1, 1, '')
+        self.assertEqual((rejected.accepted, rejected.rejected_at), (False, 1))
+        # the edit is after the rejected token, so it is still rejected
+        self.assertEqual(parser.reparse(rejected, 5, 0, 'b').accepted, False)
+        fixed = parser.reparse(rejected, 1, 0, 'i')
+        self.assertEqual((fixed.accepted, fixed.string), (True, string.replace('a', 'b')))
+        invalid = parser.reparse(fixed, 0, 0, '?')
+        self.assertEqual((invalid.valid, invalid.accepted), (False, False))
+        self.assertEqual(parser.reparse(invalid, 0, 1, '').accepted, True)
+
+    def test_apply_edit_checks_range(self):
+        self.assertEqual(parsing.apply_edit('(ifab)', 4, 1, ' a a '), ('(ifaaa)', 'aa'))
+        self.assertEqual(parsing.apply_edit(['a', 'b'], 1, 1, ['c']), (['a', 'c'], ['c']))
+        with self.assertRaises(IndexError):
+            parsing.apply_edit('(ifab)', 5, 2, '')
+
+    # Test error reporting and recovery
+    def test_LL1Parser_errors_reports_position_and_expected(self):
+        parser = parsing.LL1Parser()
+        self.assertEqual(parser.errors('(if(-1a)(print1))'), [])
+        # input: ()if+-*printabcd0123
+        error, = parser.errors(parser.read_input('test/test3_rejected'))
+        self.assertEqual((error.offset, error.token), (1, ')'))
+        self.assertEqual(error.expected, ['*', '+', '-', 'i', 'p'])
+        self.assertEqual(str(error),
+                         "offset 1: unexpected ')', expected '*', '+', '-', 'i', 'p'")
+        error, = parser.errors('(+a')
+        self.assertEqual((error.offset, error.token), (3, '$'))
+        self.assertIn('unexpected end of input', str(error))
+
+    def test_LL1Parser_report_recovers_with_line_and_column(self):
+        parser = parsing.LL1Parser()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'input')
+            with open(path, 'w') as file:
+                file.write('(+ab)) (if x a)\n  (- ?)\n')
+            errors = parser.report(path, recover=True)
+            self.assertEqual([(error.line, error.column, error.token) for error in errors],
+                             [(1, 6, ')'), (1, 12, 'x'), (1, 15, ')'), (2, 6, '?')])
+            first, = parser.report(path)
+            self.assertEqual(str(first), str(errors[0]))
+            self.assertEqual(str(first),
+                             "line 1, column 6: unexpected ')', expected end of input")
+            out = io.StringIO()
+            sys.stdout = out
+            parsing.main(path, trace=False, recover=True)
+            sys.stdout = sys.__stdout__
+            lines = out.getvalue().strip().split('\n')
+            self.assertEqual(lines[:-1], [str(error) for error in errors])
+            self.assertEqual(lines[-1], parsing.REJECTED)
+
+    def test_SourceMap_locates_stripped_offsets(self):
+        source = parsing.SourceMap('  ab c\n\td  \n')
+        self.assertEqual([source.locate(offset) for offset in range(0, 5)],
+                         [(1, 3), (1, 4), (1, 6), (2, 2), (2, 3)])
+
+    # Test pruning the CYK table with yield lengths and corners
+    def test_CYKParser_yield_bounds_and_corners_test5(self):
+        parser = parsing.CYKParser('test/test5_cyk_ambiguous_grammar')
+        self.assertEqual((parser.min_yield['PP'], parser.max_yield['PP']), (2, 3))
+        self.assertEqual((parser.min_yield['NP'], parser.max_yield['NP']), (1, 2))
+        self.assertEqual((parser.min_yield['S'], parser.max_yield['S']), (2, math.inf))
+        self.assertEqual(parser.mask_symbols(parser.corner_masks[True, True]), ['S'])
+        self.assertEqual(parser.mask_symbols(parser.corner_masks[True, False]),
+                         ['NP', 'Det'])
+        # PP can only derive strings of 2 or 3 tokens
+        self.assertEqual(parser.mask_symbols(parser.span_mask(1, 4, 7)), ['VP'])
+
+    def test_CYKParser_pruned_table_keeps_answers_and_trees(self):
+        # she eats is an S, but not at the start of a longer sentence
+        parser = parsing.CYKParser('test/test5_cyk_ambiguous_grammar')
+        string = 'she eats a fish with a fork'.split()
+        table = parser.bitset_table(string)
+        self.assertEqual(parser._recognition_table(string)[1, 0], ['S'])
+        self.assertEqual(table[1, 0], 0)
+        self.assertEqual(parser.forest(string).count(), 1)
+        grammar = 'test/test6_cyk_unambiguous_grammar'
+        parser = parsing.CYKParser(grammar)
+        for input in ['test/test1_accepted', 'test/test3_rejected',
+                      'test/accept_nested_condition', 'test/accept_times_multiple_expressions',
+                      'test/reject_too_many_parentheses', 'test/reject_if_missing_expression']:
+            string = parser.read_input(input)
+            dense = parser.bitset_table(string)
+            unpruned = parser._recognition_table(string)
+            for row in range(0, len(string)):
+                for column in range(0, len(string) - row):
+                    self.assertTrue(set(parser.mask_symbols(dense[row, column])) <=
+                                    set(unpruned[row, column]))
+            self.assertEqual(parser.recognise_bitset(string, sparse=False),
+                             parser.recognise_string(string), input)
+
+    # Test filling the CYK table in parallel
+    def test_CYKParser_parallel_table_matches_bitset_table(self):
+        grammar = 'test/test6_cyk_unambiguous_grammar'
+        parser = parsing.CYKParser(grammar)
+        block_work = parsing.PARALLEL_BLOCK_WORK
+        # hand every span length with two or more spans to the workers
+        parsing.PARALLEL_BLOCK_WORK = 1
+        try:
+            for string in ['(if(-1a)(print1))', '()if+-*printabcd0123', '(if(-1))',
+                           '(*' + '(+(ifa(-b)))' * 4 + ')', '1', '', '(ifa?)']:
+                table = parser.parallel_table(string, processes=2)
+                expected = parser.bitset_table(string)
+                if expected is None:
+                    self.assertIsNone(table)
+                else:
+                    self.assertEqual(table.cells, expected.cells, string)
+        finally:
+            parsing.PARALLEL_BLOCK_WORK = block_work
+            parser.close_pool()
+
+    def test_CYKParser_parallel_table_reuses_pool(self):
+        parser = parsing.CYKParser('test/test11_cyk_dense_grammar')
+        block_work = parsing.PARALLEL_BLOCK_WORK
+        parsing.PARALLEL_BLOCK_WORK = 1
+        try:
+            parser.parallel_table('abaabbbaab', processes=2)
+            pool = parser._pool
+            self.assertIsNotNone(pool)
+            # the workers attach to the shared memory of each new table
+            for string in ['abbaab', 'bababaabab', 'aab' * 5]:
+                self.assertEqual(parser.parallel_table(string, processes=2).cells,
+                                 parser.bitset_table(string).cells)
+                self.assertIs(parser._pool, pool)
+            # the pool is not sent to other processes
+            self.assertIsNone(pickle.loads(pickle.dumps(parser))._pool)
+            parser.parallel_table('abaabbbaab', processes=3)
+            self.assertIsNot(parser._pool, pool)
+        finally:
+            parsing.PARALLEL_BLOCK_WORK = block_work
+            parser.close_pool()
+        self.assertIsNone(parser._pool)
+
+    def test_CYKParser_parallel_threshold_parses_dense_chart(self):
+        grammar = 'test/test11_cyk_dense_grammar'
+        parser = parsing.CYKParser(grammar, parallel_threshold=10, processes=2)
+        serial = parsing.CYKParser(grammar)
+        string = 'abaabbbaab'
+        self.assertTrue(parser._is_parallel(string))
+        self.assertFalse(parser._is_parallel('abab'))
+        self.assertEqual(parser.accepts(string), True)
+        self.assertEqual(parser.accepts(string + 'c'), False)
+        # the sparse engine is kept for charts that are mostly empty
+        sparse = parsing.CYKParser('test/test6_cyk_unambiguous_grammar',
+                                   parallel_threshold=10, processes=2)
+        self.assertLess(sparse._chart_density('(if(-1a)(print1))'), parsing.PARALLEL_MIN_DENSITY)
+        self.assertFalse(sparse._is_parallel('(if(-1a)(print1))'))
+        arena, root = parser.derivation(string)
+        serial_arena, serial_root = serial.derivation(string)
+        parser.close_pool()
+        self.assertEqual(parser._generate_tree(arena.node(root)),
+                         serial._generate_tree(serial_arena.node(serial_root)))
+
+    @unittest.skipIf(parsing.numpy is None, 'NumPy is not installed')
+    def test_CYKParser_dense_chart_prefers_numpy_to_parallel(self):
+        grammar = 'test/test11_cyk_dense_grammar'
+        parser = parsing.CYKParser(grammar, numpy_threshold=10,
+                                   parallel_threshold=10, processes=2)
+        string = 'abaabbbaab'
+        self.assertTrue(parser._is_parallel(string))
+        self.assertEqual(parser._engine(string), 'numpy')
+        parser.parallel_table = None
+        self.assertEqual(parser.accepts(string), True)
+        arena, root = parser.derivation(string)
+        serial = parsing.CYKParser(grammar, numpy_threshold=None)
+        serial_arena, serial_root = serial.derivation(string)
+        self.assertEqual(parser._generate_tree(arena.node(root)),
+                         serial._generate_tree(serial_arena.node(serial_root)))
+        # without NumPy for this string, the table is filled in parallel
+        parser.numpy_bytes = lambda len_string: parsing.NUMPY_MAX_BYTES + 1
+        self.assertEqual(parser._engine(string), 'parallel')
+
+    @unittest.skipIf(parsing.numpy is None, 'NumPy is not installed')
+    def test_CYKParser_numpy_table_matches_bitset_table(self):
+        for grammar, strings in [('test/test11_cyk_dense_grammar', ['abaabbbaab', 'b', '']),
+                                 ('test/test6_cyk_unambiguous_grammar',
+                                  ['(if(-1a)(print1))', '(if(-1))', '(ifa?)'])]:
+            parser = parsing.CYKParser(grammar)
+            for string in strings:
+                table = parser.numpy_table(string)
+                expected = parser.bitset_table(string)
+                if expected is None:
+                    self.assertIsNone(table)
+                else:
+                    self.assertEqual(table.cells, expected.cells, string)
+
+    def test_CYKParser_parallel_blocks_balance_work(self):
+        parser = parsing.CYKParser('test/test6_cyk_unambiguous_grammar')
+        # short spans have too few partitions to be worth sending to a worker
+        self.assertEqual(parser._parallel_blocks(2, 1000, 4), [(2, 0, 999)])
+        blocks = parser._parallel_blocks(500, 4000, 4)
+        self.assertEqual(len(blocks), 4 * parsing.PARALLEL_BLOCKS_PER_PROCESS)
+        self.assertEqual([block[1] for block in blocks[1:]],
+                         [block[2] for block in blocks[:-1]])
+        self.assertEqual((blocks[0][1], blocks[-1][2]), (0, 3501))
+        shared = parsing.SharedCells(memoryview(bytearray(32)).cast('Q'), 2)
+        shared[1] = (5 << 64) | 3
+        self.assertEqual((shared[0], shared[1]), (0, (5 << 64) | 3))
+        self.assertEqual(shared.tolist(), [0, (5 << 64) | 3])
+
+    # Test the benchmark generators and runner
+    def test_GrammarGenerator_generates_strings_of_G_prime(self):
+        generator = parsing.GrammarGenerator.from_ll1_table(seed=1)
+        parser = parsing.LL1Parser()
+        for length in [1, 10, 100]:
+            for _ in range(0, 5):
+                string = generator.generate(length)
+                self.assertGreaterEqual(len(string), length)
+                self.assertTrue(parser.recognise(''.join(string)), string)
+        self.assertLess(len(generator.generate(depth=2)), len(generator.generate(depth=8)))
+        string = generator.generate(50)
+        edited = generator.near_valid(string, edits=3)
+        self.assertLessEqual(abs(len(edited) - len(string)), 3)
+        self.assertTrue(set(edited) <= parsing.TERMINALS)
+
+    def test_GrammarGenerator_generates_strings_of_grammar_file(self):
+        grammar = 'test/test6_cyk_unambiguous_grammar'
+        generator = parsing.GrammarGenerator.from_grammar(grammar, seed=2)
+        again = parsing.GrammarGenerator.from_grammar(grammar, seed=2)
+        parser = parsing.CYKParser(grammar)
+        strings = [generator.generate(40) for _ in range(0, 5)]
+        self.assertEqual(strings, [again.generate(40) for _ in range(0, 5)])
+        for string in strings:
+            self.assertTrue(parser.accepts(string), string)
+        # every variable is closed by a rule with the least height
+        self.assertEqual(generator.closing['E'], ('a',))
+
+    def test_run_benchmark_reports_each_engine(self):
+        self.assertAlmostEqual(parsing.scaling_exponent([10, 20, 40], [0.01, 0.08, 0.64]), 3)
+        self.assertEqual(parsing.percentile([1, 2, 3, 4], 0.5), 2.5)
+        results = parsing.run_benchmark('test/test10_lalr_grammar', lengths=[4, 8],
+                                        repeats=2, engines=['cyk-sparse', 'lalr'])
+        self.assertEqual(sorted(results['engines']), ['cyk-sparse', 'lalr'])
+        for result in results['engines'].values():
+            self.assertEqual([row['length'] for row in result['lengths']], [4, 8])
+            self.assertEqual(sorted(result['lengths'][0]['latency']),
+                             ['mean', 'p50', 'p90', 'p99'])
+            self.assertGreater(result['lengths'][0]['peak_memory'], 0)
+        self.assertEqual([row['accepted'] for row in results['engines']['lalr']['lengths']],
+                         [row['accepted'] for row in results['engines']['cyk-sparse']['lengths']])
+        json.dumps(results)
+
+    # Test ParseStats
+    def test_LL1Parser_stats_agree_between_engines(self):
+        string = '(if(-1a)(print1))'
+        counters = []
+        for compiled in [False, True]:
+            stats = parsing.ParseStats()
+            parser = parsing.LL1Parser(compiled=compiled, stats=stats)
+            self.assertTrue(parser.recognise(string))
+            counters.append(dict(stats.counters))
+        self.assertEqual(counters[0], counters[1])
+        # every step either looks up the table or matches a symbol
+        self.assertEqual(counters[0]['steps'], counters[0]['lookups'] + counters[0]['matches'])
+        self.assertEqual(counters[0]['matches'], len(string) + 1)
+
+    def test_CYKParser_stats_count_cells_rules_and_nodes(self):
+        stats = parsing.ParseStats()
+        parser = parsing.CYKParser('test/test6_cyk_unambiguous_grammar', stats=stats)
+        sys.stdout = io.StringIO()
+        try:
+            self.assertTrue(parser.parse('test/test1_accepted'))
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertEqual(sorted(stats.timers), ['fill', 'output', 'read', 'tree', 'validate'])
+        self.assertEqual(stats.counters['cells'], 17 * 18 // 2)
+        self.assertLessEqual(stats.counters['rule_matches'], stats.counters['rule_checks'])
+        # 17 terminals, 17 unit productions and 16 binary nodes
+        self.assertEqual(stats.counters['nodes'], 50)
+        dense = parsing.ParseStats()
+        parser.stats = dense
+        parser.bitset_table('(if(-1a)(print1))')
+        self.assertEqual(dense.counters['cells_filled'], stats.counters['cells_filled'])
+        self.assertIsNone(pickle.loads(pickle.dumps(parser)).stats)
+
+    def test_main_prints_stats_to_stderr(self):
+        out, err = io.StringIO(), io.StringIO()
+        sys.stdout, sys.stderr = out, err
+        try:
+            parsing.main('test/test1_accepted', compiled=True, stats=True)
+        finally:
+            sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+        self.assertEqual(out.getvalue(), parsing.ACCEPTED + '\n')
+        lines = err.getvalue().splitlines()
+        self.assertEqual([line.split()[0] for line in lines],
+                         ['read', 'validate', 'fill', 'output',
+                          'lookups', 'matches', 'max_stack', 'steps'])
+
+    # Test ParserServer
+    def test_ParserServer_answers_json_lines(self):
+        requests = [{'id': 1, 'input': '(if(-1a)(print1))'},
+                    {'id': 2, 'input': '9 +', 'parser': 'lalr',
+                     'grammar': 'test/test10_lalr_grammar'},
+                    {'id': 3, 'input': 'a + b', 'parser': 'lalr',
+                     'grammar': 'test/test10_lalr_grammar', 'tree_format': 'json'},
+                    {'id': 4, 'input': 'a', 'parser': 'cyk'}]
+        source = io.StringIO(''.join(json.dumps(request) + '\n' for request in requests) +
+                             'not json\n')
+        output = io.StringIO()
+        with tempfile.TemporaryDirectory() as cache_dir:
+            server = parsing.ParserServer(cache_dir)
+            parsing.asyncio.run(server.serve_stdin(source, output))
+        responses = [json.loads(line) for line in output.getvalue().splitlines()]
+        by_id = {response['id']: response for response in responses}
+        self.assertEqual(len(responses), 5)
+        self.assertEqual(by_id[1], {'id': 1, 'result': parsing.ACCEPTED, 'accepted': True})
+        self.assertEqual(by_id[2]['result'], parsing.ERROR_INVALID_SYMBOL)
+        self.assertEqual(json.loads(by_id[3]['tree'])[0], 'E')
+        self.assertIn('grammar', by_id[4]['error'])
+        self.assertIn('error', by_id[None])
+
+    def test_ParserServer_answers_every_request(self):
+        with tempfile.TemporaryDirectory() as directory:
+            empty = os.path.join(directory, 'empty')
+            open(empty, 'w').close()
+            server = parsing.ParserServer(directory)
+            self.assertIn('input', server.handle({'id': 1, 'input': 5})['error'])
+            for kind in ['cyk', 'lalr']:
+                response = server.handle({'id': 2, 'input': 'a', 'parser': kind,
+                                          'grammar': empty})
+                self.assertEqual(sorted(response), ['error', 'id'])
+            # with cnf the tree is in terms of the original grammar, as in main
+            response = server.handle({'input': 'a', 'parser': 'cyk', 'cnf': True,
+                                      'grammar': 'test/test9_cyk_cnf_grammar'})
+            self.assertEqual(response['tree'], "['S', ['E', ['V', 'a']]]")
+
+    def test_ParserServer_reloads_a_changed_grammar(self):
+        with tempfile.TemporaryDirectory() as directory:
+            grammar = os.path.join(directory, 'grammar')
+            with open(grammar, 'w') as file:
+                file.write('S -> a\n')
+            server = parsing.ParserServer(directory)
+            request = {'input': 'b b', 'parser': 'earley', 'grammar': grammar}
+            self.assertEqual(server.handle(request)['result'], parsing.ERROR_INVALID_SYMBOL)
+            first = server.parser('earley', grammar)[0]
+            self.assertIs(server.parser('earley', grammar)[0], first)
+            with open(grammar, 'w') as file:
+                file.write('S -> b b\n')
+            self.assertEqual(server.handle(request)['tree'], "['S', 'b', 'b']")
+
+    def test_ParserServer_loads_other_parsers_while_one_loads(self):
+        server = parsing.ParserServer(None)
+        started = parsing.threading.Event()
+        release = parsing.threading.Event()
+        load = server._load
+        def slow_load(kind, grammar, cnf):
+            if kind == 'earley':
+                started.set()
+                release.wait(10)
+            return load(kind, grammar, cnf)
+        server._load = slow_load
+        thread = parsing.threading.Thread(target=server.parser,
+                                          args=('earley', 'test/test10_lalr_grammar'))
+        thread.start()
+        try:
+            self.assertTrue(started.wait(10))
+            # the LL(1) parser is loaded while the Earley parser is loading
+            self.assertIsNotNone(server.parser('ll1')[0])
+        finally:
+            release.set()
+            thread.join()
+        self.assertIn(('earley', 'test/test10_lalr_grammar', False), server.parsers)
+
+    def test_cache_writers_use_a_temporary_file_per_thread(self):
+        names = []
+        threads = [parsing.threading.Thread(
+            target=lambda: names.append(parsing.temporary_path('cache'))) \
+                   for _ in range(0, 4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertNotEqual(names[0], parsing.temporary_path('cache'))
+        self.assertTrue(all(name.startswith('cache.') and name.endswith('.tmp') \
+                            for name in names))
+        with tempfile.TemporaryDirectory() as cache_dir:
+            loaders = [(parsing.load_ll1_table, 'test/ll1_grammar'),
+                       (parsing.load_lalr1_table, 'test/test10_lalr_grammar'),
+                       (parsing.compile_grammar, 'test/test6_cyk_unambiguous_grammar')]
+            errors = []
+            def load(loader, grammar):
+                try:
+                    loader(grammar, cache_dir)
+                except Exception as error:
+                    errors.append(error)
+            threads = [parsing.threading.Thread(target=load, args=loader) \
+                       for loader in loaders * 4]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertFalse([name for name in os.listdir(cache_dir) if name.endswith('.tmp')])
+
+    def test_main_client_prints_like_main(self):
+        grammar = 'test/test6_cyk_unambiguous_grammar'
+        requests = [{'input': '(if(-1a)(print1))'},
+                    {'input': '(if(-1a)(print1))', 'parser': 'cyk', 'grammar': grammar}]
+        def clients(path):
+            out = io.StringIO()
+            with parsing.contextlib.redirect_stdout(out):
+                parsing.main_client('test/test1_accepted', path, 'cyk', grammar)
+            return out.getvalue()
+        async def run(path):
+            server = parsing.ParserServer(cache_dir)
+            async with await server.start_unix(path):
+                loop = parsing.asyncio.get_running_loop()
+                # concurrent requests, then the client on its own
+                responses = await parsing.asyncio.gather(*[loop.run_in_executor(
+                    None, parsing.request_server, request, path) for request in requests])
+                return responses, await loop.run_in_executor(None, clients, path)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            responses, output = parsing.asyncio.run(run(os.path.join(cache_dir, 'parser.sock')))
+        self.assertEqual([response['result'] for response in responses],
+                         [parsing.ACCEPTED, parsing.ACCEPTED])
+        with open('test/test6_cyk_unambiguous_grammar_expected_output') as file:
+            expected = file.read()
+        self.assertEqual(responses[1]['tree'], expected.split('\n')[0])
+        self.assertEqual(output.strip(), expected.strip())